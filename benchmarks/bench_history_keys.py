@@ -0,0 +1,93 @@
+"""
+Measures how long ``R.get_metric_history`` takes to build the keys it reads,
+against the per-date ``_build_keys`` loop (plus ``dedupe`` and a sort) it used
+before ``KeySchema.range_periods``.
+
+Building keys doesn't talk to Redis, so this doesn't need a Redis server. Run
+it from the root of the repository::
+
+    $ python benchmarks/bench_history_keys.py
+    $ python benchmarks/bench_history_keys.py --slugs 200 --granularity daily
+
+It exits with status 1 if the two don't build the same keys, or if the new
+way isn't at least ``--min-speedup`` times faster.
+
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import sys
+import timeit
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+settings.configure(
+    INSTALLED_APPS=["redis_metrics"],
+    REDIS_METRICS={"MIN_GRANULARITY": "seconds", "MAX_GRANULARITY": "yearly"},
+)
+django.setup()
+
+from redis_metrics.models import R, dedupe  # noqa: E402
+
+
+def per_date_keys(r, slugs, since, to, granularity):
+    """Builds the keys the way ``_metric_history_keys`` used to."""
+    keys = []
+    for slug in slugs:
+        for date in r._date_range(granularity, since, to):
+            keys += r._build_keys(slug, date, granularity)
+    return sorted(dedupe(keys))
+
+
+def per_call(func, calls, repeat):
+    """The best time per call, in milliseconds, over ``repeat`` runs."""
+    return min(timeit.repeat(func, number=calls, repeat=repeat)) / calls * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--slugs", type=int, default=50)
+    parser.add_argument("--granularity", default="hourly")
+    parser.add_argument("--days", type=int, default=30)
+    parser.add_argument("--calls", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-speedup", type=float, default=2.0)
+    args = parser.parse_args()
+
+    r = R()
+    slugs = ["bench-slug-{0}".format(i) for i in range(args.slugs)]
+    to = datetime(2014, 7, 2, 12, 6, 34)
+    since = to - timedelta(days=args.days)
+
+    old = per_date_keys(r, slugs, since, to, args.granularity)
+    new = r._metric_history_keys(slugs, since, to, args.granularity)
+    if old != new:
+        print("The keys differ")
+        return 1
+    print("{0} keys for {1} slugs at {2}".format(
+        len(new), args.slugs, args.granularity
+    ))
+
+    before = per_call(
+        lambda: per_date_keys(r, slugs, since, to, args.granularity),
+        args.calls, args.repeat
+    )
+    after = per_call(
+        lambda: r._metric_history_keys(slugs, since, to, args.granularity),
+        args.calls, args.repeat
+    )
+    speedup = before / after
+    print("{0:<24} {1:8.3f} ms/call".format("per-date _build_keys", before))
+    print("{0:<24} {1:8.3f} ms/call".format("range_periods", after))
+    print("Speedup: {0:.1f}x".format(speedup))
+    if speedup < args.min_speedup:
+        print("Speedup is under {0}x".format(args.min_speedup))
+    return 1 if speedup < args.min_speedup else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""
+Measures the overhead that ``redis_metrics.timed`` and
+``redis_metrics.count_calls`` add to each call.
+
+Neither decorator talks to Redis on the calling thread, so this doesn't need
+a Redis server: nothing is flushed while the benchmark runs. Run it from the
+root of the repository::
+
+    $ python benchmarks/bench_timed.py
+    $ python benchmarks/bench_timed.py --calls 1000000 --max-overhead-us 2
+
+It exits with status 1 if any decorator adds more than ``--max-overhead-us``
+microseconds per call.
+
+"""
+from __future__ import print_function, unicode_literals
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+settings.configure(
+    INSTALLED_APPS=["redis_metrics"],
+    REDIS_METRICS={"BUFFER_FLUSH_INTERVAL": 3600},
+)
+django.setup()
+
+from redis_metrics import count_calls, timed  # noqa: E402
+from redis_metrics import utils  # noqa: E402
+
+
+def noop():
+    pass
+
+
+@timed("bench-timed")
+def timed_noop():
+    pass
+
+
+@count_calls("bench-count-calls")
+def counted_noop():
+    pass
+
+
+def timed_block():
+    with timed("bench-timed-block"):
+        pass
+
+
+def per_call(func, calls, repeat):
+    """The best time per call, in microseconds, over ``repeat`` runs."""
+    return min(timeit.repeat(func, number=calls, repeat=repeat)) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--calls", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-overhead-us", type=float, default=5.0)
+    args = parser.parse_args()
+
+    timed_noop()  # Start the recorder's thread outside of the measurements.
+    baseline = per_call(noop, args.calls, args.repeat)
+    print("{0:<24} {1:8.3f} us/call".format("undecorated", baseline))
+
+    failed = False
+    for name, func in [("@timed", timed_noop),
+                       ("with timed(...)", timed_block),
+                       ("@count_calls", counted_noop)]:
+        overhead = per_call(func, args.calls, args.repeat) - baseline
+        failed = failed or overhead > args.max_overhead_us
+        print("{0:<24} {1:8.3f} us/call overhead".format(name, overhead))
+
+    recorder = utils.get_recorder()
+    print("Calls recorded (not flushed): {0}".format(recorder.depth))
+    with recorder._lock:
+        recorder._clear()  # Don't write the benchmark's calls at exit.
+    if failed:
+        print("Overhead exceeds {0} us/call".format(args.max_overhead_us))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,7 +2,9 @@ VERSION = "2.2.0"
 __version__ = VERSION
 
 try:
-    from .utils import gauge, metric, set_metric  # NOQA
+    from .utils import gauge, metric, set_metric, timing, unique  # NOQA
+    from .utils import agauge, ametric, aset_metric, atiming, aunique  # NOQA
+    from .utils import count_calls, timed  # NOQA
 except ImportError:  # pragma: no cover
     pass  # pragma: no cover
 
@@ -0,0 +1,261 @@
+"""
+A small statsd-like agent that collects metrics over UDP (or a Unix datagram
+socket) and writes them to Redis. Run it with::
+
+    manage.py redis_metrics_agent
+
+Each datagram holds one or more newline-separated lines:
+
+* ``<slug>:<num>|c`` -- increment a metric by ``num``
+* ``<slug>:<num>|c|@<rate>`` -- a metric sampled at ``rate`` (e.g. 0.1); the
+  increment is scaled by ``1 / rate``
+* ``<slug>:<value>|g`` -- set a gauge
+
+For example, from a shell script::
+
+    echo "deploys:1|c" | nc -u -w0 127.0.0.1 8125
+
+Lines are summed in memory, and everything received during a flush interval
+is written to Redis with ``R.metrics_bulk`` (plus one pipeline for gauges).
+
+"""
+from __future__ import unicode_literals
+from datetime import datetime
+import logging
+import math
+import os
+import selectors
+import socket
+import time
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+# The largest possible UDP payload.
+MAX_DATAGRAM_SIZE = 65535
+
+# Receive at most this many datagrams from one socket before checking whether
+# it's time to flush, so a flood of packets can't delay writes indefinitely.
+MAX_READS_PER_WAKEUP = 10000
+
+
+class MetricAggregator(object):
+    """Parses lines and sums them until they're flushed."""
+
+    def __init__(self):
+        self.counters = {}  # {slug (bytes): total}
+        self.gauges = {}  # {slug (bytes): latest value (bytes)}
+        self.lines = 0
+        self.parse_errors = 0
+
+    def feed(self, packet):
+        """Parses the lines in a datagram. Malformed lines are counted in
+        ``parse_errors`` and otherwise ignored."""
+        counters = self.counters
+        for line in packet.split(b"\n"):
+            if not line:
+                continue
+            self.lines += 1
+            slug, _, rest = line.partition(b":")
+            value, _, rest = rest.partition(b"|")
+            kind, _, rate = rest.partition(b"|")
+            try:
+                if not slug:
+                    raise ValueError(line)
+                if kind == b"c":
+                    num = float(value)
+                    if rate:
+                        if rate[:1] != b"@":
+                            raise ValueError(line)
+                        num /= float(rate[1:])
+                    total = counters.get(slug, 0) + num
+                    if not math.isfinite(total):
+                        raise ValueError(line)  # nan, inf or an overflow
+                    counters[slug] = total
+                elif kind == b"g":
+                    if not math.isfinite(float(value)):
+                        raise ValueError(line)
+                    self.gauges[slug] = value.strip()
+                else:
+                    raise ValueError(line)
+            except (ValueError, ZeroDivisionError):
+                self.parse_errors += 1
+
+    def take(self):
+        """Returns the ``(counters, gauges)`` summed so far, with slugs and
+        gauge values decoded, and starts over."""
+        counters, self.counters = self.counters, {}
+        gauges, self.gauges = self.gauges, {}
+        counters = dict(
+            (slug.decode("utf-8", "replace"), int(round(total)))
+            for slug, total in counters.items()
+        )
+        gauges = dict(
+            (slug.decode("utf-8", "replace"), value.decode("ascii"))
+            for slug, value in gauges.items()
+        )
+        return counters, gauges
+
+
+class Agent(object):
+
+    def __init__(self, r, host="127.0.0.1", port=8125, unix_socket=None,
+                 flush_interval=10):
+        """Creates an agent that writes metrics using the given ``R`` instance.
+
+        * ``r`` -- an instance of ``redis_metrics.models.R``
+        * ``host`` / ``port`` -- the UDP address to listen on; set ``port`` to
+          None to disable UDP.
+        * ``unix_socket`` -- optional path for a Unix datagram socket.
+        * ``flush_interval`` -- the number of seconds between writes to Redis.
+
+        """
+        self.r = r
+        self.host = host
+        self.port = port
+        self.unix_socket = unix_socket
+        self.flush_interval = flush_interval
+
+        self.aggregator = MetricAggregator()
+        self.sockets = []
+        self._selector = None
+        self._running = False
+
+        self.packets = 0  # Number of datagrams received
+        self.flushes = 0  # Number of pipelines sent to Redis
+        self.write_errors = 0  # Number of flushes lost to Redis errors
+        self.last_flush_duration = 0.0  # Seconds taken by the latest flush
+        self.max_flush_duration = 0.0  # Slowest flush, in seconds
+
+    def bind(self):
+        """Opens the agent's sockets."""
+        self._selector = selectors.DefaultSelector()
+        if self.port is not None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((self.host, self.port))
+            self._add_socket(sock)
+        if self.unix_socket:
+            if os.path.exists(self.unix_socket):
+                os.unlink(self.unix_socket)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            sock.bind(self.unix_socket)
+            self._add_socket(sock)
+
+    def _add_socket(self, sock):
+        # A large kernel buffer absorbs bursts while we're busy flushing.
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+        except OSError:
+            pass
+        sock.setblocking(False)
+        self._selector.register(sock, selectors.EVENT_READ)
+        self.sockets.append(sock)
+
+    @property
+    def address(self):
+        """The ``(host, port)`` the UDP socket is bound to, if any."""
+        for sock in self.sockets:
+            if sock.family == socket.AF_INET:
+                return sock.getsockname()
+
+    def close(self):
+        """Closes the agent's sockets."""
+        for sock in self.sockets:
+            sock.close()
+        self.sockets = []
+        if self._selector is not None:
+            self._selector.close()
+            self._selector = None
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
+
+    def _drain(self, sock):
+        """Reads the datagrams waiting on a socket."""
+        recv = sock.recv
+        feed = self.aggregator.feed
+        count = 0
+        try:
+            while count < MAX_READS_PER_WAKEUP:
+                feed(recv(MAX_DATAGRAM_SIZE))
+                count += 1
+        except (BlockingIOError, InterruptedError):
+            pass  # Nothing left to read.
+        self.packets += count
+
+    def serve_forever(self, on_flush=None):
+        """Receives metrics until ``stop`` is called, writing them every
+        ``flush_interval`` seconds. If given, ``on_flush`` is called with the
+        agent after each flush."""
+        if self._selector is None:
+            self.bind()
+        self._running = True
+        next_flush = time.monotonic() + self.flush_interval
+        try:
+            while self._running:
+                timeout = max(0, next_flush - time.monotonic())
+                for key, events in self._selector.select(min(timeout, 1)):
+                    self._drain(key.fileobj)
+
+                if time.monotonic() >= next_flush:
+                    self.flush()
+                    next_flush = time.monotonic() + self.flush_interval
+                    if on_flush is not None:
+                        on_flush(self)
+        finally:
+            self.flush()
+
+    def stop(self):
+        """Makes ``serve_forever`` return (within about a second)."""
+        self._running = False
+
+    def flush(self):
+        """Writes everything received since the last flush to Redis."""
+        try:
+            counters, gauges = self.aggregator.take()
+        except Exception:
+            # One bad value shouldn't stop the agent.
+            logger.exception("Dropped metrics that couldn't be converted")
+            self.write_errors += 1
+            return
+        if not counters and not gauges:
+            return
+
+        start = time.monotonic()
+        date = datetime.utcnow()
+        r = self.r
+        try:
+            if counters:
+                r.metrics_bulk((slug, num, date) for slug, num in counters.items())
+            if gauges:
+                pipe = r.r.pipeline(transaction=False)
+                pipe.sadd(r._gauge_slugs_key, *gauges.keys())
+                for slug, value in gauges.items():
+                    r._queue_gauge(pipe, slug, value, date)
+                pipe.execute()
+            self.flushes += 1
+        except RedisError:
+            logger.exception("Dropped %d metrics", len(counters) + len(gauges))
+            self.write_errors += 1
+        except Exception:
+            logger.exception("Failed to write %d metrics",
+                             len(counters) + len(gauges))
+            self.write_errors += 1
+        finally:
+            self.last_flush_duration = time.monotonic() - start
+            self.max_flush_duration = max(
+                self.max_flush_duration,
+                self.last_flush_duration
+            )
+
+    def stats(self):
+        """Returns a dictionary of counters describing this agent."""
+        return {
+            'packets': self.packets,
+            'lines': self.aggregator.lines,
+            'parse_errors': self.aggregator.parse_errors,
+            'flushes': self.flushes,
+            'write_errors': self.write_errors,
+            'last_flush_duration': self.last_flush_duration,
+            'max_flush_duration': self.max_flush_duration,
+        }
@@ -0,0 +1,388 @@
+"""
+An asyncio version of the ``R`` class, for use in async views and ASGI
+middleware. ``AsyncR`` uses ``redis.asyncio``, stores data using the same keys
+as ``R``, and its methods are coroutines that mirror the ``R`` API::
+
+    from redis_metrics.aio import AsyncR
+
+    r = AsyncR()
+    await r.metric('new-user-signup')
+    await r.get_metric_history('new-user-signup', granularity='daily')
+
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+from datetime import datetime
+
+import redis.asyncio
+import redis.asyncio.cluster
+
+from . import scripts
+from .breaker import protected
+from .keys import get_schema
+from .models import R, numpy
+from .settings import app_settings
+
+
+class AsyncR(R):
+    """Accepts the same keyword arguments as ``R``. If you use the
+    CONNECTION_CLASS setting with ``AsyncR``, it must return a
+    ``redis.asyncio`` client."""
+
+    def _redis_module(self):
+        return redis.asyncio
+
+    def _redis_class(self):
+        return redis.asyncio.StrictRedis
+
+    def _cluster_class(self):
+        return redis.asyncio.cluster.RedisCluster
+
+    def _make_spool(self):
+        # ``MetricBuffer`` writes synchronously, so ``AsyncR`` drops metrics
+        # while the circuit is open.
+        return None
+
+    def _connect_replicas(self, replicas):
+        # READ_REPLICAS only applies to ``R``; ``AsyncR`` reads from the
+        # primary.
+        return None
+
+    async def close(self):
+        """Closes the client's connection pool."""
+        # redis-py 5 renamed ``close`` to ``aclose``.
+        close = getattr(self.r, "aclose", None) or self.r.close
+        await close()
+
+    async def _run_script(self, source, keys, args):
+        if self.cluster:
+            return await self.r.eval(source, len(keys), *(list(keys) + list(args)))
+        return await self._script(source)(keys=keys, args=args)
+
+    def _queue_script(self, pipe, source, keys, args):
+        if self.cluster:
+            return super(AsyncR, self)._queue_script(pipe, source, keys, args)
+        # Calling an async script returns a coroutine, so queue its EVALSHA
+        # directly; the pipeline loads its scripts before it executes.
+        script = self._script(source)
+        pipe.scripts.add(script)
+        pipe.evalsha(script.sha, len(keys), *keys, *args)
+
+    async def _scan_keys(self, pattern):
+        if self.cluster:
+            return [key async for key in self.r.scan_iter(match=pattern)]
+        return await self.r.keys(pattern)
+
+    async def _mget(self, keys):
+        if not keys:
+            return []
+        if not get_schema().hashed:
+            if self.cluster:
+                return await self.r.mget_nonatomic(keys)
+            chunk_size = app_settings.MGET_CHUNK_SIZE
+            if len(keys) <= chunk_size:
+                return await self.r.mget(keys)
+            pipe = self.r.pipeline(transaction=False)
+            for i in range(0, len(keys), chunk_size):
+                pipe.mget(keys[i:i + chunk_size])
+            return [value for values in await pipe.execute() for value in values]
+
+        locations, fields = self._hash_fields(keys)
+        pipe = self.r.pipeline(transaction=False)
+        for name, hash_fields in fields.items():
+            pipe.hmget(name, hash_fields)
+        return self._hash_values(locations, fields, await pipe.execute())
+
+    async def categories(self):
+        return await self.r.smembers(self._categories_key)
+
+    async def _category_slugs(self, category):
+        return await self.r.smembers(self._category_key(category))
+
+    async def _categorize(self, slug, category):
+        pipe = self.r.pipeline(transaction=False)
+        pending = []
+        self._queue_sadd_once(pipe, pending, self._category_key(category), slug)
+        self._queue_sadd_once(pipe, pending, self._categories_key, category)
+        if pending:
+            await pipe.execute()
+            self._registered(pending)
+
+    async def metric_slugs(self):
+        return await self.r.smembers(self._metric_slugs_key)
+
+    async def metric_slugs_by_category(self):
+        categories = sorted(await self.categories())
+        pipe = self.r.pipeline(transaction=False)
+        for category in categories:
+            pipe.smembers(self._category_key(category))
+        pipe.smembers(self._metric_slugs_key)
+        results = await pipe.execute()
+
+        result = OrderedDict(zip(categories, results[:-1]))
+        return self._add_uncategorized(result, results[-1])
+
+    async def delete_metric(self, slug):
+        keys = await self._scan_keys("m:{0}:*".format(get_schema().tag(slug)))
+        pipe = self.r.pipeline(transaction=False)
+        self._queue_delete(pipe, keys)
+        pipe.srem(self._metric_slugs_key, slug)
+        await pipe.execute()
+        self._known_slugs.discard(self._metric_slugs_key, slug)
+
+    def _queue_metric_slugs(self, pipe, slug, category):
+        """Queues the SADDs that register a metric (and its category) on
+        ``pipe``, and returns the list to pass to ``_registered``."""
+        pending = []
+        self._queue_sadd_once(pipe, pending, self._metric_slugs_key, slug)
+        if category:
+            self._queue_sadd_once(pipe, pending, self._category_key(category), slug)
+            self._queue_sadd_once(pipe, pending, self._categories_key, category)
+        return pending
+
+    @protected
+    async def set_metric(self, slug, value, category=None, expire=None, date=None):
+        keys = self._build_keys(slug, date=date)
+        schema = get_schema()
+        expires = schema.expires(expire)
+
+        if self._use_scripts():
+            script_keys, args = self._write_script_params(
+                slug, category, keys, value, expires
+            )
+            await self._run_script(scripts.SET_METRIC, keys=script_keys, args=args)
+            return
+
+        pipe = self.r.pipeline()
+        pending = self._queue_metric_slugs(pipe, slug, category)
+        for k, ttl in zip(keys, expires):
+            if schema.hashed:
+                name, field = schema.hash_field(k)
+                pipe.hset(name, field, value)
+            else:
+                name = k
+                pipe.set(name, value)
+            if ttl:
+                pipe.expire(name, ttl)
+        await pipe.execute()
+        self._registered(pending)
+
+    @protected
+    async def metric(self, slug, num=1, category=None, expire=None, date=None,
+                     sample_rate=None):
+        num = self._sample(slug, num, sample_rate)
+        if num is None:
+            return
+
+        keys = self._build_keys(slug, date=date)
+        expires = get_schema().expires(expire)
+
+        if self._use_scripts():
+            script_keys, args = self._write_script_params(
+                slug, category, keys, num, expires
+            )
+            await self._run_script(scripts.METRIC, keys=script_keys, args=args)
+            return
+
+        pipe = self.r.pipeline()
+        pending = self._queue_metric_slugs(pipe, slug, category)
+        for key, ttl in zip(keys, expires):
+            name = self._incr(pipe, key, num)
+            if ttl:
+                pipe.expire(name, ttl)
+        await pipe.execute()
+        self._registered(pending)
+
+    @protected(raises=True)
+    async def _write_counts(self, counts, slugs, categories, expires=None,
+                            histograms=()):
+        self._wrote()
+        pipe = self.r.pipeline(transaction=False)
+        pending = []
+        self._queue_counts(pipe, pending, counts, slugs, categories, expires)
+        for histogram in histograms:
+            pending += self._queue_histogram(pipe, *histogram)
+        await pipe.execute()
+        self._registered(pending)
+
+    async def metrics_bulk(self, metrics, expire=None, chunk_size=None):
+        recorded = 0
+        for chunk in self._bulk_chunks(metrics, expire, chunk_size):
+            counts, slugs, categories, expires, num = chunk
+            await self._write_counts(counts, slugs, categories, expires)
+            recorded += num
+        return recorded
+
+    async def get_metric(self, slug):
+        keys = self._build_keys(slug)
+        values = await self._mget(keys)
+        return OrderedDict(zip(self._granularities(), values))
+
+    async def get_metrics(self, slug_list):
+        slug_list = list(slug_list)
+        values = await self._mget(self._slug_list_keys(slug_list))
+        return self._metrics_by_slug(slug_list, values)
+
+    async def get_category_metrics(self, category):
+        slug_list = await self._category_slugs(category)
+        return await self.get_metrics(slug_list)
+
+    async def delete_category(self, category):
+        pipe = self.r.pipeline(transaction=False)
+        pipe.delete(self._category_key(category))
+        pipe.srem(self._categories_key, category)
+        await pipe.execute()
+        self._known_slugs.discard(self._category_key(category))
+        self._known_slugs.discard(self._categories_key, category)
+
+    async def reset_category(self, category, metric_slugs):
+        if len(metric_slugs) == 0:
+            await self.delete_category(category)
+        else:
+            pipe = self.r.pipeline(transaction=False)
+            pipe.sadd(self._category_key(category), *metric_slugs)
+            pipe.sadd(self._categories_key, category)
+            await pipe.execute()
+
+    async def get_metric_history(self, slugs, since=None, to=None, granularity='daily'):
+        keys = self._metric_history_keys(slugs, since, to, granularity)
+        return self._metric_history_results(keys, await self._mget(keys))
+
+    async def get_metric_history_as_columns(self, slugs, since=None,
+                                            granularity='daily', as_array=False):
+        if as_array and numpy is None:
+            raise ImportError("as_array=True requires NumPy")
+        history = await self.get_metric_history(slugs, since, granularity=granularity)
+        return self._history_as_columns(slugs, history, as_array)
+
+    async def get_metric_history_chart_data(self, slugs, since=None,
+                                            granularity='daily'):
+        slugs = sorted(slugs)
+        history = await self.get_metric_history(slugs, since, granularity=granularity)
+        return self._history_as_chart_data(history)
+
+    async def gauge_slugs(self):
+        return await self.r.smembers(self._gauge_slugs_key)
+
+    @protected
+    async def gauge(self, slug, current_value, date=None):
+        pipe = self.r.pipeline(transaction=False)
+        pending = []
+        # keep track of all Gauges
+        self._queue_sadd_once(pipe, pending, self._gauge_slugs_key, slug)
+        self._queue_gauge(pipe, slug, current_value, date)
+        await pipe.execute()
+        self._registered(pending)
+
+    async def get_gauge(self, slug):
+        return await self.r.get(self._gauge_key(slug))
+
+    async def get_gauge_history(self, slug, since=None, to=None):
+        results = await self.r.zrangebyscore(
+            self._gauge_history_key(slug),
+            *self._gauge_history_range(since, to),
+            withscores=True
+        )
+        return self._gauge_history(results)
+
+    async def _hgetall(self, keys):
+        pipe = self.r.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        return await pipe.execute()
+
+    async def get_gauge_stats(self, slug, date=None):
+        keys = self._gauge_stats_keys(slug, date or datetime.utcnow())
+        values = await self._hgetall(keys)
+        return OrderedDict(
+            (granularity, self._gauge_stats(v))
+            for granularity, v in zip(self._granularities(), values)
+        )
+
+    async def get_gauge_stats_history(self, slug, since=None, to=None,
+                                      granularity='daily'):
+        keys = self._period_history_keys("gs", slug, since, to, granularity)
+        values = await self._hgetall(keys)
+        return [(k, self._gauge_stats(v)) for k, v in zip(keys, values)]
+
+    async def delete_gauge(self, slug):
+        keys = [self._gauge_key(slug), self._gauge_history_key(slug)]
+        if app_settings.GAUGE_STATS:
+            keys.extend(await self._scan_keys("gs:{0}:*".format(get_schema().tag(slug))))
+        pipe = self.r.pipeline(transaction=False)
+        self._queue_delete(pipe, keys)
+        pipe.srem(self._gauge_slugs_key, slug)
+        await pipe.execute()
+        self._known_slugs.discard(self._gauge_slugs_key, slug)
+
+    async def timer_slugs(self):
+        return await self.r.smembers(self._timer_slugs_key)
+
+    @protected
+    async def timing(self, slug, value, date=None):
+        pipe = self.r.pipeline(transaction=False)
+        pending = self._queue_timing(pipe, slug, value, date)
+        await pipe.execute()
+        self._registered(pending)
+
+    async def get_timing(self, slug, since=None, to=None, granularity='daily'):
+        keys = self._period_history_keys("t", slug, since, to, granularity)
+        return self._timer_histogram(await self._hgetall(keys))
+
+    async def get_timing_history(self, slug, since=None, to=None,
+                                 granularity='daily'):
+        keys = self._period_history_keys("t", slug, since, to, granularity)
+        return [
+            (key, self._timer_histogram([values]))
+            for key, values in zip(keys, await self._hgetall(keys))
+        ]
+
+    async def delete_timer(self, slug):
+        keys = await self._scan_keys("t:{0}:*".format(get_schema().tag(slug)))
+        pipe = self.r.pipeline(transaction=False)
+        self._queue_delete(pipe, keys)
+        pipe.srem(self._timer_slugs_key, slug)
+        await pipe.execute()
+        self._known_slugs.discard(self._timer_slugs_key, slug)
+
+    async def unique_slugs(self):
+        return await self.r.smembers(self._unique_slugs_key)
+
+    @protected
+    async def unique(self, slug, member, date=None):
+        members = member if isinstance(member, (list, tuple, set)) else [member]
+        if not members:
+            return
+        pipe = self.r.pipeline(transaction=False)
+        pending = self._queue_unique(pipe, slug, members, date)
+        await pipe.execute()
+        self._registered(pending)
+
+    async def _pfcounts(self, keys):
+        pipe = self.r.pipeline(transaction=False)
+        for key in keys:
+            pipe.pfcount(key)
+        return await pipe.execute()
+
+    async def get_unique(self, slug, date=None):
+        keys = self._unique_keys(slug, date or datetime.utcnow())
+        counts = await self._pfcounts(keys)
+        return OrderedDict(zip(self._granularities(), counts))
+
+    async def get_unique_history(self, slug, since=None, to=None,
+                                 granularity='daily'):
+        keys = self._period_history_keys("u", slug, since, to, granularity)
+        return list(zip(keys, await self._pfcounts(keys)))
+
+    async def get_unique_count(self, slug, since=None, to=None,
+                               granularity='daily'):
+        keys = self._period_history_keys("u", slug, since, to, granularity)
+        return await self.r.pfcount(*keys) if keys else 0
+
+    async def delete_unique(self, slug):
+        keys = await self._scan_keys("u:{0}:*".format(get_schema().tag(slug)))
+        pipe = self.r.pipeline(transaction=False)
+        self._queue_delete(pipe, keys)
+        pipe.srem(self._unique_slugs_key, slug)
+        await pipe.execute()
+        self._known_slugs.discard(self._unique_slugs_key, slug)
@@ -0,0 +1,214 @@
+"""
+A circuit breaker for metric writes, so that a slow or unreachable Redis
+can't hold up (or break) the code that records metrics.
+
+When the CIRCUIT_BREAKER setting is enabled, each ``R`` instance has a
+``CircuitBreaker``, and its recording methods (``metric``, ``set_metric``,
+``gauge``, ``timing`` and ``unique``, and the pipelines written for
+``metrics_bulk``, ``MetricBuffer``, ``BackgroundWriter`` and ``CallRecorder``)
+go through it.
+The circuit is:
+
+* ``"closed"`` -- writes go to Redis. A Redis error, or a write that takes
+  longer than WRITE_TIMEOUT seconds, is logged and counted rather than
+  raised; after BREAKER_FAILURES of them in a row, the circuit opens.
+* ``"open"`` -- writes are skipped until BREAKER_RESET_TIMEOUT seconds have
+  passed. With BREAKER_SPOOL_SIZE, calls to ``metric`` are summed in memory
+  instead, and written when the circuit closes.
+* ``"half-open"`` -- one write is let through as a probe. If it succeeds,
+  the circuit closes; if not, it opens again.
+
+WRITE_TIMEOUT is also used as the socket timeout when SOCKET_TIMEOUT isn't
+set, so no single Redis command can block for longer than that.
+
+"""
+from __future__ import unicode_literals
+import functools
+import inspect
+import logging
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half-open"
+
+
+class CircuitOpenError(RedisError):
+    """Raised for a skipped write that can't be dropped silently."""
+
+
+class CircuitBreaker(object):
+
+    def __init__(self, failures=5, reset_timeout=30, budget=None):
+        """Creates a closed circuit.
+
+        * ``failures`` -- the number of failures in a row that open the
+          circuit (set in settings.REDIS_METRICS['BREAKER_FAILURES'])
+        * ``reset_timeout`` -- the number of seconds the circuit stays open
+          before a probe (set in
+          settings.REDIS_METRICS['BREAKER_RESET_TIMEOUT'])
+        * ``budget`` -- the most seconds a write may take before it counts as
+          a failure, or None (set in settings.REDIS_METRICS['WRITE_TIMEOUT'])
+
+        """
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.budget = budget
+        self._lock = threading.Lock()
+
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._opened_at = 0.0
+
+        self.calls = 0  # Number of writes let through
+        self.errors = 0  # Number of writes that raised a Redis error
+        self.timeouts = 0  # Number of writes that took longer than the budget
+        self.rejected = 0  # Number of writes skipped while open
+        self.opened = 0  # Number of times the circuit opened
+        self.last_error = None
+
+    def allow(self):
+        """Returns True if a write may go to Redis now."""
+        with self._lock:
+            if self.state == CLOSED:
+                allowed = True
+            elif self.state == OPEN and (
+                time.monotonic() - self._opened_at >= self.reset_timeout
+            ):
+                self.state = HALF_OPEN
+                allowed = True
+            else:
+                # Only one probe at a time while half-open.
+                allowed = False
+            if allowed:
+                self.calls += 1
+            else:
+                self.rejected += 1
+            return allowed
+
+    def record(self, elapsed, error=None):
+        """Records the outcome of a write that ``allow`` let through, and
+        returns True if it closed the circuit."""
+        with self._lock:
+            if error is None and self.budget and elapsed > self.budget:
+                error = "took {0:.3f}s, over the {1}s budget".format(
+                    elapsed, self.budget
+                )
+                self.timeouts += 1
+            elif error is not None:
+                self.errors += 1
+
+            if error is None:
+                closed = self.state != CLOSED
+                self.state = CLOSED
+                self.consecutive_failures = 0
+                if closed:
+                    logger.info("Metric writes resumed")
+                return closed
+
+            self.last_error = str(error)
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or (
+                self.state == CLOSED
+                and self.consecutive_failures >= self.failures
+            ):
+                self.state = OPEN
+                self._opened_at = time.monotonic()
+                self.opened += 1
+                logger.warning(
+                    "Skipping metric writes for %ss after %d failures: %s",
+                    self.reset_timeout, self.consecutive_failures, error
+                )
+            return False
+
+    def abandon(self):
+        """Records that a write ``allow`` let through raised something other
+        than a Redis error. That says nothing about Redis, so if it was the
+        probe, the circuit goes back to open, and the next write is the
+        probe instead."""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+
+    def stats(self):
+        """Returns a dictionary describing the circuit."""
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'calls': self.calls,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'rejected': self.rejected,
+            'opened': self.opened,
+            'last_error': self.last_error,
+        }
+
+
+def protected(method=None, raises=False):
+    """Decorates an ``R`` write method (or coroutine method) to go through the
+    instance's ``breaker``, if it has one.
+
+    Redis errors are logged and the method returns None, unless ``raises`` is
+    True; then they're re-raised, and a skipped write raises
+    ``CircuitOpenError``. A skipped call is passed to the instance's
+    ``_skipped(name, args, kwargs)``.
+
+    """
+    if method is None:
+        return functools.partial(protected, raises=raises)
+
+    name = method.__name__
+
+    def failed(self, start, error):
+        self.breaker.record(time.monotonic() - start, error)
+        if raises:
+            raise error
+        logger.warning("Failed to write metrics with %s: %s", name, error)
+
+    def skipped(self, args, kwargs):
+        if raises:
+            raise CircuitOpenError("Metric writes are paused")
+        self._skipped(name, args, kwargs)
+
+    if inspect.iscoroutinefunction(method):
+        @functools.wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            if self.breaker is None:
+                return await method(self, *args, **kwargs)
+            if not self.breaker.allow():
+                return skipped(self, args, kwargs)
+            start = time.monotonic()
+            try:
+                result = await method(self, *args, **kwargs)
+            except RedisError as e:
+                return failed(self, start, e)
+            except BaseException:
+                self.breaker.abandon()
+                raise
+            if self.breaker.record(time.monotonic() - start):
+                self._resumed()
+            return result
+    else:
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.breaker is None:
+                return method(self, *args, **kwargs)
+            if not self.breaker.allow():
+                return skipped(self, args, kwargs)
+            start = time.monotonic()
+            try:
+                result = method(self, *args, **kwargs)
+            except RedisError as e:
+                return failed(self, start, e)
+            except BaseException:
+                self.breaker.abandon()
+                raise
+            if self.breaker.record(time.monotonic() - start):
+                self._resumed()
+            return result
+    return wrapper
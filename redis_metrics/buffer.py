@@ -0,0 +1,170 @@
+"""
+An in-process, write-coalescing buffer for metrics.
+
+When ``settings.REDIS_METRICS['WRITE_MODE']`` is set to ``"buffered"``, calls
+to ``redis_metrics.utils.metric`` don't talk to Redis directly. Instead, each
+increment is summed in memory for every Redis key it would touch, and all of
+the pending increments are written using a single pipeline when:
+
+* the number of distinct keys reaches ``BUFFER_MAX_SIZE``, or
+* more than ``BUFFER_FLUSH_INTERVAL`` seconds have passed since the last flush
+  (this is checked whenever a new metric is recorded), or
+* ``BUFFER_FLUSH_INTERVAL`` seconds after the first metric of a burst was
+  buffered (a timer thread flushes it even if nothing else is recorded), or
+* the process exits.
+
+"""
+from __future__ import unicode_literals
+import logging
+import math
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from .keys import get_schema
+from .settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+
+class MetricBuffer(object):
+
+    def __init__(self, r, max_size=None, flush_interval=None):
+        """Creates a buffer that writes metrics using the given ``R`` instance.
+
+        * ``r`` -- an instance of ``redis_metrics.models.R``
+        * ``max_size`` -- The number of distinct keys to hold before flushing
+          (set in settings.REDIS_METRICS['BUFFER_MAX_SIZE'])
+        * ``flush_interval`` -- The max number of seconds between flushes (set
+          in settings.REDIS_METRICS['BUFFER_FLUSH_INTERVAL'])
+
+        """
+        self.r = r
+        if max_size is None:
+            max_size = app_settings.BUFFER_MAX_SIZE
+        if flush_interval is None:
+            flush_interval = app_settings.BUFFER_FLUSH_INTERVAL
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        self._timer = None  # Flushes the pending metrics if nothing else does
+        self._clear()
+
+        self.flushes = 0  # Number of pipelines sent to Redis
+        self.flushed = 0  # Number of metric() calls written to Redis
+        self.dropped = 0  # Number of metric() calls lost to Redis errors
+        self.last_flush_latency = 0.0  # Seconds taken by the latest flush
+        self.max_flush_latency = 0.0  # Slowest flush, in seconds
+
+    def _clear(self):
+        """Reset the pending data. Call while holding ``self._lock``."""
+        self._counts = {}  # {key: total increment}
+        self._expires = {}  # {key: seconds}
+        self._slugs = set()
+        self._categories = set()  # {(slug, category), ...}
+        self._pending = 0  # Number of metric() calls waiting to be written
+
+    def metric(self, slug, num=1, category=None, expire=None, date=None,
+               sample_rate=None):
+        """Buffers a metric. This accepts the same arguments as ``R.metric``,
+        and the metric gets written the next time the buffer is flushed."""
+        num = self.r._sample(slug, num, sample_rate)
+        if num is None:
+            return
+
+        keys = self.r._build_keys(slug, date=date)
+        expires = get_schema().expires(expire)
+        with self._lock:
+            self._slugs.add(slug)
+            if category:
+                self._categories.add((slug, category))
+            for key, ttl in zip(keys, expires):
+                self._counts[key] = self._counts.get(key, 0) + num
+                if ttl:
+                    self._expires[key] = ttl
+            self._pending += 1
+
+            elapsed = time.monotonic() - self._last_flush
+            full = len(self._counts) >= self.max_size
+            should_flush = full or elapsed >= self.flush_interval
+            if not should_flush:
+                self._start_timer()
+
+        if should_flush:
+            self.flush()
+
+    def _start_timer(self):
+        """Starts a timer to flush the buffer after ``flush_interval``
+        seconds, unless one is running (or the interval is infinite, as in
+        buffers that only flush by hand). Call while holding ``self._lock``."""
+        if not (math.isfinite(self.flush_interval) and self.flush_interval > 0):
+            return
+        timer = self._timer
+        if timer is not None and timer.is_alive():
+            return
+        self._timer = threading.Timer(self.flush_interval, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    @property
+    def depth(self):
+        """The number of distinct Redis keys waiting to be written."""
+        return len(self._counts)
+
+    def flush(self):
+        """Writes all of the pending metrics using a single pipeline, and
+        returns the number of ``metric()`` calls that were written.
+
+        If Redis fails, the pending data is discarded (and counted in
+        ``dropped``) rather than raised; recording metrics should never
+        break the code that records them.
+
+        """
+        with self._lock:
+            counts = self._counts
+            expires = self._expires
+            slugs = self._slugs
+            categories = self._categories
+            pending = self._pending
+            self._clear()
+            self._last_flush = time.monotonic()
+            timer, self._timer = self._timer, None
+
+        if timer is not None:
+            timer.cancel()  # Nothing left for it to flush
+
+        if pending == 0:
+            return 0
+
+        start = time.monotonic()
+        try:
+            self.r._write_counts(counts, slugs, categories, expires)
+        except RedisError:
+            logger.exception("Dropped %d buffered metrics", pending)
+            self.dropped += pending
+            return 0
+        finally:
+            self.last_flush_latency = time.monotonic() - start
+            self.max_flush_latency = max(
+                self.max_flush_latency,
+                self.last_flush_latency
+            )
+
+        self.flushes += 1
+        self.flushed += pending
+        return pending
+
+    def stats(self):
+        """Returns a dictionary of counters describing this buffer."""
+        return {
+            'depth': self.depth,
+            'pending': self._pending,
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
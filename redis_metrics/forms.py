@@ -1,6 +1,6 @@
 from __future__ import unicode_literals
 from django import forms
-from .models import R
+from .utils import get_r
 
 
 class AggregateMetricForm(forms.Form):
@@ -11,7 +11,7 @@ class AggregateMetricForm(forms.Form):
 
     def __init__(self, *args, **kwargs):
         super(AggregateMetricForm, self).__init__(*args, **kwargs)
-        r = R()
+        r = get_r()
         choices = [(slug, slug) for slug in r.metric_slugs()]
         self.fields['metrics'].choices = choices
 
@@ -35,7 +35,7 @@ class MetricCategoryForm(forms.Form):
 
         """
         super(MetricCategoryForm, self).__init__(*args, **kwargs)
-        self.r = R()  # Keep a connection to our Redis wrapper
+        self.r = get_r()  # Keep a connection to our Redis wrapper
         # The list of available choices should include all metrics
         choices = [(slug, slug) for slug in self.r.metric_slugs()]
         self.fields['metrics'].choices = choices
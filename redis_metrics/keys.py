@@ -0,0 +1,339 @@
+"""
+Builds the Redis keys used to store metrics.
+
+Key building happens on every write, so the work that only depends on
+settings (which granularities are enabled, the key pattern and date format for
+each one) is done once, in a ``KeySchema``. The schema is rebuilt whenever
+Django's ``setting_changed`` signal fires for one of this app's settings.
+
+"""
+from __future__ import unicode_literals
+from bisect import bisect_left
+from datetime import date, timedelta
+from functools import lru_cache
+
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+from django.template.defaultfilters import slugify
+
+from .settings import app_settings, AppSettings, GRANULARITIES
+
+
+# The Redis key and date formatting patterns for each granularity. The
+# weekly date format depends on the week settings; see ``KeySchema``.
+KEY_PATTERNS = {
+    "seconds": ("m:{0}:s:{1}", "%Y-%m-%d-%H-%M-%S"),
+    "minutes": ("m:{0}:i:{1}", "%Y-%m-%d-%H-%M"),
+    "hourly": ("m:{0}:h:{1}", "%Y-%m-%d-%H"),
+    "daily": ("m:{0}:{1}", "%Y-%m-%d"),
+    "weekly": ("m:{0}:w:{1}", None),
+    "monthly": ("m:{0}:m:{1}", "%Y-%m"),
+    "yearly": ("m:{0}:y:{1}", "%Y"),
+}
+
+# The parts of a datetime that don't affect the keys for each minimum
+# granularity; the day determines every period from "daily" up.
+TRUNCATIONS = {
+    "seconds": {"microsecond": 0},
+    "minutes": {"second": 0, "microsecond": 0},
+    "hourly": {"minute": 0, "second": 0, "microsecond": 0},
+    "daily": {"hour": 0, "minute": 0, "second": 0, "microsecond": 0},
+}
+
+
+# The length in seconds of the steps between the periods at the sub-daily
+# granularities; see ``KeySchema.range_periods``.
+STEP_SECONDS = {"seconds": 1, "minutes": 60, "hourly": 3600}
+
+# Zero-padded numbers for the parts of a period, to format them without
+# ``strftime``.
+TWO_DIGITS = tuple("{0:02d}".format(i) for i in range(100))
+
+
+class KeySchema(object):
+
+    def __init__(self, min_granularity="daily", max_granularity="yearly",
+                 monday_first_day_of_week=False, use_iso_week_number=False,
+                 slug_cache_size=1024, storage_layout="keys", retention=None,
+                 histogram_buckets=(), hash_tags=False):
+        """Compiles the key patterns for the given settings.
+
+        * ``min_granularity`` / ``max_granularity`` -- the range of
+          granularities for which keys are built.
+        * ``monday_first_day_of_week`` -- weeks start on Monday (%W) rather
+          than Sunday (%U).
+        * ``use_iso_week_number`` -- use ISO calendar weeks.
+        * ``slug_cache_size`` -- the number of normalized slugs to remember.
+        * ``storage_layout`` -- "keys" to store each value in its own Redis
+          string, or "hashes" to pack values into Redis hashes (see
+          ``hash_field``).
+        * ``retention`` -- a dict mapping granularities to the number of
+          seconds (or a ``timedelta``) for which their keys are kept.
+        * ``histogram_buckets`` -- the upper bounds of the buckets into which
+          timings are counted (see ``bucket``).
+        * ``hash_tags`` -- wrap slugs in a Redis Cluster hash tag, e.g.
+          ``m:{<slug>}:<yyyy-mm-dd>``, so all of a slug's keys are stored in
+          the same cluster slot (see ``tag``).
+
+        """
+        granularities = []
+        keep = False
+        for g in GRANULARITIES:
+            if g == min_granularity and not keep:
+                keep = True
+            elif g == max_granularity and keep:
+                keep = False
+                granularities.append(g)
+            if keep:
+                granularities.append(g)
+        self.granularities = tuple(granularities)
+
+        self.use_iso_week_number = use_iso_week_number
+        self.weekly_date_format = "%Y-%W" if monday_first_day_of_week else "%Y-%U"
+        self.hash_tags = hash_tags
+        self._key_patterns = dict(
+            (g, self.tag_pattern(pattern)) for g, (pattern, _) in KEY_PATTERNS.items()
+        )
+        self.key_patterns = tuple(self._key_patterns[g] for g in self.granularities)
+        self.hashed = storage_layout == "hashes"
+
+        # The TTL for each granularity's keys, or None to keep them forever.
+        retention = retention or {}
+        ttls = []
+        for g in self.granularities:
+            ttl = retention.get(g)
+            if isinstance(ttl, timedelta):
+                ttl = int(ttl.total_seconds())
+            ttls.append(ttl or None)
+        self.ttls = tuple(ttls)
+        self.buckets = tuple(sorted(histogram_buckets))
+        self.bucket_fields = tuple(str(b) for b in self.buckets) + ("+Inf",)
+        self._truncation = TRUNCATIONS.get(self.granularities[0], TRUNCATIONS["daily"])
+
+        # Slugs are normalized with Django's ``slugify``, which is relatively
+        # expensive; metrics tend to reuse the same slugs over and over.
+        self.slugify = lru_cache(maxsize=slug_cache_size)(slugify)
+
+        # The (datetime, periods) most recently formatted by ``periods``. All
+        # writes within the same second share the same period strings.
+        self._periods_cache = (None, None)
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            min_granularity=app_settings.MIN_GRANULARITY,
+            max_granularity=app_settings.MAX_GRANULARITY,
+            monday_first_day_of_week=app_settings.MONDAY_FIRST_DAY_OF_WEEK,
+            use_iso_week_number=app_settings.USE_ISO_WEEK_NUMBER,
+            slug_cache_size=app_settings.SLUG_CACHE_SIZE,
+            storage_layout=app_settings.STORAGE_LAYOUT,
+            retention=app_settings.RETENTION,
+            histogram_buckets=app_settings.HISTOGRAM_BUCKETS,
+            hash_tags=app_settings.HASH_TAG_KEYS,
+        )
+
+    def tag(self, slug):
+        """Returns ``slug`` as it appears in keys: wrapped in braces (a Redis
+        Cluster hash tag) when ``hash_tags`` is enabled, so only the slug is
+        hashed to pick a key's slot."""
+        if self.hash_tags:
+            return "{" + slug + "}"
+        return slug
+
+    def tag_pattern(self, pattern):
+        """Applies ``tag`` to the "{0}" slug placeholder in a key pattern."""
+        if self.hash_tags:
+            return pattern.replace("{0}", "{{{0}}}")
+        return pattern
+
+    def period(self, granularity, date):
+        """Formats the time period for ``date`` at the given granularity,
+        e.g. "2014-07-02" for the "daily" granularity."""
+        date_format = KEY_PATTERNS[granularity][1]
+        if date_format is None:  # weekly
+            if self.use_iso_week_number:
+                year, week_no = date.isocalendar()[:2]
+                return "{0}-{1}".format(year, week_no)
+            date_format = self.weekly_date_format
+        return date.strftime(date_format)
+
+    def periods(self, date):
+        """Returns a tuple of the time periods for ``date`` at every enabled
+        granularity, from smallest to largest."""
+        # Periods follow the wall time, so cache on that: aware datetimes for
+        # the same instant in different zones compare equal.
+        stamp = date.replace(microsecond=0, tzinfo=None)
+        cached_stamp, periods = self._periods_cache
+        if cached_stamp != stamp:
+            periods = tuple(self.period(g, date) for g in self.granularities)
+            self._periods_cache = (stamp, periods)
+        return periods
+
+    def range_periods(self, granularity, to, count):
+        """Returns the distinct periods at ``granularity`` covered by
+        ``count`` steps back from ``to``, where a step is a second, minute or
+        hour at those granularities, and a day otherwise (like
+        ``R._date_range``). The periods are sorted, as their keys would be.
+
+        Each period is worked out from the date's ordinal and time of day,
+        rather than formatted with ``strftime``, and the label of each day is
+        only built once.
+
+        """
+        if granularity not in self.granularities:
+            raise KeyError(granularity)
+        if count <= 0:
+            return []
+
+        if granularity in STEP_SECONDS:
+            step = STEP_SECONDS[granularity]
+            last = to.toordinal() * 86400 + to.hour * 3600 + to.minute * 60 + to.second
+            last -= last % step
+            days = {}
+            periods = []
+            for t in range(last - (count - 1) * step, last + 1, step):
+                ordinal, seconds = divmod(t, 86400)
+                day = days.get(ordinal)
+                if day is None:
+                    day = days[ordinal] = self._day_period(date.fromordinal(ordinal))
+                hour, seconds = divmod(seconds, 3600)
+                if step == 3600:
+                    periods.append("-".join((day, TWO_DIGITS[hour])))
+                elif step == 60:
+                    periods.append("-".join((
+                        day, TWO_DIGITS[hour], TWO_DIGITS[seconds // 60]
+                    )))
+                else:
+                    minute, second = divmod(seconds, 60)
+                    periods.append("-".join((
+                        day, TWO_DIGITS[hour], TWO_DIGITS[minute], TWO_DIGITS[second]
+                    )))
+            return periods
+
+        period = {
+            "daily": self._day_period,
+            "weekly": self._week_period,
+            "monthly": lambda d: "{0}-{1}".format(d.year, TWO_DIGITS[d.month]),
+            "yearly": lambda d: str(d.year),
+        }[granularity]
+        last = to.toordinal()
+        periods = []
+        for ordinal in range(last - count + 1, last + 1):
+            label = period(date.fromordinal(ordinal))
+            if not periods or periods[-1] != label:
+                periods.append(label)
+        if granularity == "weekly" and self.use_iso_week_number:
+            # ISO week numbers aren't zero-padded, so "2014-10" sorts before
+            # "2014-9".
+            periods.sort()
+        return periods
+
+    def _day_period(self, day):
+        """Formats a date's "daily" period, like ``period``."""
+        return "{0}-{1}-{2}".format(day.year, TWO_DIGITS[day.month], TWO_DIGITS[day.day])
+
+    def _week_period(self, day):
+        """Formats a date's "weekly" period, like ``period``."""
+        if self.use_iso_week_number:
+            year, week_no = day.isocalendar()[:2]
+            return "{0}-{1}".format(year, week_no)
+        # strftime's %U (weeks start on Sunday) and %W (on Monday) count the
+        # days before the year's first Sunday or Monday as week 0.
+        yday = day.toordinal() - date(day.year, 1, 1).toordinal()
+        weekday = day.weekday()  # Monday is 0
+        if self.weekly_date_format == "%Y-%U":
+            weekday = (weekday + 1) % 7
+        return "{0}-{1}".format(day.year, TWO_DIGITS[(yday + 7 - weekday) // 7])
+
+    def history_keys(self, slugs, granularity, periods):
+        """Yields the keys for each of ``slugs`` at each of ``periods`` (see
+        ``range_periods``), in sorted order and without duplicates. The key
+        patterns all end with the period, so each slug's prefix is only built
+        once."""
+        key_pattern = self._key_patterns[granularity]
+        prefixes = sorted(set(
+            key_pattern.format(self.slugify(slug), "") for slug in slugs
+        ))
+        for prefix in prefixes:
+            for period in periods:
+                yield prefix + period
+
+    def truncate(self, date):
+        """Drops the parts of ``date`` that don't affect its keys, so any two
+        dates that truncate to the same value have the same keys."""
+        return date.replace(**self._truncation)
+
+    def key(self, granularity, slug, date):
+        """Builds the key for an already-normalized ``slug``."""
+        key_pattern = self._key_patterns[granularity]
+        return key_pattern.format(slug, self.period(granularity, date))
+
+    def build_keys(self, slug, date, granularity="all"):
+        """Builds the list of keys for ``slug`` at ``date``. See
+        ``R._build_keys``."""
+        slug = self.slugify(slug)
+        if granularity == "all":
+            periods = self.periods(date)
+            return [
+                key_pattern.format(slug, period)
+                for key_pattern, period in zip(self.key_patterns, periods)
+            ]
+        if granularity not in self.granularities:
+            raise KeyError(granularity)
+        return [self.key(granularity, slug, date)]
+
+    def expires(self, expire=None):
+        """Returns the TTL for each of the keys returned by ``build_keys`` for
+        all granularities: ``expire`` for every key if it's given, otherwise
+        the configured retention for each one."""
+        if expire:
+            return (expire,) * len(self.granularities)
+        return self.ttls
+
+    def bucket(self, value):
+        """Returns the name of the histogram bucket that counts ``value``:
+        the smallest upper bound that's >= ``value``, or "+Inf"."""
+        return self.bucket_fields[bisect_left(self.buckets, value)]
+
+    def hash_field(self, key):
+        """Returns a ``(hash key, field)`` tuple locating a metric key's value
+        in the "hashes" storage layout.
+
+        Each value is stored in a hash that covers the next coarser period,
+        with the value's own period as the field, so:
+
+            m:<slug>:s:<yyyy-mm-dd-hh-mm-ss> -> m:<slug>:s:<yyyy-mm-dd-hh-mm>
+            m:<slug>:i:<yyyy-mm-dd-hh-mm>    -> m:<slug>:i:<yyyy-mm-dd-hh>
+            m:<slug>:h:<yyyy-mm-dd-hh>       -> m:<slug>:h:<yyyy-mm-dd>
+            m:<slug>:<yyyy-mm-dd>            -> m:<slug>:<yyyy-mm>
+            m:<slug>:w:<yyyy-num>            -> m:<slug>:w:<yyyy>
+            m:<slug>:m:<yyyy-mm>             -> m:<slug>:m:<yyyy>
+            m:<slug>:y:<yyyy>                -> m:<slug>:y:
+
+        No hash has more than 60 fields, so Redis keeps them all in its
+        compact small-hash encoding.
+
+        """
+        prefix, period = key.rsplit(":", 1)
+        container = period.rsplit("-", 1)[0] if "-" in period else ""
+        return "{0}:{1}".format(prefix, container), period
+
+
+_schema = None
+
+
+def get_schema():
+    """Returns the ``KeySchema`` for the current settings."""
+    global _schema
+    schema = _schema
+    if schema is None:
+        schema = _schema = KeySchema.from_settings()
+    return schema
+
+
+@receiver(setting_changed)
+def reset_schema(setting, **kwargs):
+    """Rebuild the schema when any of this app's settings change."""
+    global _schema
+    if setting.startswith("REDIS_METRICS") or setting in AppSettings._default_settings:
+        _schema = None
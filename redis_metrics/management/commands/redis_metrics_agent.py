@@ -0,0 +1,87 @@
+"""
+Runs a statsd-like agent that receives metrics over UDP and writes them to
+Redis. See ``redis_metrics.agent`` for the line format.
+
+Usage:
+
+    manage.py redis_metrics_agent [--host HOST] [--port PORT]
+        [--unix-socket PATH] [--flush-interval SECONDS]
+
+"""
+from __future__ import unicode_literals
+from django.core.management.base import BaseCommand, CommandError
+from redis_metrics.agent import Agent
+from redis_metrics.utils import get_r
+
+
+class Command(BaseCommand):
+    help = "Receives statsd-like metrics over UDP and writes them to Redis"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host',
+            default='127.0.0.1',
+            help='Address for the UDP socket (default: 127.0.0.1)'
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=8125,
+            help='Port for the UDP socket, or 0 to disable UDP (default: 8125)'
+        )
+        parser.add_argument(
+            '--unix-socket',
+            dest='unix_socket',
+            default=None,
+            help='Also listen on a Unix datagram socket at this path'
+        )
+        parser.add_argument(
+            '--flush-interval',
+            dest='flush_interval',
+            type=float,
+            default=10,
+            help='Seconds between writes to Redis (default: 10)'
+        )
+
+    def handle(self, *args, **options):
+        agent = Agent(
+            get_r(),
+            host=options['host'],
+            port=options['port'] or None,
+            unix_socket=options['unix_socket'],
+            flush_interval=options['flush_interval'],
+        )
+        if agent.port is None and not agent.unix_socket:
+            raise CommandError("Nothing to listen on; set --port or --unix-socket")
+
+        try:
+            agent.bind()
+        except OSError as e:
+            raise CommandError("Unable to bind: {0}".format(e))
+
+        verbosity = options.get('verbosity', 1)
+        if verbosity > 0:
+            listening = []
+            if agent.port is not None:
+                listening.append("udp://{0}:{1}".format(*agent.address))
+            if agent.unix_socket:
+                listening.append("unix://{0}".format(agent.unix_socket))
+            self.stdout.write("Listening on {0}".format(", ".join(listening)))
+
+        try:
+            # Report after every flush with -v 2, and once at exit otherwise.
+            agent.serve_forever(on_flush=self.report if verbosity > 1 else None)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            agent.close()
+        if verbosity > 0:
+            self.report(agent)
+
+    def report(self, agent):
+        self.stdout.write(
+            "packets={packets} lines={lines} parse_errors={parse_errors} "
+            "flushes={flushes} write_errors={write_errors} "
+            "last_flush={last_flush_duration:.4f}s "
+            "max_flush={max_flush_duration:.4f}s".format(**agent.stats())
+        )
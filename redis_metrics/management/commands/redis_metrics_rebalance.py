@@ -0,0 +1,67 @@
+"""
+Moves metrics data to the shards that own it, after servers were added to (or
+removed from) the SHARDS setting. See ``redis_metrics.sharding``.
+
+Usage:
+
+    manage.py redis_metrics_rebalance [--source URL ...] [--dry-run]
+        [--batch-size N]
+
+"""
+from __future__ import unicode_literals
+import redis
+
+from django.core.management.base import BaseCommand, CommandError
+from redis_metrics.sharding import ShardedR
+from redis_metrics.utils import get_r
+
+
+class Command(BaseCommand):
+    help = "Moves metrics data to the Redis shards that own it"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--source',
+            action='append',
+            default=[],
+            help=(
+                'URL of a Redis server that was removed from SHARDS, e.g. '
+                'redis://old-host:6379/0; all of its data is moved to the '
+                'shards. May be repeated.'
+            )
+        )
+        parser.add_argument(
+            '--dry-run',
+            dest='dry_run',
+            action='store_true',
+            help="Count the data that would be moved, but don't move it"
+        )
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=500,
+            help='Number of keys to fetch per SCAN (default: 500)'
+        )
+
+    def handle(self, *args, **options):
+        r = get_r()
+        if not isinstance(r, ShardedR):
+            raise CommandError("The SHARDS setting isn't configured")
+
+        sources = [
+            redis.StrictRedis.from_url(url, decode_responses=True)
+            for url in options['source']
+        ]
+        moved = r.rebalance(
+            sources=sources,
+            dry_run=options['dry_run'],
+            batch_size=options['batch_size'],
+        )
+        if options.get('verbosity', 1) > 0:
+            verb = "Would move" if options['dry_run'] else "Moved"
+            self.stdout.write(
+                "{0} {1} keys and {2} set members".format(
+                    verb, moved['keys'], moved['members']
+                )
+            )
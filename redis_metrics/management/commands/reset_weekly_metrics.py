@@ -3,7 +3,7 @@ import re
 
 from datetime import date
 from django.core.management.base import BaseCommand, CommandError
-from redis_metrics.utils import r
+from redis_metrics.utils import get_r
 
 
 class Command(BaseCommand):
@@ -36,7 +36,7 @@ class Command(BaseCommand):
         else:
             raise CommandError("Invalid arguments. Provide a 4-digit year.")
 
-        r = R()
+        r = get_r()
 
         # Retrieve all the metric keys of the form: "m:<slug>:w:<nn>"
         weekly_keys = filter(
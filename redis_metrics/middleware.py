@@ -0,0 +1,162 @@
+"""
+Middleware that records the throughput and latency of every view.
+
+Add it near the top of ``settings.MIDDLEWARE``, so the time it records
+includes the other middleware::
+
+    MIDDLEWARE = [
+        'redis_metrics.middleware.RequestMetricsMiddleware',
+        ...
+    ]
+
+For each request, it records the following, where ``<view>`` is the resolved
+URL's view name (e.g. ``view-blog-post-detail`` for "blog:post-detail"), with
+the ``REQUEST_METRICS_PREFIX`` setting in front of it:
+
+* ``<view>-requests`` -- a metric counting the requests
+* ``<view>-2xx`` (or ``-3xx``, ``-4xx``, ``-5xx``) -- a metric counting the
+  responses with each class of status code
+* ``<view>-response-time`` -- a timer with the response times in milliseconds
+* ``<view>-db-queries`` -- a metric counting the database queries made while
+  handling the requests (unless ``REQUEST_METRICS_COUNT_QUERIES`` is False);
+  divide it by ``<view>-requests`` for the average per request.
+
+Requests that don't resolve to a view are recorded as ``unresolved``.
+
+Nothing is written to Redis while a request is handled: the numbers are added
+to the process's ``CallRecorder`` (see ``redis_metrics.recorder``), which
+writes everything recorded by all requests in one pipeline every
+``BUFFER_FLUSH_INTERVAL`` seconds. The middleware works in both sync (WSGI)
+and async (ASGI) stacks. In an async stack, the ORM's queries run in other
+threads (through ``sync_to_async``), so each connection counts its queries
+for whichever request's context it runs in (see ``count_query``).
+
+"""
+from __future__ import unicode_literals
+from contextlib import ExitStack
+from contextvars import ContextVar
+import logging
+import time
+
+from django.db import connections
+from django.db.backends.signals import connection_created
+
+from .settings import app_settings
+from .utils import get_recorder
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError:  # asgiref < 3.6
+    from asyncio import iscoroutinefunction
+    markcoroutinefunction = None
+
+logger = logging.getLogger(__name__)
+
+
+class QueryCounter(object):
+    """A database execute wrapper (see Django's ``execute_wrapper``) that
+    counts queries."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+# The ``QueryCounter`` for the request being handled in an async stack; it's
+# copied into the threads that ``sync_to_async`` runs the ORM in.
+current_counter = ContextVar("redis_metrics_query_counter", default=None)
+
+
+def count_query(execute, sql, params, many, context):
+    """A database execute wrapper that counts queries with the
+    ``current_counter``, if there is one."""
+    counter = current_counter.get()
+    if counter is not None:
+        counter.count += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(connection, **kwargs):
+    """Adds ``count_query`` to a connection's execute wrappers, for good.
+    Connected to ``connection_created``, so connections opened in any
+    thread count their queries."""
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
+
+
+class RequestMetricsMiddleware(object):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode and markcoroutinefunction is not None:
+            # Tell Django to call this middleware asynchronously.
+            markcoroutinefunction(self)
+        self.prefix = app_settings.REQUEST_METRICS_PREFIX
+        self.count_queries = app_settings.REQUEST_METRICS_COUNT_QUERIES
+        if self.async_mode and self.count_queries:
+            connection_created.connect(
+                install_query_counter, dispatch_uid="redis_metrics_query_counter"
+            )
+            for connection in connections.all():
+                install_query_counter(connection)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        start = time.perf_counter()
+        with ExitStack() as stack:
+            counter = self._count_queries(stack)
+            response = self.get_response(request)
+        self._record(request, response, time.perf_counter() - start, counter)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter()
+        counter = QueryCounter() if self.count_queries else None
+        token = current_counter.set(counter)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_counter.reset(token)
+        self._record(request, response, time.perf_counter() - start, counter)
+        return response
+
+    def _count_queries(self, stack):
+        """Installs a ``QueryCounter`` on every database connection until
+        ``stack`` is closed, and returns it (or None when queries aren't
+        counted)."""
+        if not self.count_queries:
+            return None
+        counter = QueryCounter()
+        for connection in connections.all():
+            stack.enter_context(connection.execute_wrapper(counter))
+        return counter
+
+    def _view_name(self, request):
+        """Returns the name under which a request is recorded."""
+        match = getattr(request, "resolver_match", None)
+        if match is None:
+            return "unresolved"
+        # Slugs can't contain the ":" of a namespaced URL name, or the dots
+        # in the dotted path used for views without a URL name.
+        return match.view_name.replace(":", "-").replace(".", "-")
+
+    def _record(self, request, response, elapsed, counter):
+        """Adds a request's numbers to the ``CallRecorder``. Errors are
+        logged, since recording metrics should never break a request."""
+        try:
+            slug = self.prefix + self._view_name(request)
+            recorder = get_recorder()
+            recorder.count(slug + "-requests")
+            recorder.count("{0}-{1}xx".format(slug, response.status_code // 100))
+            recorder.timing(slug + "-response-time", elapsed * 1000)
+            if counter is not None and counter.count:
+                recorder.count(slug + "-db-queries", counter.count)
+        except Exception:
+            logger.exception("Couldn't record metrics for %s", request.path)
@@ -4,16 +4,44 @@ lightweight wrapper around Redis.
 
 """
 from __future__ import unicode_literals
+import math
+import random
 import redis
+import time
 
 from importlib import import_module
 from collections import OrderedDict
+from collections.abc import Mapping
 from datetime import datetime, timedelta
-from django.template.defaultfilters import slugify
 
+from django.core.exceptions import ImproperlyConfigured
+
+from . import scripts
+from .breaker import CircuitBreaker, protected
+from .buffer import MetricBuffer
+from .keys import get_schema
+from .registry import SlugRegistry
+from .replicas import ReplicaPool
 from .settings import app_settings, GRANULARITIES
 from .templatetags import redis_metrics_filters as template_tags
 
+try:
+    import numpy
+except ImportError:
+    numpy = None  # NOQA
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def _timestamp(date):
+    """Converts a ``datetime`` to seconds since the epoch. Naive datetimes are
+    taken to be in UTC; aware ones (e.g. Django's ``timezone.now()`` with
+    USE_TZ) are converted."""
+    if date.tzinfo is not None and date.utcoffset() is not None:
+        return date.timestamp()
+    return (date - EPOCH).total_seconds()
+
 
 def dedupe(items):
     """Remove duplicates from a sequence (of hashable items) while maintaining
@@ -43,6 +71,10 @@ class R(object):
           (default is "metric-slugs")
         * ``gauge_slugs_key`` -- The key storing a set of all slugs for gauges
           (default is "gauge-slugs")
+        * ``timer_slugs_key`` -- The key storing a set of all slugs for timers
+          (default is "timer-slugs")
+        * ``unique_slugs_key`` -- The key storing a set of all slugs for
+          unique-count metrics (default is "unique-slugs")
         * ``connection_class`` -- class to use to obtain a Redis connection (set in settings.REDIS_METRICS['CONNECTION_CLASS'])
         * ``host`` -- Redis host (set in settings.REDIS_METRICS['HOST'])
         * ``port`` -- Redis port (set in settings.REDIS_METRICS['PORT'])
@@ -53,44 +85,420 @@ class R(object):
           settings.REDIS_METRICS['SOCKET_TIMEOUT'])
         * ``connection_pool`` -- Redis connection pool info. (set in
           settings.REDIS_METRICS['SOCKET_CONNECTION_POOL'])
+        * ``cluster`` -- Connect to a Redis Cluster, using ``host`` and
+          ``port`` to discover its nodes (set in
+          settings.REDIS_METRICS['CLUSTER']). This requires the HASH_TAG_KEYS
+          setting, or ImproperlyConfigured is raised.
+        * ``read_replicas`` -- a list of dicts describing Redis replicas to
+          read from (set in settings.REDIS_METRICS['READ_REPLICAS'])
 
         """
         self._categories_key = kwargs.get('categories_key', 'categories')
         self._metric_slugs_key = kwargs.get('metric_slugs_key', 'metric-slugs')
         self._gauge_slugs_key = kwargs.get('gauge_slugs_key', 'gauge-slugs')
+        self._timer_slugs_key = kwargs.get('timer_slugs_key', 'timer-slugs')
+        self._unique_slugs_key = kwargs.get('unique_slugs_key', 'unique-slugs')
+        self._scripts = {}  # Registered Lua scripts, keyed by their source
+        self._known_slugs = SlugRegistry(ttl=app_settings.KNOWN_SLUGS_TTL)
 
         self.connection_class = kwargs.pop('connection_class', app_settings.CONNECTION_CLASS)
+        self.cluster = kwargs.pop('cluster', app_settings.CLUSTER)
+        if self.cluster and not app_settings.HASH_TAG_KEYS:
+            # GAUGE_STATS and get_unique_count use several of a slug's keys
+            # in one command, so they must be in the same slot.
+            raise ImproperlyConfigured("CLUSTER requires HASH_TAG_KEYS")
+        read_replicas = kwargs.pop('read_replicas', app_settings.READ_REPLICAS)
+
+        self.r = self._connect(**kwargs)
+        self._replicas = self._connect_replicas(read_replicas)
+        self._last_write = float('-inf')  # When this instance last wrote
+
+        self.breaker = None
+        self._spool = None  # Metrics held while the circuit is open
+        if app_settings.CIRCUIT_BREAKER:
+            self.breaker = CircuitBreaker(
+                failures=app_settings.BREAKER_FAILURES,
+                reset_timeout=app_settings.BREAKER_RESET_TIMEOUT,
+                budget=app_settings.WRITE_TIMEOUT,
+            )
+            self._spool = self._make_spool()
 
+    def _connect(self, **kwargs):
+        """Creates the Redis client from the connection settings, or the
+        keyword arguments described in ``__init__``."""
         if self.connection_class:
             package, module = self.connection_class.rsplit('.', 1)
-            self.r = getattr(import_module(package), module)()
-        else:
-            self.host = kwargs.pop('host', app_settings.HOST)
-            self.port = kwargs.pop('port', app_settings.PORT)
-            self.db = kwargs.pop('db', app_settings.DB)
-            self.password = kwargs.pop('password', app_settings.PASSWORD)
-            self.ssl = kwargs.pop('ssl', app_settings.SSL)
-            self.socket_timeout = kwargs.pop(
-                'socket_timeout',
-                app_settings.SOCKET_TIMEOUT
-            )
-            self.connection_pool = kwargs.pop(
-                'connection_pool',
-                app_settings.SOCKET_CONNECTION_POOL
+            return getattr(import_module(package), module)()
+
+        self.host = kwargs.pop('host', app_settings.HOST)
+        self.port = kwargs.pop('port', app_settings.PORT)
+        self.db = kwargs.pop('db', app_settings.DB)
+        self.password = kwargs.pop('password', app_settings.PASSWORD)
+        self.ssl = kwargs.pop('ssl', app_settings.SSL)
+        self.socket_timeout = kwargs.pop(
+            'socket_timeout',
+            app_settings.SOCKET_TIMEOUT
+        )
+        if self.socket_timeout is None and app_settings.CIRCUIT_BREAKER:
+            # Keep any one command within the write latency budget.
+            self.socket_timeout = app_settings.WRITE_TIMEOUT
+        self.connection_pool = kwargs.pop(
+            'connection_pool',
+            app_settings.SOCKET_CONNECTION_POOL
+        )
+
+        if self.cluster:
+            # Cluster clients find the other nodes from the first one, and
+            # have no databases or shared connection pool.
+            return self._cluster_class()(
+                host=self.host,
+                port=self.port,
+                password=self.password,
+                ssl=self.ssl,
+                socket_timeout=self.socket_timeout,
+                decode_responses=True
             )
 
-            # Create the connection to Redis
-            self.r = redis.StrictRedis(
+        if self.connection_pool is None:
+            self.connection_pool = self._connection_pool(
                 host=self.host,
                 port=self.port,
                 db=self.db,
                 password=self.password,
                 ssl=self.ssl,
                 socket_timeout=self.socket_timeout,
-                connection_pool=self.connection_pool,
-                decode_responses=True
             )
 
+        # Create the connection to Redis
+        return self._redis_class()(
+            host=self.host,
+            port=self.port,
+            db=self.db,
+            password=self.password,
+            ssl=self.ssl,
+            socket_timeout=self.socket_timeout,
+            connection_pool=self.connection_pool,
+            decode_responses=True
+        )
+
+    def _connection_pool(self, ssl=False, **kwargs):
+        """Returns a connection pool for the MAX_CONNECTIONS and
+        BLOCKING_POOL settings, or None to let redis-py create its own.
+
+        A ``BlockingConnectionPool`` makes a thread wait up to POOL_TIMEOUT
+        seconds for a free connection once MAX_CONNECTIONS (default 50) are
+        in use, instead of failing.
+
+        """
+        max_connections = app_settings.MAX_CONNECTIONS
+        blocking = app_settings.BLOCKING_POOL
+        if not (max_connections or blocking):
+            return None
+        module = self._redis_module()
+        if ssl:
+            kwargs['connection_class'] = module.SSLConnection
+        if blocking:
+            return module.BlockingConnectionPool(
+                max_connections=max_connections or 50,
+                timeout=app_settings.POOL_TIMEOUT,
+                decode_responses=True,
+                **kwargs
+            )
+        return module.ConnectionPool(
+            max_connections=max_connections,
+            decode_responses=True,
+            **kwargs
+        )
+
+    def _connect_replicas(self, replicas):
+        """Returns a ``ReplicaPool`` for a list of replicas, each a dict with
+        any of the HOST, PORT, DB, PASSWORD, SSL and SOCKET_TIMEOUT keys
+        (missing keys fall back to the settings), or None if there are none.
+        A cluster reads from its own replicas, so it has no pool."""
+        if not replicas or self.cluster:
+            return None
+        clients = []
+        for replica in replicas:
+            options = dict(
+                host=replica.get('HOST', app_settings.HOST),
+                port=replica.get('PORT', app_settings.PORT),
+                db=replica.get('DB', app_settings.DB),
+                password=replica.get('PASSWORD', app_settings.PASSWORD),
+                ssl=replica.get('SSL', app_settings.SSL),
+                socket_timeout=replica.get(
+                    'SOCKET_TIMEOUT',
+                    app_settings.SOCKET_TIMEOUT
+                ),
+            )
+            clients.append(self._redis_class()(
+                connection_pool=self._connection_pool(**options),
+                decode_responses=True,
+                **options
+            ))
+        return ReplicaPool(self.r, clients, app_settings.READ_REPLICA_SELECTION)
+
+    def _reader(self):
+        """Returns the Redis client to read from: a read replica (see
+        ``redis_metrics.replicas``), or the primary if there aren't any, or if
+        this instance wrote to it less than READ_YOUR_WRITES seconds ago."""
+        if self._replicas is None:
+            return self.r
+        window = app_settings.READ_YOUR_WRITES
+        if window and time.monotonic() - self._last_write < window:
+            return self.r
+        return self._replicas.client()
+
+    def _wrote(self):
+        """Notes that this instance just wrote to the primary."""
+        self._last_write = time.monotonic()
+
+    def _make_spool(self):
+        """Returns a ``MetricBuffer`` to hold metrics while the circuit is
+        open, or None if BREAKER_SPOOL_SIZE is 0."""
+        if not app_settings.BREAKER_SPOOL_SIZE:
+            return None
+        return MetricBuffer(
+            self,
+            max_size=float('inf'),
+            flush_interval=float('inf')
+        )
+
+    def _skipped(self, name, args, kwargs):
+        """Called with a write that the circuit breaker skipped. Calls to
+        ``metric`` are spooled, while there are fewer than BREAKER_SPOOL_SIZE
+        keys waiting; everything else is dropped."""
+        spool = self._spool
+        if name == 'metric' and spool is not None:
+            if spool.depth < app_settings.BREAKER_SPOOL_SIZE:
+                spool.metric(*args, **kwargs)
+
+    def _resumed(self):
+        """Called when the circuit closes, to write the spooled metrics."""
+        if self._spool is not None:
+            self._spool.flush()
+
+    def circuit_stats(self):
+        """Returns a dictionary describing the circuit breaker (see
+        ``redis_metrics.breaker``), or None if CIRCUIT_BREAKER is disabled."""
+        if self.breaker is None:
+            return None
+        stats = self.breaker.stats()
+        spool = self._spool
+        stats['spooled'] = spool.depth if spool is not None else 0
+        stats['spool_dropped'] = spool.dropped if spool is not None else 0
+        return stats
+
+    def _redis_module(self):
+        """The module holding the connection pool classes."""
+        return redis
+
+    def _redis_class(self):
+        """The Redis client class used when there's no CONNECTION_CLASS."""
+        return redis.StrictRedis
+
+    def _cluster_class(self):
+        """The Redis client class used when CLUSTER is enabled."""
+        return redis.cluster.RedisCluster
+
+    def _script(self, source):
+        """Returns a Lua script from ``redis_metrics.scripts``. The script is
+        registered the first time it's used, and subsequently run with EVALSHA
+        (redis-py reloads it if it's missing from Redis's script cache)."""
+        script = self._scripts.get(source)
+        if script is None:
+            script = self.r.register_script(source)
+            self._scripts[source] = script
+        return script
+
+    def _run_script(self, source, keys, args):
+        """Runs a Lua script from ``redis_metrics.scripts``."""
+        if self.cluster:
+            return self.r.eval(source, len(keys), *(list(keys) + list(args)))
+        return self._script(source)(keys=keys, args=args)
+
+    def _queue_script(self, pipe, source, keys, args):
+        """Queues a Lua script from ``redis_metrics.scripts`` on ``pipe``.
+
+        Cluster pipelines can't load scripts into each node's script cache,
+        so in a cluster the script is sent with EVAL; all of its ``keys``
+        must be in the same slot (see the HASH_TAG_KEYS setting).
+
+        """
+        if self.cluster:
+            pipe.execute_command("EVAL", source, len(keys), *(list(keys) + list(args)))
+            return
+        self._script(source)(keys=keys, args=args, client=pipe)
+
+    def _use_scripts(self):
+        """Whether to write metrics with the METRIC and SET_METRIC scripts.
+        They write to the slug and category sets as well as the metric's own
+        keys, which can't be done by one script in a cluster, so
+        USE_LUA_SCRIPTS is ignored when CLUSTER is enabled."""
+        return app_settings.USE_LUA_SCRIPTS and not self.cluster
+
+    def _scan_keys(self, pattern):
+        """Returns the keys matching a glob-style ``pattern``. In a cluster,
+        this scans every primary node, since KEYS only searches one."""
+        if self.cluster:
+            return list(self.r.scan_iter(match=pattern))
+        return self.r.keys(pattern)
+
+    def _queue_delete(self, pipe, keys):
+        """Queues the deletion of ``keys`` on ``pipe``. A cluster pipeline
+        can't send a multi-key DEL for keys in different slots, so each key is
+        deleted on its own."""
+        if self.cluster:
+            for key in keys:
+                pipe.delete(key)
+        elif keys:
+            pipe.delete(*keys)
+
+    def _write_script_params(self, slug, category, keys, value, expires):
+        """Returns the KEYS and ARGV for the METRIC and SET_METRIC scripts;
+        ``expires`` holds the TTL for each key (see ``KeySchema.expires``)."""
+        schema = get_schema()
+        fields = []
+        if schema.hashed:
+            keys, fields = zip(*[schema.hash_field(k) for k in keys])
+
+        script_keys = [
+            self._metric_slugs_key,
+            self._categories_key,
+            self._category_key(category or ''),
+        ]
+        script_keys.extend(keys)
+        args = [slug, category or '', value]
+        args.extend(ttl or 0 for ttl in expires)
+        args.extend(fields)
+        return script_keys, args
+
+    def _incr(self, client, key, num):
+        """Increments the value for a metric key using ``client`` (a Redis
+        client or pipeline) in the configured STORAGE_LAYOUT. Returns the name
+        of the Redis key that holds the value."""
+        schema = get_schema()
+        if schema.hashed:
+            name, field = schema.hash_field(key)
+            client.hincrby(name, field, num)
+            return name
+        client.incr(key, num)
+        return key
+
+    def _unregistered(self, key, members):
+        """Returns the ``members`` that still need to be added to the set at
+        ``key``; when CACHE_KNOWN_SLUGS is enabled, that's only the ones this
+        process hasn't already added (see ``redis_metrics.registry``)."""
+        if not app_settings.CACHE_KNOWN_SLUGS:
+            return list(members)
+        return self._known_slugs.unknown(key, members)
+
+    def _registered(self, pending):
+        """Remembers a list of ``(key, members)`` that were just added."""
+        if app_settings.CACHE_KNOWN_SLUGS:
+            for key, members in pending:
+                self._known_slugs.add(key, members)
+
+    def _sadd_once(self, key, *members):
+        """Adds ``members`` to the set at ``key``, unless they're known to
+        have been added already."""
+        members = self._unregistered(key, members)
+        if members:
+            self.r.sadd(key, *members)
+            self._registered([(key, members)])
+
+    def _queue_sadd_once(self, pipe, pending, key, *members):
+        """Like ``_sadd_once``, but queues the SADD on ``pipe``. The members
+        are appended to the ``pending`` list, which should be passed to
+        ``_registered`` once the pipeline has been executed."""
+        members = self._unregistered(key, members)
+        if members:
+            pipe.sadd(key, *members)
+            pending.append((key, members))
+
+    @protected(raises=True)
+    def _write_counts(self, counts, slugs, categories, expires=None,
+                      histograms=()):
+        """Increments many metric keys using a single, non-transactional
+        pipeline.
+
+        * ``counts`` -- a dict of {metric key: increment}
+        * ``slugs`` -- the metric slugs being recorded
+        * ``categories`` -- a collection of (slug, category) tuples
+        * ``expires`` -- (optional) a dict of {metric key: seconds}
+        * ``histograms`` -- (optional) already-bucketed timings to add in the
+          same pipeline, as ``(slug, buckets, count, total, date)`` tuples
+          (see ``_queue_histogram``)
+
+        """
+        self._wrote()
+        pipe = self.r.pipeline(transaction=False)
+        pending = []
+        self._queue_counts(pipe, pending, counts, slugs, categories, expires)
+        for histogram in histograms:
+            pending += self._queue_histogram(pipe, *histogram)
+        pipe.execute()
+        self._registered(pending)
+
+    def _queue_counts(self, pipe, pending, counts, slugs, categories,
+                      expires=None):
+        """Queues the commands for ``_write_counts`` on ``pipe``, appending
+        the registered slugs to ``pending`` (see ``_queue_sadd_once``)."""
+        if slugs:
+            self._queue_sadd_once(pipe, pending, self._metric_slugs_key, *slugs)
+        for slug, category in categories:
+            self._queue_sadd_once(pipe, pending, self._category_key(category), slug)
+            self._queue_sadd_once(pipe, pending, self._categories_key, category)
+        for key, num in counts.items():
+            name = self._incr(pipe, key, num)
+            if expires and key in expires:
+                pipe.expire(name, expires[key])
+
+    def _mget(self, keys):
+        """Returns the values for a list of metric keys, in the configured
+        STORAGE_LAYOUT, in one round trip. More than MGET_CHUNK_SIZE keys are
+        read with several MGETs in a single pipeline. In the "hashes" layout,
+        this sends one HMGET per hash in a single pipeline. In a cluster, the
+        keys are grouped by slot, and the MGETs for each slot are sent to
+        their nodes concurrently."""
+        if not keys:
+            return []
+        reader = self._reader()
+        if not get_schema().hashed:
+            if self.cluster:
+                return reader.mget_nonatomic(keys)
+            chunk_size = app_settings.MGET_CHUNK_SIZE
+            if len(keys) <= chunk_size:
+                return reader.mget(keys)
+            pipe = reader.pipeline(transaction=False)
+            for i in range(0, len(keys), chunk_size):
+                pipe.mget(keys[i:i + chunk_size])
+            return [value for values in pipe.execute() for value in values]
+
+        locations, fields = self._hash_fields(keys)
+        pipe = reader.pipeline(transaction=False)
+        for name, hash_fields in fields.items():
+            pipe.hmget(name, hash_fields)
+        return self._hash_values(locations, fields, pipe.execute())
+
+    def _hash_fields(self, keys):
+        """Locates a list of metric keys in the "hashes" storage layout.
+        Returns a list of ``(hash key, field)`` tuples for each key, and an
+        OrderedDict of the fields to read from each hash."""
+        schema = get_schema()
+        locations = [schema.hash_field(k) for k in keys]
+        fields = OrderedDict()  # {hash key: [field, ...]}
+        for name, field in locations:
+            fields.setdefault(name, []).append(field)
+        return locations, fields
+
+    def _hash_values(self, locations, fields, results):
+        """Maps the results of HMGET-ing ``fields`` (see ``_hash_fields``)
+        back to a list of values, in the same order as ``locations``."""
+        values = {}
+        for (name, hash_fields), result in zip(fields.items(), results):
+            values[name] = dict(zip(hash_fields, result))
+        return [values[name][field] for name, field in locations]
+
     def _date_range(self, granularity, since, to=None):
         """Returns a generator that yields ``datetime.datetime`` objects from
         the ``since`` date until ``to`` (default: *now*).
@@ -120,6 +528,13 @@ class R(object):
         objects that differ by 1 second each.
 
         """
+        to, unit, units = self._date_range_units(granularity, since, to)
+        return (to - timedelta(**{unit: u}) for u in range(units))
+
+    def _date_range_units(self, granularity, since, to=None):
+        """Returns ``to`` (default: *now*), the name of the ``timedelta`` unit
+        between the dates yielded by ``_date_range``, and how many of them it
+        yields."""
         if since is None:
             since = datetime.utcnow() - timedelta(days=7)  # Default to 7 days
 
@@ -144,12 +559,12 @@ class R(object):
             granularity = "days"
             units = elapsed.days + 1
 
-        return (to - timedelta(**{granularity: u}) for u in range(int(units)))
+        return to, granularity, int(units)
 
     def categories(self):
         """Returns a set of Categories under which metrics may have been
         organized."""
-        return self.r.smembers(self._categories_key)
+        return self._reader().smembers(self._categories_key)
 
     def _category_key(self, category):
         return u"c:{0}".format(category)
@@ -157,7 +572,7 @@ class R(object):
     def _category_slugs(self, category):
         """Returns a set of the metric slugs for the given category"""
         key = self._category_key(category)
-        slugs = self.r.smembers(key)
+        slugs = self._reader().smembers(key)
         return slugs
 
     def _categorize(self, slug, category):
@@ -172,58 +587,22 @@ class R(object):
 
         """
         key = self._category_key(category)
-        self.r.sadd(key, slug)
+        self._sadd_once(key, slug)
 
         # Store all category names in a Redis set, for easy retrieval
-        self.r.sadd(self._categories_key, category)
+        self._sadd_once(self._categories_key, category)
 
     def _granularities(self):
-        """Returns a generator of all possible granularities based on the
+        """Returns an iterator of all possible granularities based on the
         MIN_GRANULARITY and MAX_GRANULARITY settings.
         """
-        keep = False
-        for g in GRANULARITIES:
-            if g == app_settings.MIN_GRANULARITY and not keep:
-                keep = True
-            elif g == app_settings.MAX_GRANULARITY and keep:
-                keep = False
-                yield g
-            if keep:
-                yield g
+        return iter(get_schema().granularities)
 
     def _get_metric_key_pattern(self, granularity, slug, date):
-        """ The Redis metric key and date formatting patterns for each key, by granularity"""
-        patterns_by_granularity = {
-            "seconds": {"key": "m:{0}:s:{1}", "date_format": "%Y-%m-%d-%H-%M-%S"},
-            "minutes": {"key": "m:{0}:i:{1}", "date_format": "%Y-%m-%d-%H-%M"},
-            "hourly": {"key": "m:{0}:h:{1}", "date_format": "%Y-%m-%d-%H"},
-            "daily": {"key": "m:{0}:{1}", "date_format": "%Y-%m-%d"},
-            "weekly": {
-                "key": "m:{0}:w:{1}",
-                "date_format": self._get_weekly_date_format(date),
-            },
-            "monthly": {"key": "m:{0}:m:{1}", "date_format": "%Y-%m"},
-            "yearly": {"key": "m:{0}:y:{1}", "date_format": "%Y"},
-        }
-        pattern_for_granularity = patterns_by_granularity[granularity]
-        fmt = pattern_for_granularity["date_format"]
-        date_string = date.strftime(fmt)
-        return pattern_for_granularity["key"].format(slug, date_string)
-
-    def _get_weekly_date_format(self, date):
-        if app_settings.USE_ISO_WEEK_NUMBER:
-            # We can return instantly because ISO week start on monday
-            return "{year}-{week_no}".format(year=date.isocalendar()[0], week_no=date.isocalendar()[1])
-        return "%Y-%{0}".format('W' if app_settings.MONDAY_FIRST_DAY_OF_WEEK else 'U')
-
-    def _build_key_patterns(self, slug, date):
-        """Builds an OrderedDict of metric keys and patterns for the given slug
-        and date."""
-        # we want to keep the order, from smallest to largest granularity
-        patts = OrderedDict()
-        for g in self._granularities():
-            patts[g] = self._get_metric_key_pattern(g, slug, date)
-        return patts
+        """Builds the Redis metric key for the given granularity, slug and
+        date. See ``redis_metrics.keys.KEY_PATTERNS`` for the key and date
+        formatting patterns used at each granularity."""
+        return get_schema().key(granularity, slug, date)
 
     def _build_keys(self, slug, date=None, granularity='all'):
         """Builds redis keys used to store metrics.
@@ -237,19 +616,18 @@ class R(object):
 
         Returns a list of strings.
 
+        Slugs are normalized with Django's ``slugify`` to ensure they have a
+        consistent format.
+
         """
-        slug = slugify(slug)  # Ensure slugs have a consistent format
         if date is None:
             date = datetime.utcnow()
-        patts = self._build_key_patterns(slug, date)
-        if granularity == "all":
-            return list(patts.values())
-        return [patts[granularity]]
+        return get_schema().build_keys(slug, date, granularity)
 
     def metric_slugs(self):
         """Return a set of metric slugs (i.e. those used to create Redis keys)
         for this app."""
-        return self.r.smembers(self._metric_slugs_key)
+        return self._reader().smembers(self._metric_slugs_key)
 
     def metric_slugs_by_category(self):
         """Return a dictionary of metrics data indexed by category:
@@ -258,17 +636,22 @@ class R(object):
 
         """
         result = OrderedDict()
-        categories = sorted(self.r.smembers(self._categories_key))
+        categories = sorted(self._reader().smembers(self._categories_key))
         for category in categories:
             result[category] = self._category_slugs(category)
+        return self._add_uncategorized(result, self.metric_slugs())
 
+    def _add_uncategorized(self, result, metric_slugs):
+        """Adds an "Uncategorized" entry to the ``result`` of
+        ``metric_slugs_by_category`` for any of the ``metric_slugs`` that
+        aren't in a category."""
         # We also need to see the uncategorized metric slugs, so need some way
         # to check which slugs are not already stored.
         categorized_metrics = set([  # Flatten the list of metrics
             slug for sublist in result.values() for slug in sublist
         ])
         f = lambda slug: slug not in categorized_metrics
-        uncategorized = list(set(filter(f, self.metric_slugs())))
+        uncategorized = list(set(filter(f, metric_slugs)))
         if len(uncategorized) > 0:
             result['Uncategorized'] = uncategorized
         return result
@@ -279,13 +662,16 @@ class R(object):
         # To remove all keys for a slug, I need to retrieve them all from
         # the set of metric keys, This uses the redis "keys" command, which is
         # inefficient, but this shouldn't be used all that often.
-        prefix = "m:{0}:*".format(slug)
-        keys = self.r.keys(prefix)
+        self._wrote()
+        prefix = "m:{0}:*".format(get_schema().tag(slug))
+        keys = self._scan_keys(prefix)
         self.r.delete(*keys)  # Remove the metric data
 
         # Finally, remove the slug from the set
         self.r.srem(self._metric_slugs_key, slug)
+        self._known_slugs.discard(self._metric_slugs_key, slug)
 
+    @protected
     def set_metric(self, slug, value, category=None, expire=None, date=None):
         """Assigns a specific value to the *current* metric. You can use this
         to start a metric at a value greater than 0 or to reset a metric.
@@ -300,7 +686,8 @@ class R(object):
         * ``value`` -- The value of the metric.
         * ``category`` -- (optional) Assign the metric to a Category (a string)
         * ``expire`` -- (optional) Specify the number of seconds in which the
-          metric will expire.
+          metric will expire. By default, each key expires according to
+          settings.REDIS_METRICS['RETENTION'] for its granularity.
         * ``date`` -- (optional) Specify the timestamp for the metric; default
           used to build the keys will be the current date and time in UTC form.
 
@@ -314,28 +701,93 @@ class R(object):
             m:<slug>:m:<yyyy-mm>             # Month
             m:<slug>:y:<yyyy>                # Year
 
+        If ``settings.REDIS_METRICS['USE_LUA_SCRIPTS']`` is True, all of this
+        happens atomically, in a single round trip to Redis.
+
         """
+        self._wrote()
         keys = self._build_keys(slug, date=date)
+        schema = get_schema()
+        expires = schema.expires(expire)
 
-        # Add the slug to the set of metric slugs
-        self.r.sadd(self._metric_slugs_key, slug)
+        if self._use_scripts():
+            script_keys, args = self._write_script_params(
+                slug, category, keys, value, expires
+            )
+            self._run_script(scripts.SET_METRIC, keys=script_keys, args=args)
+            return
 
-        # Construct a dictionary of key/values for use with mset
-        data = {}
-        for k in keys:
-            data[k] = value
-        self.r.mset(data)
+        # Add the slug to the set of metric slugs
+        self._sadd_once(self._metric_slugs_key, slug)
+
+        if schema.hashed:
+            pipe = self.r.pipeline()
+            for k, ttl in zip(keys, expires):
+                name, field = schema.hash_field(k)
+                pipe.hset(name, field, value)
+                if ttl:
+                    pipe.expire(name, ttl)
+            pipe.execute()
+        else:
+            # Construct a dictionary of key/values for use with mset
+            data = {}
+            for k in keys:
+                data[k] = value
+
+            if self.cluster:
+                # The keys may be in different slots, so set them one by one.
+                pipe = self.r.pipeline()
+                for k, ttl in zip(keys, expires):
+                    pipe.set(k, value, ex=ttl)
+                pipe.execute()
+            elif any(expires):
+                # Expire the keys in the same round trip.
+                pipe = self.r.pipeline()
+                pipe.mset(data)
+                for k, ttl in zip(keys, expires):
+                    if ttl:
+                        pipe.expire(k, ttl)
+                pipe.execute()
+            else:
+                self.r.mset(data)
 
         # Add the category if applicable.
         if category:
             self._categorize(slug, category)
 
-        # Expire the Metric in ``expire`` seconds if applicable.
-        if expire:
-            for k in keys:
-                self.r.expire(k, expire)
+    def _sample(self, slug, num, sample_rate=None):
+        """Decides whether to record a sampled metric. Returns None if the
+        metric should be skipped, or else the amount by which to increment it,
+        scaled so that the expected total is unchanged.
+
+        ``sample_rate`` defaults to the slug's entry in
+        settings.REDIS_METRICS['SAMPLE_RATES'], if any.
 
-    def metric(self, slug, num=1, category=None, expire=None, date=None):
+        """
+        if sample_rate is None:
+            sample_rates = app_settings.SAMPLE_RATES
+            if not sample_rates:
+                return num
+            sample_rate = sample_rates.get(slug)
+            if sample_rate is None:
+                return num
+        if sample_rate >= 1:
+            return num
+        if random.random() >= sample_rate:
+            return None
+
+        # INCRBY needs an integer, so round the scaled increment up or down at
+        # random, in proportion to its fractional part; e.g. 1 / 0.3 is sent
+        # as 3 two-thirds of the time and 4 a third of the time.
+        scaled = num / sample_rate
+        whole = int(math.floor(scaled))
+        if random.random() < scaled - whole:
+            whole += 1
+        return whole
+
+    @protected
+    def metric(self, slug, num=1, category=None, expire=None, date=None,
+               sample_rate=None):
         """Records a metric, creating it if it doesn't exist or incrementing it
         if it does. All metrics are prefixed with 'm', and automatically
         aggregate for Seconds, Minutes, Hours, Day, Week, Month, and Year.
@@ -347,9 +799,13 @@ class R(object):
         * ``num`` -- Set or Increment the metric by this number; default is 1.
         * ``category`` -- (optional) Assign the metric to a Category (a string)
         * ``expire`` -- (optional) Specify the number of seconds in which the
-          metric will expire.
+          metric will expire. By default, each key expires according to
+          settings.REDIS_METRICS['RETENTION'] for its granularity.
         * ``date`` -- (optional) Specify the timestamp for the metric; default
           used to build the keys will be the current date and time in UTC form.
+        * ``sample_rate`` -- (optional) Only record this fraction of calls
+          (e.g. 0.1 for 10%), incrementing by ``num / sample_rate`` when one
+          is recorded; see settings.REDIS_METRICS['SAMPLE_RATES'].
 
         Redis keys for each metric (slug) take the form:
 
@@ -361,25 +817,112 @@ class R(object):
             m:<slug>:m:<yyyy-mm>             # Month
             m:<slug>:y:<yyyy>                # Year
 
+        If ``settings.REDIS_METRICS['USE_LUA_SCRIPTS']`` is True, all of this
+        happens atomically, in a single round trip to Redis.
+
         """
+        num = self._sample(slug, num, sample_rate)
+        if num is None:
+            return
+
+        self._wrote()
+        keys = self._build_keys(slug, date=date)
+        expires = get_schema().expires(expire)
+
+        if self._use_scripts():
+            script_keys, args = self._write_script_params(
+                slug, category, keys, num, expires
+            )
+            self._run_script(scripts.METRIC, keys=script_keys, args=args)
+            return
+
         # Add the slug to the set of metric slugs
-        self.r.sadd(self._metric_slugs_key, slug)
+        self._sadd_once(self._metric_slugs_key, slug)
 
         if category:
             self._categorize(slug, category)
 
         # Increment keys. NOTE: current redis-py (2.7.2) doesn't include an
         # incrby method; .incr accepts a second ``amount`` parameter.
-        keys = self._build_keys(slug, date=date)
-
         # Use a pipeline to speed up incrementing multiple keys
         pipe = self.r.pipeline()
-        for key in keys:
-            pipe.incr(key, num)
-            if expire:
-                pipe.expire(key, expire)
+        for key, ttl in zip(keys, expires):
+            name = self._incr(pipe, key, num)
+            if ttl:
+                pipe.expire(name, ttl)
         pipe.execute()
 
+    def metrics_bulk(self, metrics, expire=None, chunk_size=None):
+        """Records many metrics at once, and returns the number recorded.
+
+        * ``metrics`` -- an iterable of ``(slug, num, date, category)`` tuples
+          (``date`` and ``category`` may be omitted or None), or a dict of
+          ``{slug: num}`` to record at the current time.
+        * ``expire`` -- (optional) the number of seconds in which every
+          metric will expire; by default, the RETENTION setting applies.
+        * ``chunk_size`` -- (optional) the most distinct keys to send in one
+          pipeline (set in settings.REDIS_METRICS['BULK_CHUNK_SIZE']).
+
+        Increments to the same key are summed before anything is sent, and
+        the keys for each slug are only built once per time period. Metrics
+        are written in chunks, each using a single non-transactional pipeline,
+        so memory use doesn't grow with the size of ``metrics`` (which may be
+        a generator).
+
+        """
+        recorded = 0
+        for chunk in self._bulk_chunks(metrics, expire, chunk_size):
+            counts, slugs, categories, expires, num = chunk
+            self._write_counts(counts, slugs, categories, expires)
+            recorded += num
+        return recorded
+
+    def _bulk_chunks(self, metrics, expire=None, chunk_size=None):
+        """Sums ``metrics`` (see ``metrics_bulk``) into chunks of at most
+        ``chunk_size`` keys, yielding the arguments for ``_write_counts`` for
+        each chunk, and the number of metrics in it."""
+        if chunk_size is None:
+            chunk_size = app_settings.BULK_CHUNK_SIZE
+        if isinstance(metrics, Mapping):
+            metrics = metrics.items()
+
+        schema = get_schema()
+        ttls = schema.expires(expire)
+        now = datetime.utcnow()
+        keys_cache = {}  # {(slug, truncated date): keys}
+        counts = {}
+        expires = {}
+        slugs = set()
+        categories = set()
+        recorded = 0
+
+        for metric in metrics:
+            slug, num = metric[0], metric[1]
+            date = metric[2] if len(metric) > 2 and metric[2] else now
+            category = metric[3] if len(metric) > 3 else None
+
+            cache_key = (slug, schema.truncate(date))
+            keys = keys_cache.get(cache_key)
+            if keys is None:
+                keys = keys_cache[cache_key] = schema.build_keys(slug, date)
+            for key, ttl in zip(keys, ttls):
+                counts[key] = counts.get(key, 0) + num
+                if ttl:
+                    expires[key] = ttl
+            slugs.add(slug)
+            if category:
+                categories.add((slug, category))
+            recorded += 1
+
+            if len(counts) >= chunk_size:
+                yield counts, slugs, categories, expires, recorded
+                keys_cache, counts, expires = {}, {}, {}
+                slugs, categories = set(), set()
+                recorded = 0
+
+        if counts:
+            yield counts, slugs, categories, expires, recorded
+
     def get_metric(self, slug):
         """Get the current values for a metric.
 
@@ -387,12 +930,8 @@ class R(object):
         minutes, hours, day, week, month, and year.
 
         """
-        results = OrderedDict()
-        granularities = self._granularities()
-        keys = self._build_keys(slug)
-        for granularity, key in zip(granularities, keys):
-            results[granularity] = self.r.get(key)
-        return results
+        values = self._mget(self._build_keys(slug))
+        return OrderedDict(zip(self._granularities(), values))
 
     def get_metrics(self, slug_list):
         """Get the metrics for multiple slugs.
@@ -408,19 +947,38 @@ class R(object):
             )
 
         """
+        slug_list = list(slug_list)
+        values = self._mget(self._slug_list_keys(slug_list))
+        return self._metrics_by_slug(slug_list, values)
+
+    def _slug_list_keys(self, slug_list):
+        """Returns the keys for every granularity of every slug in
+        ``slug_list``, so ``get_metrics`` can read them all at once."""
+        keys = []
+        for slug in slug_list:
+            keys.extend(self._build_keys(slug))
+        return keys
+
+    def _metrics_by_slug(self, slug_list, values):
+        """Splits the values read for ``_slug_list_keys`` into the results of
+        ``get_metrics``, leaving out slugs without any data."""
+        names = self._metric_value_names()
+        size = len(names)
+        results = []
+        for i, slug in enumerate(slug_list):
+            metrics = values[i * size:(i + 1) * size]
+            if any(metrics):  # Only if we have data.
+                results.append((slug, dict(zip(names, metrics))))
+        return results
+
+    def _metric_value_names(self):
+        """The names used for each granularity's value in ``get_metrics``."""
         # meh. I should have been consistent here, but I'm lazy, so support these
         # value names instead of granularity names, but respect the min/max
         # granularity settings.
         keys = ['seconds', 'minutes', 'hours', 'day', 'week', 'month', 'year']
         key_mapping = {gran: key for gran, key in zip(GRANULARITIES, keys)}
-        keys = [key_mapping[gran] for gran in self._granularities()]
-
-        results = []
-        for slug in slug_list:
-            metrics = self.r.mget(*self._build_keys(slug))
-            if any(metrics):  # Only if we have data.
-                results.append((slug, dict(zip(keys, metrics))))
-        return results
+        return [key_mapping[gran] for gran in self._granularities()]
 
     def get_category_metrics(self, category):
         """Get metrics belonging to the given category"""
@@ -430,6 +988,7 @@ class R(object):
     def delete_category(self, category):
         """Removes the category from Redis. This doesn't touch the metrics;
         they simply become uncategorized."""
+        self._wrote()
         # Remove mapping of metrics-to-category
         category_key = self._category_key(category)
         self.r.delete(category_key)
@@ -437,6 +996,9 @@ class R(object):
         # Remove category from Set
         self.r.srem(self._categories_key, category)
 
+        self._known_slugs.discard(category_key)
+        self._known_slugs.discard(self._categories_key, category)
+
     def reset_category(self, category, metric_slugs):
         """Resets (or creates) a category containing a list of metrics.
 
@@ -445,6 +1007,7 @@ class R(object):
             category.
 
         """
+        self._wrote()
         key = self._category_key(category)
         if len(metric_slugs) == 0:
             # If there are no metrics, just remove the category
@@ -482,23 +1045,33 @@ class R(object):
             ]
 
         """
+        keys = self._metric_history_keys(slugs, since, to, granularity)
+        return self._metric_history_results(keys, self._mget(keys))
+
+    def _metric_history_keys(self, slugs, since, to, granularity):
+        """Build the sorted list of Redis keys needed by
+        ``get_metric_history``: the periods in the range are worked out once
+        (see ``KeySchema.range_periods``), and shared by every slug."""
         if not type(slugs) == list:
             slugs = [slugs]
 
-        # Build the set of Redis keys that we need to get.
-        keys = []
-        for slug in slugs:
-            for date in self._date_range(granularity, since, to):
-                keys += self._build_keys(slug, date, granularity)
-        keys = list(dedupe(keys))
+        schema = get_schema()
+        periods = self._history_periods(granularity, since, to)
+        return list(schema.history_keys(slugs, granularity, periods))
 
-        # Fetch our data, replacing any None-values with zeros
-        results = [0 if v is None else v for v in self.r.mget(keys)]
-        results = zip(keys, results)
-        return sorted(results, key=lambda t: t[0])
+    def _history_periods(self, granularity, since, to):
+        """Returns the sorted periods at ``granularity`` between ``since`` and
+        ``to``; the same ones as for each date from ``_date_range``."""
+        to, unit, units = self._date_range_units(granularity, since, to)
+        return get_schema().range_periods(granularity, to, units)
+
+    def _metric_history_results(self, keys, values):
+        """Pairs each key (already sorted) with its value, replacing any
+        None-values with zeros."""
+        return [(k, 0 if v is None else v) for k, v in zip(keys, values)]
 
     def get_metric_history_as_columns(self, slugs, since=None,
-                                      granularity='daily'):
+                                      granularity='daily', as_array=False):
         """Provides the same data as ``get_metric_history``, but in a columnar
         format. If you had the following yearly history, for example::
 
@@ -521,29 +1094,53 @@ class R(object):
         be useful for certain graphing libraries (I'm looking at you Google
         Charts LineChart).
 
+        With ``as_array=True`` (which requires NumPy), this returns a tuple of
+        the list of periods and a NumPy array of floats, with a row for each
+        period and a column for each slug::
+
+            (['y:2012', 'y:2013'], array([[1., 3.], [2., 4.]]))
+
         """
+        if as_array and numpy is None:
+            raise ImportError("as_array=True requires NumPy")
         history = self.get_metric_history(slugs, since, granularity=granularity)
-        _history = []  # new, columnar history
-        periods = ['Period']  # A separate, single column for the time period
-        for s in slugs:
-            column = [s]  # story all the data for a single slug
-            for key, value in history:
-                # ``metric_slug`` extracts the slug from the Redis Key
-                if template_tags.metric_slug(key) == s:
-                    column.append(value)
-
-                # Get time period value as first column; This value is
-                # duplicated in the Redis key for each value, so this is a bit
-                # inefficient, but... oh well.
-                period = template_tags.strip_metric_prefix(key)
-                if period not in periods:
-                    periods.append(period)
-
-            _history.append(column)  # Remember that slug's column of data
-
-        # Finally, stick the time periods in the first column.
-        _history.insert(0, periods)
-        return list(zip(*_history))  # Transpose the rows & columns
+        return self._history_as_columns(slugs, history, as_array)
+
+    def _history_as_columns(self, slugs, history, as_array=False):
+        """Transposes a metric ``history`` into columns for each slug; see
+        ``get_metric_history_as_columns``.
+
+        Each key is split into its slug and period once, and its value is
+        filed under the row for that period, so this is a single pass over the
+        history. Missing values are zeros.
+
+        """
+        if not type(slugs) == list:
+            slugs = [slugs]
+
+        rows = {}  # The row number of each period, in the order they're seen
+        cells = {}  # The values for each slug in a key, by row number
+        for key, value in history:
+            _, slug, period = key.split(":", 2)
+            row = rows.setdefault(period, len(rows))
+            cells.setdefault(slug, {})[row] = value
+
+        # Slugs appear in keys normalized (and maybe wrapped in a hash tag).
+        schema = get_schema()
+        columns = [cells.get(schema.tag(schema.slugify(s)), {}) for s in slugs]
+        periods = list(rows)
+        values = [
+            [column.get(row, 0) for column in columns]
+            for row in range(len(periods))
+        ]
+        if as_array:
+            return periods, numpy.array(values, dtype=float).reshape(
+                len(periods), len(columns)
+            )
+        header = tuple(['Period'] + slugs)
+        return [header] + [
+            tuple([period] + row) for period, row in zip(periods, values)
+        ]
 
     def get_metric_history_chart_data(self, slugs, since=None, granularity='daily'):
         """Provides the same data as ``get_metric_history``, but with metrics
@@ -576,7 +1173,11 @@ class R(object):
         """
         slugs = sorted(slugs)
         history = self.get_metric_history(slugs, since, granularity=granularity)
+        return self._history_as_chart_data(history)
 
+    def _history_as_chart_data(self, history):
+        """Rearranges a metric ``history`` for Chart.js; see
+        ``get_metric_history_chart_data``."""
         # Convert the history into an intermediate data structure organized
         # by periods. Since the history is sorted by key (which includes both
         # the slug and the date, the values should be ordered correctly.
@@ -607,29 +1208,425 @@ class R(object):
     def gauge_slugs(self):
         """Return a set of Gauges slugs (i.e. those used to create Redis keys)
         for this app."""
-        return self.r.smembers(self._gauge_slugs_key)
+        return self._reader().smembers(self._gauge_slugs_key)
 
     def _gauge_key(self, slug):
         """Make sure our slugs have a consistent format."""
-        return "g:{0}".format(slugify(slug))
+        schema = get_schema()
+        return "g:{0}".format(schema.tag(schema.slugify(slug)))
+
+    def _gauge_history_key(self, slug):
+        schema = get_schema()
+        return "gh:{0}".format(schema.tag(schema.slugify(slug)))
 
-    def gauge(self, slug, current_value):
-        """Set the value for a Gauge.
+    def _queue_gauge(self, pipe, slug, current_value, date=None):
+        """Queues the commands that set a gauge on ``pipe``.
+
+        The current value is kept at ``g:<slug>``, and (unless
+        GAUGE_HISTORY_SIZE is 0) each value is also added to a sorted set at
+        ``gh:<slug>``, scored by its timestamp. The sorted set is trimmed to
+        at most GAUGE_HISTORY_SIZE entries that are no older than
+        GAUGE_HISTORY_MAX_AGE seconds.
+
+        When GAUGE_STATS is True, the count, sum, min, max and last value for
+        each of the gauge's time periods are also updated (by the
+        ``GAUGE_STATS`` Lua script), so the value must be a number.
+
+        """
+        date = date or datetime.utcnow()
+        pipe.set(self._gauge_key(slug), current_value)
+        if app_settings.GAUGE_STATS:
+            keys = self._gauge_stats_keys(slug, date)
+            args = [current_value]
+            args.extend(ttl or 0 for ttl in get_schema().expires())
+            self._queue_script(pipe, scripts.GAUGE_STATS, keys, args)
+
+        size = app_settings.GAUGE_HISTORY_SIZE
+        if not size:
+            return
+
+        key = self._gauge_history_key(slug)
+        timestamp = _timestamp(date)
+        # Members of a sorted set are unique, so prefix the value with its
+        # timestamp to keep repeated values.
+        pipe.zadd(key, {"{0:.6f}:{1}".format(timestamp, current_value): timestamp})
+        pipe.zremrangebyrank(key, 0, -(size + 1))
+        max_age = app_settings.GAUGE_HISTORY_MAX_AGE
+        if max_age:
+            pipe.zremrangebyscore(key, "-inf", "({0}".format(timestamp - max_age))
+            pipe.expire(key, max_age)
+
+    @protected
+    def gauge(self, slug, current_value, date=None):
+        """Set the value for a Gauge, using a single round trip.
 
         * ``slug`` -- the unique identifier (or key) for the Gauge
         * ``current_value`` -- the value that the gauge should display
+        * ``date`` -- (optional) the time of the value, for the gauge's
+          history; default is now (in UTC).
 
         """
-        k = self._gauge_key(slug)
-        self.r.sadd(self._gauge_slugs_key, slug)  # keep track of all Gauges
-        self.r.set(k, current_value)
+        self._wrote()
+        pipe = self.r.pipeline(transaction=False)
+        pending = []
+        # keep track of all Gauges
+        self._queue_sadd_once(pipe, pending, self._gauge_slugs_key, slug)
+        self._queue_gauge(pipe, slug, current_value, date)
+        pipe.execute()
+        self._registered(pending)
 
     def get_gauge(self, slug):
         k = self._gauge_key(slug)
-        return self.r.get(k)
+        return self._reader().get(k)
+
+    def _period_keys(self, prefix, slug, date, granularity='all'):
+        """Builds keys that follow the metric keys for each period, but with
+        another ``prefix`` instead of "m", e.g. "gs:<slug>:<yyyy-mm-dd>"."""
+        return [
+            prefix + key[1:]
+            for key in get_schema().build_keys(slug, date, granularity)
+        ]
+
+    def _period_history_keys(self, prefix, slug, since, to, granularity):
+        """Like ``_metric_history_keys``, for keys built by ``_period_keys``
+        (and sorted)."""
+        schema = get_schema()
+        periods = self._history_periods(granularity, since, to)
+        return [
+            prefix + key[1:]
+            for key in schema.history_keys([slug], granularity, periods)
+        ]
+
+    def _gauge_stats_keys(self, slug, date, granularity='all'):
+        """Builds the keys of the hashes that hold a gauge's statistics, e.g.
+        "gs:<slug>:<yyyy-mm-dd>" for the daily statistics."""
+        return self._period_keys("gs", slug, date, granularity)
+
+    def _gauge_stats(self, values):
+        """Converts a hash of gauge statistics to a dict of numbers (with the
+        average), or None if nothing was recorded."""
+        if not values:
+            return None
+        stats = {k: float(values[k]) for k in ('sum', 'min', 'max', 'last')}
+        stats['count'] = int(values['count'])
+        stats['avg'] = stats['sum'] / stats['count']
+        return stats
+
+    def _hgetall(self, keys):
+        """Fetches several hashes in one round trip."""
+        pipe = self._reader().pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        return pipe.execute()
+
+    def get_gauge_stats(self, slug, date=None):
+        """Returns the statistics recorded for a gauge (when GAUGE_STATS is
+        enabled) in each of the periods containing ``date`` (default: now), as
+        an OrderedDict keyed by granularity::
+
+            {
+                'daily': {
+                    'count': 1440, 'sum': 21600.0, 'avg': 15.0,
+                    'min': 0.0, 'max': 42.0, 'last': 12.0,
+                },
+                ...
+            }
+
+        A period in which the gauge wasn't set has None for its statistics.
+
+        """
+        keys = self._gauge_stats_keys(slug, date or datetime.utcnow())
+        values = self._hgetall(keys)
+        return OrderedDict(
+            (granularity, self._gauge_stats(v))
+            for granularity, v in zip(self._granularities(), values)
+        )
+
+    def get_gauge_stats_history(self, slug, since=None, to=None,
+                                granularity='daily'):
+        """Returns a gauge's statistics for each period at the given
+        ``granularity`` from ``since`` until ``to``, as a list of
+        ``(key, statistics)`` tuples sorted by key. The arguments work like
+        they do for ``get_metric_history``, and the statistics are like those
+        returned by ``get_gauge_stats``.
+
+        """
+        keys = self._period_history_keys("gs", slug, since, to, granularity)
+        values = self._hgetall(keys)
+        return [(k, self._gauge_stats(v)) for k, v in zip(keys, values)]
+
+    def _gauge_history_range(self, since=None, to=None):
+        """Returns the (min, max) scores for a range of a gauge's history."""
+        return (
+            _timestamp(since) if since else "-inf",
+            _timestamp(to) if to else "+inf",
+        )
+
+    def _gauge_history(self, results):
+        """Converts the members of a gauge's history to a list of
+        ``(datetime, value)`` tuples."""
+        return [
+            (EPOCH + timedelta(seconds=score), member.partition(":")[2])
+            for member, score in results
+        ]
+
+    def get_gauge_history(self, slug, since=None, to=None):
+        """Returns a list of the ``(datetime, value)`` pairs recorded for a
+        gauge, oldest first.
+
+        * ``slug`` -- the gauge's slug
+        * ``since`` -- (optional) a ``datetime`` from which to return values
+        * ``to`` -- (optional) a ``datetime`` until which to return values
+
+        Only the values kept according to the GAUGE_HISTORY_SIZE and
+        GAUGE_HISTORY_MAX_AGE settings are available.
+
+        """
+        results = self._reader().zrangebyscore(
+            self._gauge_history_key(slug),
+            *self._gauge_history_range(since, to),
+            withscores=True
+        )
+        return self._gauge_history(results)
 
     def delete_gauge(self, slug):
         """Removes all gauges with the given ``slug``."""
-        key = self._gauge_key(slug)
-        self.r.delete(key)  # Remove the Gauge
+        self._wrote()
+        keys = [self._gauge_key(slug), self._gauge_history_key(slug)]
+        if app_settings.GAUGE_STATS:
+            keys.extend(self._scan_keys("gs:{0}:*".format(get_schema().tag(slug))))
+        self.r.delete(*keys)
         self.r.srem(self._gauge_slugs_key, slug)  # Remove from the set of keys
+        self._known_slugs.discard(self._gauge_slugs_key, slug)
+
+    # Timers. Each timing is counted in a histogram bucket (see the
+    # HISTOGRAM_BUCKETS setting), in a hash per period at "t:<slug>:<period>".
+    def timer_slugs(self):
+        """Return a set of the slugs for all timers."""
+        return self._reader().smembers(self._timer_slugs_key)
+
+    def _timer_keys(self, slug, date, granularity='all'):
+        """Builds the keys of the hashes that hold a timer's histogram, e.g.
+        "t:<slug>:<yyyy-mm-dd>" for the daily histogram."""
+        return self._period_keys("t", slug, date, granularity)
+
+    def _queue_timing(self, pipe, slug, value, date=None):
+        """Queues the commands that record a timing on ``pipe``, and returns
+        the list to pass to ``_registered``."""
+        buckets = {get_schema().bucket(value): 1}
+        return self._queue_histogram(pipe, slug, buckets, 1, value, date)
+
+    def _queue_histogram(self, pipe, slug, buckets, count, total, date=None):
+        """Queues the commands that add already-bucketed timings to a timer
+        on ``pipe``, and returns the list to pass to ``_registered``.
+
+        * ``buckets`` -- a dict of {bucket name: count}
+        * ``count`` -- the number of timings
+        * ``total`` -- the sum of the timings
+
+        """
+        pending = []
+        self._queue_sadd_once(pipe, pending, self._timer_slugs_key, slug)
+        keys = self._timer_keys(slug, date or datetime.utcnow())
+        for key, ttl in zip(keys, get_schema().expires()):
+            for bucket, n in buckets.items():
+                pipe.hincrby(key, bucket, n)
+            pipe.hincrby(key, 'count', count)
+            pipe.hincrbyfloat(key, 'sum', total)
+            if ttl:
+                pipe.expire(key, ttl)
+        return pending
+
+    @protected
+    def timing(self, slug, value, date=None):
+        """Records a timing (or any other value whose distribution you'd like
+        to see) for a timer, using a single round trip.
+
+        * ``slug`` -- the unique identifier (or key) for the timer
+        * ``value`` -- the value to record, e.g. a duration in milliseconds
+        * ``date`` -- (optional) the time at which the value was recorded;
+          default is now (in UTC).
+
+        """
+        self._wrote()
+        pipe = self.r.pipeline(transaction=False)
+        pending = self._queue_timing(pipe, slug, value, date)
+        pipe.execute()
+        self._registered(pending)
+
+    def _timer_histogram(self, hashes):
+        """Merges a list of timer hashes (e.g. for several periods) into a
+        dict with the total ``count``, ``sum`` and ``mean``, the ``buckets``
+        as an OrderedDict of {upper bound: count}, and estimated percentiles
+        ``p50``, ``p95`` and ``p99``."""
+        count = 0
+        total = 0.0
+        bounds = get_schema().buckets + (float('inf'),)
+        buckets = dict.fromkeys((float(b) for b in bounds), 0)
+        for values in hashes:
+            for field, value in values.items():
+                if field == 'count':
+                    count += int(value)
+                elif field == 'sum':
+                    total += float(value)
+                else:
+                    bound = float(field)
+                    buckets[bound] = buckets.get(bound, 0) + int(value)
+        buckets = OrderedDict(sorted(buckets.items()))
+        histogram = {
+            'count': count,
+            'sum': total,
+            'mean': total / count if count else None,
+            'buckets': buckets,
+        }
+        for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            histogram[name] = self._percentile(buckets, q)
+        return histogram
+
+    def _percentile(self, buckets, q):
+        """Estimates the ``q``-th quantile (0 < q < 1) of a histogram, given
+        an OrderedDict of {upper bound: count}, by interpolating linearly
+        within the bucket that contains it. Values in the "+Inf" bucket are
+        reported as the largest finite bound."""
+        total = sum(buckets.values())
+        if not total:
+            return None
+
+        rank = q * total
+        seen = 0
+        lower = 0.0
+        for upper, n in buckets.items():
+            if n and seen + n >= rank:
+                if math.isinf(upper):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / n
+            seen += n
+            lower = upper
+        return lower
+
+    def get_timing(self, slug, since=None, to=None, granularity='daily'):
+        """Returns a timer's histogram, merged over every period at the given
+        ``granularity`` from ``since`` until ``to`` (these work like they do
+        for ``get_metric_history``)::
+
+            {
+                'count': 1200,
+                'sum': 96000.0,
+                'mean': 80.0,
+                'buckets': OrderedDict([(5.0, 0), (10.0, 12), ...]),
+                'p50': 42.5,
+                'p95': 230.0,
+                'p99': 480.0,
+            }
+
+        Percentiles are estimated from the bucket counts, so they're only as
+        precise as the HISTOGRAM_BUCKETS setting.
+
+        """
+        keys = self._period_history_keys("t", slug, since, to, granularity)
+        return self._timer_histogram(self._hgetall(keys))
+
+    def get_timing_history(self, slug, since=None, to=None, granularity='daily'):
+        """Like ``get_timing``, but returns a list of ``(key, histogram)``
+        tuples with the histogram for each period, sorted by key."""
+        keys = self._period_history_keys("t", slug, since, to, granularity)
+        return [
+            (key, self._timer_histogram([values]))
+            for key, values in zip(keys, self._hgetall(keys))
+        ]
+
+    def delete_timer(self, slug):
+        """Removes all data for the timer with the given ``slug``."""
+        self._wrote()
+        keys = self._scan_keys("t:{0}:*".format(get_schema().tag(slug)))
+        if keys:
+            self.r.delete(*keys)
+        self.r.srem(self._timer_slugs_key, slug)
+        self._known_slugs.discard(self._timer_slugs_key, slug)
+
+    # Unique counts. Members are added to a HyperLogLog per period at
+    # "u:<slug>:<period>", which counts distinct members with a standard error
+    # of 0.81% in at most 12KB, however many members there are.
+    def unique_slugs(self):
+        """Return a set of the slugs for all unique-count metrics."""
+        return self._reader().smembers(self._unique_slugs_key)
+
+    def _unique_keys(self, slug, date, granularity='all'):
+        """Builds the keys of the HyperLogLogs that count a metric's unique
+        members, e.g. "u:<slug>:<yyyy-mm-dd>" for those seen each day."""
+        return self._period_keys("u", slug, date, granularity)
+
+    def _queue_unique(self, pipe, slug, members, date=None):
+        """Queues the commands that add ``members`` to a unique-count metric
+        on ``pipe``, and returns the list to pass to ``_registered``."""
+        pending = []
+        self._queue_sadd_once(pipe, pending, self._unique_slugs_key, slug)
+        keys = self._unique_keys(slug, date or datetime.utcnow())
+        for key, ttl in zip(keys, get_schema().expires()):
+            pipe.pfadd(key, *members)
+            if ttl:
+                pipe.expire(key, ttl)
+        return pending
+
+    @protected
+    def unique(self, slug, member, date=None):
+        """Records that ``member`` (e.g. a user id) was seen, for counting the
+        unique members of a metric in each time period. Uses a single round
+        trip.
+
+        * ``slug`` -- the unique identifier (or key) for the metric
+        * ``member`` -- the member to count, or a list of members
+        * ``date`` -- (optional) when the member was seen; default is now (in
+          UTC).
+
+        """
+        members = member if isinstance(member, (list, tuple, set)) else [member]
+        if not members:
+            return
+        self._wrote()
+        pipe = self.r.pipeline(transaction=False)
+        pending = self._queue_unique(pipe, slug, members, date)
+        pipe.execute()
+        self._registered(pending)
+
+    def _pfcounts(self, keys):
+        """Counts several HyperLogLogs in one round trip."""
+        pipe = self._reader().pipeline(transaction=False)
+        for key in keys:
+            pipe.pfcount(key)
+        return pipe.execute()
+
+    def get_unique(self, slug, date=None):
+        """Returns the (approximate) number of unique members seen in each of
+        the periods containing ``date`` (default: now), as an OrderedDict
+        keyed by granularity, e.g. ``{'daily': 1523, 'weekly': 6402, ...}``.
+        """
+        keys = self._unique_keys(slug, date or datetime.utcnow())
+        return OrderedDict(zip(self._granularities(), self._pfcounts(keys)))
+
+    def get_unique_history(self, slug, since=None, to=None,
+                           granularity='daily'):
+        """Returns the (approximate) number of unique members seen in each
+        period at the given ``granularity`` from ``since`` until ``to``, as a
+        list of ``(key, count)`` tuples sorted by key. The arguments work like
+        they do for ``get_metric_history``."""
+        keys = self._period_history_keys("u", slug, since, to, granularity)
+        return list(zip(keys, self._pfcounts(keys)))
+
+    def get_unique_count(self, slug, since=None, to=None, granularity='daily'):
+        """Returns the (approximate) number of unique members seen over the
+        whole range of periods from ``since`` until ``to``. A member seen in
+        several periods is only counted once: Redis merges the periods'
+        HyperLogLogs in a single PFCOUNT."""
+        keys = self._period_history_keys("u", slug, since, to, granularity)
+        return self._reader().pfcount(*keys) if keys else 0
+
+    def delete_unique(self, slug):
+        """Removes all data for the unique-count metric with the given
+        ``slug``."""
+        self._wrote()
+        keys = self._scan_keys("u:{0}:*".format(get_schema().tag(slug)))
+        if keys:
+            self.r.delete(*keys)
+        self.r.srem(self._unique_slugs_key, slug)
+        self._known_slugs.discard(self._unique_slugs_key, slug)
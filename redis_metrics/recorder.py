@@ -0,0 +1,189 @@
+"""
+An in-process accumulator for call counts and timings, used by the
+``redis_metrics.timed`` and ``redis_metrics.count_calls`` decorators.
+
+Recording a call only updates a few numbers in memory: a call count per slug,
+or, for timings, a count, a sum and a histogram bucket per slug (see the
+HISTOGRAM_BUCKETS setting). A daemon thread writes everything that was
+recorded to Redis in a single pipeline every ``BUFFER_FLUSH_INTERVAL``
+seconds, so the code being measured never waits for Redis.
+
+Calls are counted in the periods in which they're flushed, so with a
+``MIN_GRANULARITY`` of "seconds" a call may be counted up to one flush
+interval late. Like the writer thread, the flush thread is started on first
+use and restarted in a forked child process, which starts with nothing
+recorded.
+
+"""
+from __future__ import unicode_literals
+from datetime import datetime
+import logging
+import os
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from .keys import get_schema
+from .settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+
+class CallRecorder(object):
+
+    def __init__(self, r, flush_interval=None):
+        """Creates a recorder that writes to Redis using the given ``R``
+        instance.
+
+        * ``r`` -- an instance of ``redis_metrics.models.R``
+        * ``flush_interval`` -- The number of seconds between flushes (set in
+          settings.REDIS_METRICS['BUFFER_FLUSH_INTERVAL'])
+
+        """
+        self.r = r
+        if flush_interval is None:
+            flush_interval = app_settings.BUFFER_FLUSH_INTERVAL
+        self.flush_interval = flush_interval
+
+        self._pid = None  # The process in which the thread is running
+        self._start_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._clear()
+
+        self.flushes = 0  # Number of pipelines sent to Redis
+        self.flushed = 0  # Number of calls written to Redis
+        self.dropped = 0  # Number of calls lost to Redis errors
+        self.last_flush_latency = 0.0  # Seconds taken by the latest flush
+        self.max_flush_latency = 0.0  # Slowest flush, in seconds
+
+    def _clear(self):
+        """Reset the pending data. Call while holding ``self._lock``."""
+        self._counts = {}  # {slug: number of calls}
+        self._timings = {}  # {slug: [count, sum, {bucket: count}]}
+        self._pending = 0  # Number of calls waiting to be written
+
+    def _ensure_started(self):
+        """Starts the flush thread if it isn't running in this process."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                # We're in a forked child; leave the parent's calls to it.
+                self._start_lock = threading.Lock()
+                self._lock = threading.Lock()
+                self._clear()
+            self._stopped = threading.Event()
+            self._thread = threading.Thread(
+                target=self._run,
+                name="redis-metrics-recorder"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = pid
+
+    def count(self, slug, num=1):
+        """Counts ``num`` calls for the metric ``slug``."""
+        self._ensure_started()
+        with self._lock:
+            self._counts[slug] = self._counts.get(slug, 0) + num
+            self._pending += 1
+
+    def timing(self, slug, value):
+        """Records a timing (e.g. in milliseconds) for the timer ``slug``."""
+        bucket = get_schema().bucket(value)
+        self._ensure_started()
+        with self._lock:
+            stats = self._timings.get(slug)
+            if stats is None:
+                stats = self._timings[slug] = [0, 0.0, {}]
+            stats[0] += 1
+            stats[1] += value
+            buckets = stats[2]
+            buckets[bucket] = buckets.get(bucket, 0) + 1
+            self._pending += 1
+
+    @property
+    def depth(self):
+        """The number of calls waiting to be written."""
+        return self._pending
+
+    def _run(self):
+        stopped = self._stopped
+        while not stopped.wait(self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """Writes everything recorded so far using a single pipeline (with
+        ``R._write_counts``), and returns the number of calls that were
+        written. Redis errors, and writes skipped by the circuit breaker, are
+        logged (and counted in ``dropped``) rather than raised."""
+        with self._lock:
+            counts = self._counts
+            timings = self._timings
+            pending = self._pending
+            self._clear()
+
+        if pending == 0:
+            return 0
+
+        r = self.r
+        date = datetime.utcnow()
+        keyed_counts = {}
+        expires = {}
+        for slug, num in counts.items():
+            keys = r._build_keys(slug, date=date)
+            for key, ttl in zip(keys, get_schema().expires()):
+                # Slugs that slugify alike share their keys.
+                keyed_counts[key] = keyed_counts.get(key, 0) + num
+                if ttl:
+                    expires[key] = ttl
+        histograms = [
+            (slug, buckets, count, total, date)
+            for slug, (count, total, buckets) in timings.items()
+        ]
+        start = time.monotonic()
+        try:
+            # Written like any other bulk write, so it goes through the
+            # circuit breaker (which raises CircuitOpenError while open).
+            r._write_counts(keyed_counts, counts, (), expires, histograms)
+        except RedisError:
+            logger.exception("Dropped %d recorded calls", pending)
+            self.dropped += pending
+            return 0
+        finally:
+            self.last_flush_latency = time.monotonic() - start
+            self.max_flush_latency = max(
+                self.max_flush_latency,
+                self.last_flush_latency
+            )
+
+        self.flushes += 1
+        self.flushed += pending
+        return pending
+
+    def stop(self, timeout=5):
+        """Stops the flush thread, and writes anything left."""
+        self._stopped.set()
+        thread = self._thread
+        if thread is not None and self._pid == os.getpid():
+            thread.join(timeout)
+        self._pid = None
+        self._thread = None
+        self.flush()
+
+    def stats(self):
+        """Returns a dictionary of counters describing this recorder."""
+        return {
+            'depth': self.depth,
+            'flushes': self.flushes,
+            'flushed': self.flushed,
+            'dropped': self.dropped,
+            'last_flush_latency': self.last_flush_latency,
+            'max_flush_latency': self.max_flush_latency,
+        }
@@ -0,0 +1,64 @@
+"""
+Remembers which slugs and categories this process has already added to the
+Redis sets that list them (``metric-slugs``, ``gauge-slugs``, ``categories``
+and each category's set of slugs).
+
+Every write used to SADD to those sets, even though a slug only needs to be
+added once. When ``settings.REDIS_METRICS['CACHE_KNOWN_SLUGS']`` is True, the
+``R`` class skips the SADD for members it has already added. Entries expire
+after ``KNOWN_SLUGS_TTL`` seconds so that sets changed by other processes
+(e.g. a metric deleted from the admin) get repaired, and ``R`` forgets the
+affected entries itself when it deletes a metric, gauge or category.
+
+"""
+from __future__ import unicode_literals
+import time
+
+
+class SlugRegistry(object):
+
+    def __init__(self, ttl=None, max_size=10000):
+        """Creates an empty registry.
+
+        * ``ttl`` -- (optional) the number of seconds for which an entry is
+          trusted; None means forever.
+        * ``max_size`` -- the most entries to keep. The registry is simply
+          emptied when it's full; the only cost is a few repeated SADDs.
+
+        """
+        self.ttl = ttl
+        self.max_size = max_size
+        self._added = {}  # {(set key, member): time added}
+
+    def __len__(self):
+        return len(self._added)
+
+    def unknown(self, key, members):
+        """Returns a list of the ``members`` that haven't been added to the
+        set at ``key``, or whose entries have expired."""
+        added = self._added
+        if self.ttl is None:
+            return [m for m in members if (key, m) not in added]
+
+        oldest = time.monotonic() - self.ttl
+        return [m for m in members if added.get((key, m), oldest) <= oldest]
+
+    def add(self, key, members):
+        """Records that ``members`` were added to the set at ``key``."""
+        if len(self._added) + len(members) > self.max_size:
+            self._added.clear()
+        now = time.monotonic()
+        for member in members:
+            self._added[(key, member)] = now
+
+    def discard(self, key, member=None):
+        """Forgets a member of the set at ``key``, or every member of it if
+        ``member`` is None."""
+        if member is not None:
+            self._added.pop((key, member), None)
+        else:
+            for entry in [e for e in list(self._added) if e[0] == key]:
+                self._added.pop(entry, None)
+
+    def clear(self):
+        self._added.clear()
@@ -0,0 +1,181 @@
+"""
+Sends reads to Redis replicas, so dashboards don't compete with the writes on
+the primary.
+
+When the READ_REPLICAS setting lists any replicas, ``R`` keeps a
+``ReplicaPool`` for them, and its read methods (``get_metric``,
+``get_metric_history``, ``get_gauge``, ``metric_slugs``, ``categories`` and so
+on) ask the pool for a client; everything else is written to the primary.
+
+A replica is chosen for each read by READ_REPLICA_SELECTION:
+
+* ``"round-robin"`` -- take turns.
+* ``"least-latency"`` -- use the replica whose recent reads were fastest (an
+  exponentially weighted moving average of each replica's read times). A
+  replica is tried at least once before it's judged.
+
+If a replica can't be reached, the read is retried on the primary, and the
+replica is left out for ``retry_after`` seconds. With READ_YOUR_WRITES, a
+process that has just written reads from the primary for that many seconds,
+so it sees its own writes despite replication lag (see ``R._reader``).
+
+"""
+from __future__ import unicode_literals
+import itertools
+import logging
+import time
+
+from redis.exceptions import ConnectionError, TimeoutError
+
+logger = logging.getLogger(__name__)
+
+SELECTIONS = ("round-robin", "least-latency")
+
+# The weight of the newest read time in each replica's average.
+LATENCY_WEIGHT = 0.2
+
+
+class ReplicaPool(object):
+
+    def __init__(self, primary, replicas, selection="round-robin",
+                 retry_after=30):
+        """Creates a pool of replicas.
+
+        * ``primary`` -- the Redis client for the primary, used when no
+          replica can be reached
+        * ``replicas`` -- a list of Redis clients for the replicas
+        * ``selection`` -- "round-robin" or "least-latency" (set in
+          settings.REDIS_METRICS['READ_REPLICA_SELECTION'])
+        * ``retry_after`` -- the number of seconds for which a replica that
+          couldn't be reached is left out
+
+        """
+        if selection not in SELECTIONS:
+            raise ValueError("Unknown READ_REPLICA_SELECTION: {0}".format(selection))
+        self.primary = primary
+        self.replicas = list(replicas)
+        self.selection = selection
+        self.retry_after = retry_after
+        self.latencies = [None] * len(self.replicas)  # Average read seconds
+        self._down_until = [0.0] * len(self.replicas)
+        self._turns = itertools.count()
+
+    def choose(self):
+        """Returns the index of the replica for the next read, or None if
+        none of them are available."""
+        now = time.monotonic()
+        available = [
+            i for i, until in enumerate(self._down_until) if until <= now
+        ]
+        if not available:
+            return None
+        if self.selection == "round-robin":
+            return available[next(self._turns) % len(available)]
+        # Replicas that haven't been measured yet go first.
+        latencies = self.latencies
+        return min(
+            available,
+            key=lambda i: (latencies[i] is not None, latencies[i] or 0)
+        )
+
+    def client(self):
+        """Returns a client for one read: a ``ReplicaClient``, or the primary
+        if no replica is available."""
+        index = self.choose()
+        if index is None:
+            return self.primary
+        return ReplicaClient(self, index)
+
+    def record(self, index, seconds):
+        """Adds the time taken by a read to a replica's average."""
+        latency = self.latencies[index]
+        if latency is None:
+            self.latencies[index] = seconds
+        else:
+            self.latencies[index] = latency + LATENCY_WEIGHT * (seconds - latency)
+
+    def failed(self, index, error):
+        """Leaves a replica out for ``retry_after`` seconds."""
+        logger.warning(
+            "Reading from the primary; replica %d is unavailable: %s", index, error
+        )
+        self._down_until[index] = time.monotonic() + self.retry_after
+        self.latencies[index] = None
+
+    def stats(self):
+        """Returns a dictionary describing each replica."""
+        now = time.monotonic()
+        return {
+            'selection': self.selection,
+            'latencies': list(self.latencies),
+            'down': [until > now for until in self._down_until],
+        }
+
+
+class ReplicaClient(object):
+    """Sends commands to a replica, timing them for the pool; if the replica
+    can't be reached, they're sent to the primary instead."""
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+        self.client = pool.replicas[index]
+
+    def _call(self, name, args, kwargs):
+        start = time.monotonic()
+        try:
+            result = getattr(self.client, name)(*args, **kwargs)
+        except (ConnectionError, TimeoutError) as e:
+            self.pool.failed(self.index, e)
+            return getattr(self.pool.primary, name)(*args, **kwargs)
+        self.pool.record(self.index, time.monotonic() - start)
+        return result
+
+    def pipeline(self, transaction=False, shard_hint=None):
+        return ReplicaPipeline(self)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self._call(name, args, kwargs)
+
+
+class ReplicaPipeline(object):
+    """A pipeline for a ``ReplicaClient``. The queued commands are replayed
+    on the primary if the replica can't be reached."""
+
+    def __init__(self, replica):
+        self.replica = replica
+        self._commands = []
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            self._commands.append((name, args, kwargs))
+            return self
+        return command
+
+    def __len__(self):
+        return len(self._commands)
+
+    def _execute_on(self, client):
+        pipe = client.pipeline(transaction=False)
+        for name, args, kwargs in self._commands:
+            getattr(pipe, name)(*args, **kwargs)
+        return pipe.execute()
+
+    def execute(self):
+        replica = self.replica
+        start = time.monotonic()
+        try:
+            results = self._execute_on(replica.client)
+        except (ConnectionError, TimeoutError) as e:
+            replica.pool.failed(replica.index, e)
+            results = self._execute_on(replica.pool.primary)
+        else:
+            replica.pool.record(replica.index, time.monotonic() - start)
+        finally:
+            self._commands = []
+        return results
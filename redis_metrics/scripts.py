@@ -0,0 +1,129 @@
+"""
+Lua scripts used by the ``R`` class when
+``settings.REDIS_METRICS['USE_LUA_SCRIPTS']`` is True.
+
+Each script does all of the work for a single write in one round trip. They're
+registered with ``redis-py``'s ``register_script``, which runs them with
+EVALSHA and falls back to loading the script if Redis's script cache has been
+flushed (e.g. after a restart).
+
+"""
+
+# Record a metric.
+#
+# KEYS[1] -- the set of all metric slugs
+# KEYS[2] -- the set of all categories
+# KEYS[3] -- the set of slugs in the metric's category
+# KEYS[4...] -- the metric keys to increment
+#
+# ARGV[1] -- the metric's slug
+# ARGV[2] -- the category name, or an empty string
+# ARGV[3] -- the amount by which each key is incremented
+# ARGV[4...] -- for each of KEYS[4...], the number of seconds in which it
+#               expires, or 0
+# ARGV[4 + #KEYS - 3...] -- (only for the "hashes" storage layout) the hash
+#                           field to increment in each of KEYS[4...]
+METRIC = """
+local slug, category, num = ARGV[1], ARGV[2], ARGV[3]
+local n = #KEYS - 3
+
+redis.call('SADD', KEYS[1], slug)
+if category ~= '' then
+    redis.call('SADD', KEYS[3], slug)
+    redis.call('SADD', KEYS[2], category)
+end
+
+for i = 4, #KEYS do
+    local expire, field = tonumber(ARGV[i]), ARGV[i + n]
+    if field then
+        redis.call('HINCRBY', KEYS[i], field, num)
+    else
+        redis.call('INCRBY', KEYS[i], num)
+    end
+    if expire > 0 then
+        redis.call('EXPIRE', KEYS[i], expire)
+    end
+end
+"""
+
+# Set a metric to a specific value. This uses the same KEYS and ARGV as the
+# METRIC script, except ARGV[3] is the value for each key.
+SET_METRIC = """
+local slug, category, value = ARGV[1], ARGV[2], ARGV[3]
+local n = #KEYS - 3
+
+redis.call('SADD', KEYS[1], slug)
+if category ~= '' then
+    redis.call('SADD', KEYS[3], slug)
+    redis.call('SADD', KEYS[2], category)
+end
+
+for i = 4, #KEYS do
+    local expire, field = tonumber(ARGV[i]), ARGV[i + n]
+    if field then
+        redis.call('HSET', KEYS[i], field, value)
+    else
+        redis.call('SET', KEYS[i], value)
+    end
+    if expire > 0 then
+        redis.call('EXPIRE', KEYS[i], expire)
+    end
+end
+"""
+
+# Update a gauge's statistics for each of its time periods, when
+# ``settings.REDIS_METRICS['GAUGE_STATS']`` is True.
+#
+# KEYS[1...] -- the hash of statistics for each period (see
+#               ``R._gauge_stats_keys``)
+#
+# ARGV[1] -- the gauge's new value
+# ARGV[2...] -- for each of KEYS, the number of seconds in which it expires,
+#               or 0
+GAUGE_STATS = """
+local value = tonumber(ARGV[1])
+if not value then
+    return redis.error_reply('gauge statistics need a numeric value')
+end
+
+for i = 1, #KEYS do
+    local key, expire = KEYS[i], tonumber(ARGV[i + 1])
+    redis.call('HINCRBY', key, 'count', 1)
+    redis.call('HINCRBYFLOAT', key, 'sum', ARGV[1])
+    local min, max = unpack(redis.call('HMGET', key, 'min', 'max'))
+    if not min or value < tonumber(min) then
+        redis.call('HSET', key, 'min', ARGV[1])
+    end
+    if not max or value > tonumber(max) then
+        redis.call('HSET', key, 'max', ARGV[1])
+    end
+    redis.call('HSET', key, 'last', ARGV[1])
+    if expire > 0 then
+        redis.call('EXPIRE', key, expire)
+    end
+end
+"""
+
+
+# Merge a hash of gauge statistics into another one, when ``ShardedR`` moves
+# it to a new shard (see ``redis_metrics.sharding``). Its "last" value is
+# kept.
+#
+# KEYS[1] -- the hash of statistics to merge into
+#
+# ARGV[1] -- the count to add
+# ARGV[2] -- the sum to add
+# ARGV[3] -- the minimum, or an empty string
+# ARGV[4] -- the maximum, or an empty string
+MERGE_GAUGE_STATS = """
+local key = KEYS[1]
+redis.call('HINCRBY', key, 'count', ARGV[1])
+redis.call('HINCRBYFLOAT', key, 'sum', ARGV[2])
+local min, max = unpack(redis.call('HMGET', key, 'min', 'max'))
+if ARGV[3] ~= '' and (not min or tonumber(ARGV[3]) < tonumber(min)) then
+    redis.call('HSET', key, 'min', ARGV[3])
+end
+if ARGV[4] ~= '' and (not max or tonumber(ARGV[4]) > tonumber(max)) then
+    redis.call('HSET', key, 'max', ARGV[4])
+end
+"""
@@ -32,10 +32,47 @@ class AppSettings:
         "SSL": False,
         "SOCKET_TIMEOUT": None,
         "SOCKET_CONNECTION_POOL": None,
+        "MAX_CONNECTIONS": None,
+        "BLOCKING_POOL": False,
+        "POOL_TIMEOUT": 20,
+        "CLUSTER": False,
+        "HASH_TAG_KEYS": False,
+        "SHARDS": [],
+        "READ_REPLICAS": [],
+        "READ_REPLICA_SELECTION": "round-robin",
+        "READ_YOUR_WRITES": 0,
+        "CIRCUIT_BREAKER": False,
+        "WRITE_TIMEOUT": None,
+        "BREAKER_FAILURES": 5,
+        "BREAKER_RESET_TIMEOUT": 30,
+        "BREAKER_SPOOL_SIZE": 0,
         "MIN_GRANULARITY": "daily",
         "MAX_GRANULARITY": "yearly",
         "MONDAY_FIRST_DAY_OF_WEEK": False,
         "USE_ISO_WEEK_NUMBER": False,
+        "SLUG_CACHE_SIZE": 1024,
+        "STORAGE_LAYOUT": "keys",
+        "USE_LUA_SCRIPTS": False,
+        "WRITE_MODE": "direct",
+        "BUFFER_MAX_SIZE": 1000,
+        "BUFFER_FLUSH_INTERVAL": 5,
+        "WRITE_QUEUE_SIZE": 10000,
+        "WRITE_QUEUE_POLICY": "drop-newest",
+        "WRITE_BATCH_SIZE": 500,
+        "BULK_CHUNK_SIZE": 1000,
+        "MGET_CHUNK_SIZE": 1000,
+        "CACHE_KNOWN_SLUGS": False,
+        "KNOWN_SLUGS_TTL": 300,
+        "RETENTION": {},
+        "SAMPLE_RATES": {},
+        "GAUGE_HISTORY_SIZE": 1000,
+        "GAUGE_HISTORY_MAX_AGE": 7 * 24 * 60 * 60,
+        "GAUGE_STATS": False,
+        "HISTOGRAM_BUCKETS": (
+            5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000,
+        ),
+        "REQUEST_METRICS_PREFIX": "view-",
+        "REQUEST_METRICS_COUNT_QUERIES": True,
     }
 
     # A mapping of our old settings names to the new name
@@ -76,7 +113,8 @@ class AppSettings:
             msg = "{} is deprecated, use REDIS_METRICS['{}'] instead."
             warnings.warn(msg.format(old_key, key), DeprecationWarning, stacklevel=2)
             return getattr(settings, old_key)
-        except AttributeError:
+        except (AttributeError, KeyError):
+            # Newer settings have no old name.
             pass
 
         # Fall back to the app's defaults.
@@ -0,0 +1,544 @@
+"""
+Client-side sharding of metrics across several Redis instances.
+
+When the SHARDS setting lists more than one Redis server, ``utils.get_r()``
+returns a ``ShardedR``. It has the same API as ``R``, but each slug is
+assigned to one of the shards by consistent hashing (see ``HashRing``), and
+all of that slug's keys -- metrics, gauges, timers and unique counts -- are
+stored on its shard. The sets of slugs are split the same way: each shard's
+``metric-slugs`` set holds the slugs it owns, and a category's set on each
+shard holds that shard's slugs in the category.
+
+Commands are routed by ``ShardedClient``, which stands in for the Redis client
+at ``R.r``, so ``R``'s methods (and the buffers, writer, recorder and agent
+that queue commands on its pipelines) work unchanged. Commands that span
+several shards, like an ``MGET`` for many slugs or reading a set of slugs, are
+sent to each shard concurrently and their results are merged.
+
+Adding or removing a shard moves some slugs to another shard. Run the
+``redis_metrics_rebalance`` management command afterwards to move their data
+(see ``ShardedR.rebalance``).
+
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect
+import hashlib
+import os
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+
+from . import scripts
+from .keys import get_schema
+from .models import R
+from .settings import app_settings
+
+# The prefixes of the keys built for a slug: metrics, gauges (and their
+# history and statistics), timer histograms and unique counts.
+KEY_PREFIXES = ("m:", "g:", "gh:", "gs:", "t:", "u:")
+
+
+class HashRing(object):
+    """A consistent hash ring. Each node is placed on the ring at
+    ``replicas`` points, and a key belongs to the node at the first point
+    after the key's own hash, so adding or removing a node only moves the
+    keys on either side of its points."""
+
+    def __init__(self, nodes, replicas=160):
+        self.nodes = list(nodes)
+        ring = []
+        for index, node in enumerate(self.nodes):
+            for replica in range(replicas):
+                ring.append((self._hash("{0}-{1}".format(node, replica)), index))
+        ring.sort()
+        self._points = [point for point, index in ring]
+        self._indexes = [index for point, index in ring]
+
+    def _hash(self, value):
+        digest = hashlib.md5(value.encode("utf-8")).digest()
+        return int.from_bytes(digest[:8], "big")
+
+    def get(self, key):
+        """Returns the index of the node that owns ``key``."""
+        position = bisect(self._points, self._hash(key)) % len(self._points)
+        return self._indexes[position]
+
+
+def _sum(results):
+    return sum(result or 0 for result in results)
+
+
+def _union(results):
+    merged = set()
+    for result in results:
+        merged.update(result or ())
+    return merged
+
+
+def _concat(results):
+    merged = []
+    for result in results:
+        merged.extend(result or ())
+    return merged
+
+
+def _first(results):
+    return results[0] if results else None
+
+
+class ShardedClient(object):
+    """Stands in for a Redis client, sending each command to the shard that
+    owns its key.
+
+    * Keys built for a slug (e.g. ``m:<slug>:<yyyy-mm-dd>``) belong to the
+      slug's shard.
+    * The sets of slugs, and each category's set of slugs, are split by
+      member: ``SADD``/``SREM`` go to each member's shard, and ``SMEMBERS``
+      returns the union of every shard's set.
+    * The set of category names is split by category name.
+    * ``MGET``, ``DELETE`` and ``KEYS`` are sent to each shard that's
+      involved, concurrently, and their results are merged.
+
+    """
+
+    def __init__(self, clients, names, slug_set_keys, categories_key,
+                 category_prefix="c:"):
+        self.clients = list(clients)
+        self.ring = HashRing(names)
+        self.slug_set_keys = frozenset(slug_set_keys)
+        self.categories_key = categories_key
+        self.category_prefix = category_prefix
+        self._pid = None
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def shard_for_slug(self, slug):
+        """Returns the index of the shard that stores ``slug``."""
+        return self.ring.get(get_schema().slugify(slug))
+
+    def shard_for_key(self, key):
+        """Returns the index of the shard that stores ``key``. For the keys
+        built for a slug, that's the slug's shard."""
+        parts = key.split(":", 2)
+        slug = parts[1].strip("{}") if len(parts) > 1 else key
+        return self.ring.get(slug)
+
+    def _member_router(self, key):
+        """Returns a function mapping members of the set at ``key`` to their
+        shard, or None if ``key`` isn't split by member."""
+        if key in self.slug_set_keys or key.startswith(self.category_prefix):
+            return self.shard_for_slug
+        if key == self.categories_key:
+            return self.ring.get
+        return None
+
+    def _plan(self, command, args, kwargs):
+        """Splits a command into the parts to send to each shard. Returns a
+        list of ``(shard, args, kwargs)`` and a function that merges the
+        results of those parts."""
+        if command == "mget":
+            keys = list(args)
+            if len(args) == 1 and isinstance(args[0], (list, tuple)):
+                keys = list(args[0])
+            by_shard = OrderedDict()
+            for key in keys:
+                by_shard.setdefault(self.shard_for_key(key), []).append(key)
+            parts = [(shard, (shard_keys,), {}) for shard, shard_keys in by_shard.items()]
+
+            def reorder(results):
+                values = {}
+                for shard_keys, result in zip(by_shard.values(), results):
+                    values.update(zip(shard_keys, result))
+                return [values[key] for key in keys]
+            return parts, reorder
+
+        if command == "delete":
+            by_shard = OrderedDict()
+            for key in args:
+                if self._member_router(key) is None:
+                    shards = [self.shard_for_key(key)]
+                else:  # Split by member, so it's on every shard.
+                    shards = range(len(self.clients))
+                for shard in shards:
+                    by_shard.setdefault(shard, []).append(key)
+            parts = [(shard, tuple(keys), {}) for shard, keys in by_shard.items()]
+            return parts, _sum
+
+        if command == "keys":
+            return [(shard, args, kwargs) for shard in range(len(self.clients))], _concat
+
+        key = args[0] if args else kwargs.get("name")
+        router = self._member_router(key) if key is not None else None
+        if router is not None:
+            if command in ("sadd", "srem"):
+                by_shard = OrderedDict()
+                for member in args[1:]:
+                    by_shard.setdefault(router(member), []).append(member)
+                parts = [
+                    (shard, (key,) + tuple(members), kwargs)
+                    for shard, members in by_shard.items()
+                ]
+                return parts, _sum
+            if command == "sismember":
+                return [(router(args[1]), args, kwargs)], _first
+            if command == "smembers":
+                parts = [(shard, args, kwargs) for shard in range(len(self.clients))]
+                return parts, _union
+            parts = [(shard, args, kwargs) for shard in range(len(self.clients))]
+            return parts, _sum if command == "scard" else _first
+
+        return [(self.shard_for_key(key), args, kwargs)], _first
+
+    def _map(self, function, items):
+        """Calls ``function`` for each of ``items``, concurrently if there's
+        more than one, and returns the results in order."""
+        items = list(items)
+        if len(items) < 2:
+            return [function(item) for item in items]
+        return list(self._get_executor().map(function, items))
+
+    def _get_executor(self):
+        """Returns the thread pool used to fan out to the shards. It's
+        created again in a forked child, which doesn't inherit its threads."""
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=len(self.clients),
+                        thread_name_prefix="redis-metrics-shard",
+                    )
+                    self._pid = os.getpid()
+        return self._executor
+
+    def pipeline(self, transaction=False, shard_hint=None):
+        """Returns a ``ShardedPipeline``. Pipelines are never transactions
+        across shards."""
+        return ShardedPipeline(self)
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            parts, merge = self._plan(name, args, kwargs)
+            results = self._map(
+                lambda part: getattr(self.clients[part[0]], name)(*part[1], **part[2]),
+                parts
+            )
+            return merge(results)
+        command.__name__ = name
+        return command
+
+
+class ShardedPipeline(object):
+    """A pipeline that queues each command on a pipeline for its shard (see
+    ``ShardedClient``). ``execute`` runs the shards' pipelines concurrently,
+    and returns the results in the order the commands were queued."""
+
+    def __init__(self, client):
+        self.client = client
+        self._pipes = OrderedDict()  # {shard: pipeline}
+        self._sizes = {}  # {shard: number of commands queued}
+        self._commands = []  # [([(shard, position), ...], merge), ...]
+
+    def shard_pipeline(self, shard):
+        """Returns the underlying pipeline for a shard."""
+        pipe = self._pipes.get(shard)
+        if pipe is None:
+            pipe = self._pipes[shard] = self.client.clients[shard].pipeline(
+                transaction=False
+            )
+            self._sizes[shard] = 0
+        return pipe
+
+    def queue(self, shard, queue_command, merge=_first):
+        """Queues one command on a shard's pipeline by calling
+        ``queue_command`` with it."""
+        queue_command(self.shard_pipeline(shard))
+        self._commands.append(([(shard, self._sizes[shard])], merge))
+        self._sizes[shard] += 1
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        def command(*args, **kwargs):
+            parts, merge = self.client._plan(name, args, kwargs)
+            positions = []
+            for shard, part_args, part_kwargs in parts:
+                getattr(self.shard_pipeline(shard), name)(*part_args, **part_kwargs)
+                positions.append((shard, self._sizes[shard]))
+                self._sizes[shard] += 1
+            self._commands.append((positions, merge))
+            return self
+        command.__name__ = name
+        return command
+
+    def __len__(self):
+        return len(self._commands)
+
+    def execute(self, raise_on_error=True):
+        pipes = list(self._pipes.items())
+        results = dict(zip(
+            [shard for shard, pipe in pipes],
+            self.client._map(
+                lambda item: item[1].execute(raise_on_error=raise_on_error),
+                pipes
+            )
+        ))
+        merged = [
+            merge([results[shard][position] for shard, position in positions])
+            for positions, merge in self._commands
+        ]
+        self.reset()
+        return merged
+
+    def reset(self):
+        for pipe in self._pipes.values():
+            pipe.reset()
+        self._pipes = OrderedDict()
+        self._sizes = {}
+        self._commands = []
+
+
+def shard_name(shard):
+    """The name that places a shard on the hash ring: its NAME, or else
+    "<host>:<port>/<db>". Changing it moves the shard's slugs."""
+    if shard.get("NAME"):
+        return shard["NAME"]
+    return "{0}:{1}/{2}".format(
+        shard.get("HOST", app_settings.HOST),
+        shard.get("PORT", app_settings.PORT),
+        shard.get("DB", app_settings.DB),
+    )
+
+
+class ShardedR(R):
+    """An ``R`` that stores each slug on one of several Redis servers.
+
+    Accepts the same keyword arguments as ``R``, except for the connection
+    arguments: each shard is described by a dict in ``shards`` (set in
+    settings.REDIS_METRICS['SHARDS']) with any of the HOST, PORT, DB,
+    PASSWORD, SSL and SOCKET_TIMEOUT keys, and optionally a NAME (see
+    ``shard_name``).
+
+    """
+
+    def __init__(self, shards=None, **kwargs):
+        self.shard_settings = list(app_settings.SHARDS if shards is None else shards)
+        if not self.shard_settings:
+            raise ImproperlyConfigured("ShardedR needs at least one shard in SHARDS")
+        kwargs['connection_class'] = None
+        kwargs['cluster'] = False
+        kwargs['read_replicas'] = ()
+        super(ShardedR, self).__init__(**kwargs)
+
+    def _connect(self, **kwargs):
+        self.shards = []
+        for shard in self.shard_settings:
+            shard_kwargs = dict(kwargs)
+            shard_kwargs.update((k.lower(), v) for k, v in shard.items() if k != "NAME")
+            shard_kwargs.setdefault('connection_pool', None)
+            self.shards.append(R(
+                connection_class=None,
+                cluster=False,
+                read_replicas=(),
+                **shard_kwargs
+            ))
+        return ShardedClient(
+            [shard.r for shard in self.shards],
+            [shard_name(shard) for shard in self.shard_settings],
+            slug_set_keys=[
+                self._metric_slugs_key,
+                self._gauge_slugs_key,
+                self._timer_slugs_key,
+                self._unique_slugs_key,
+            ],
+            categories_key=self._categories_key,
+            category_prefix=self._category_key(""),
+        )
+
+    def shard(self, slug):
+        """Returns the ``R`` instance for the shard that stores ``slug``."""
+        return self.shards[self.r.shard_for_slug(slug)]
+
+    def _use_scripts(self):
+        """The METRIC and SET_METRIC scripts add the category to the set of
+        categories on the slug's shard, but that set is split by category
+        name, so USE_LUA_SCRIPTS is ignored."""
+        return False
+
+    def _run_script(self, source, keys, args):
+        # The last key of each script is always one of the slug's own keys.
+        shard = self.r.shard_for_key(keys[-1])
+        return self.shards[shard]._run_script(source, keys, args)
+
+    def _queue_script(self, pipe, source, keys, args):
+        shard = self.r.shard_for_key(keys[-1])
+        pipe.queue(
+            shard,
+            lambda shard_pipe: self.shards[shard]._queue_script(
+                shard_pipe, source, keys, args
+            )
+        )
+
+    def metric_slugs_by_category(self):
+        """Like ``R.metric_slugs_by_category``, but reads every category
+        (from all shards, concurrently) in one pipeline."""
+        categories = sorted(self.categories())
+        pipe = self.r.pipeline()
+        for category in categories:
+            pipe.smembers(self._category_key(category))
+        pipe.smembers(self._metric_slugs_key)
+        results = pipe.execute()
+        result = OrderedDict(zip(categories, results[:-1]))
+        return self._add_uncategorized(result, results[-1])
+
+    def rebalance(self, sources=(), dry_run=False, batch_size=500):
+        """Moves any data that's stored on the wrong shard, e.g. after a shard
+        was added to SHARDS, to the shard that now owns it.
+
+        * ``sources`` -- (optional) Redis clients for servers that aren't
+          shards anymore; everything on them is moved to the shards.
+        * ``dry_run`` -- count what would be moved, without moving it.
+        * ``batch_size`` -- the number of keys to fetch per SCAN.
+
+        When a key already exists on its new shard (because it was written
+        after the shards changed), the two are merged: counts, timer and
+        gauge statistics, unique counts, sets and gauge histories are
+        combined, and the new shard's current gauge value is kept.
+
+        Returns a dict with the number of ``keys`` and of set ``members``
+        moved from each shard.
+
+        """
+        moved = {"keys": 0, "members": 0}
+        servers = [(i, shard.r) for i, shard in enumerate(self.shards)]
+        servers.extend((None, source) for source in sources)
+        for index, client in servers:
+            for key in self._scan_own_keys(client, batch_size):
+                router = self.r._member_router(key)
+                if router is not None:
+                    moved["members"] += self._rebalance_members(
+                        client, index, key, router, dry_run
+                    )
+                    continue
+                owner = self.r.shard_for_key(key)
+                if owner == index:
+                    continue
+                if dry_run or _move_key(client, self.shards[owner].r, key):
+                    moved["keys"] += 1
+        return moved
+
+    def _scan_own_keys(self, client, batch_size):
+        """Yields the keys on ``client`` that belong to this app, leaving
+        anything else in a shared database (sessions, cache entries...)
+        alone."""
+        sharded = self.r
+        prefixes = KEY_PREFIXES + (sharded.category_prefix,)
+        for prefix in prefixes:
+            for key in client.scan_iter(match=prefix + "*", count=batch_size):
+                yield key
+        for key in sorted(sharded.slug_set_keys) + [sharded.categories_key]:
+            if client.exists(key):
+                yield key
+
+    def _rebalance_members(self, client, index, key, router, dry_run):
+        """Moves the members of a set of slugs (or categories) that belong on
+        other shards; returns the number moved."""
+        by_shard = {}
+        for member in client.smembers(key):
+            owner = router(member)
+            if owner != index:
+                by_shard.setdefault(owner, []).append(member)
+        count = 0
+        for owner, members in by_shard.items():
+            count += len(members)
+            if not dry_run:
+                self.shards[owner].r.sadd(key, *members)
+                client.srem(key, *members)
+        return count
+
+
+def _number(value):
+    """Parses a Redis string as an int if possible, or else a float."""
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _move_key(source, target, key):
+    """Moves ``key`` from the ``source`` client to ``target``, keeping its
+    TTL, or merges it into the existing key on ``target``. Returns False if
+    the key expired (or was deleted) before it could be moved."""
+    if not target.exists(key):
+        ttl = source.pttl(key)
+        data = source.dump(key)
+        if ttl == -2 or data is None:
+            return False
+        target.restore(key, ttl if ttl > 0 else 0, data, replace=True)
+        source.delete(key)
+        return True
+
+    kind = source.type(key)
+    if kind == "none":
+        return False
+    prefix = key.split(":", 1)[0]
+    if kind == "string" and prefix == "u":
+        # HyperLogLogs can only be merged on the same server.
+        data = source.dump(key)
+        if data is None:
+            return False
+        temporary = "{0}:rebalance".format(key)
+        target.restore(temporary, 0, data, replace=True)
+        target.pfmerge(key, key, temporary)
+        target.delete(temporary)
+    elif kind == "string" and prefix != "g":
+        value = source.get(key)
+        if value is None:
+            return False
+        value = _number(value)
+        if isinstance(value, int):
+            target.incrby(key, value)
+        else:
+            target.incrbyfloat(key, value)
+    elif kind == "hash" and prefix == "gs":
+        _merge_gauge_stats(target, key, source.hgetall(key))
+    elif kind == "hash":
+        # HINCRBY fails on a field that holds a float on either side.
+        current = target.hgetall(key)
+        pipe = target.pipeline(transaction=False)
+        for field, value in source.hgetall(key).items():
+            value = _number(value)
+            if isinstance(value, int) and isinstance(_number(current.get(field, 0)), int):
+                pipe.hincrby(key, field, value)
+            else:
+                pipe.hincrbyfloat(key, field, value)
+        pipe.execute()
+    elif kind == "set":
+        members = source.smembers(key)
+        if members:
+            target.sadd(key, *members)
+    elif kind == "zset":
+        members = dict(source.zrange(key, 0, -1, withscores=True))
+        if members:
+            target.zadd(key, members)
+    source.delete(key)
+    return True
+
+
+def _merge_gauge_stats(target, key, stats):
+    """Merges a hash of gauge statistics (see ``scripts.GAUGE_STATS``) into
+    the one at ``key`` on ``target``, keeping its "last" value. The sum may
+    be a float, and the minimum and maximum are compared in Redis, so gauges
+    written to ``key`` meanwhile aren't lost."""
+    target.register_script(scripts.MERGE_GAUGE_STATS)(keys=[key], args=[
+        stats.get("count", 0),
+        stats.get("sum", 0),
+        stats.get("min", ""),
+        stats.get("max", ""),
+    ])
@@ -81,6 +81,43 @@ def gauge(slug, maximum=9000, size=200, coerce='float'):
     }
 
 
+@register.inclusion_tag("redis_metrics/_gauge_history.html")
+def gauge_history(slug, since=None, to=None, with_data_table=False):
+    """Template Tag to display a gauge's recorded values over time.
+
+    * ``slug`` -- the gauge's unique slug
+    * ``since`` -- a datetime object or a string string matching one of the
+      following patterns: "YYYY-mm-dd" for a date or "YYYY-mm-dd HH:MM:SS" for
+      a date & time.
+    * ``to`` -- the date until which to show values, in the same format.
+    * ``with_data_table`` -- if True, prints the raw data in a table.
+
+    """
+    r = get_r()
+    try:
+        if since and len(since) == 10:  # yyyy-mm-dd
+            since = datetime.strptime(since, "%Y-%m-%d")
+        elif since and len(since) == 19:  # yyyy-mm-dd HH:MM:ss
+            since = datetime.strptime(since, "%Y-%m-%d %H:%M:%S")
+
+        if to and len(to) == 10:  # yyyy-mm-dd
+            to = datetime.strptime(to, "%Y-%m-%d")
+        elif to and len(to) == 19:  # yyyy-mm-dd HH:MM:ss
+            to = datetime.strptime(to, "%Y-%m-%d %H:%M:%S")
+
+    except (TypeError, ValueError):
+        # assume we got a datetime object or leave since = None
+        pass
+
+    return {
+        'since': since,
+        'to': to,
+        'slug': slug,
+        'gauge_history': r.get_gauge_history(slug, since=since, to=to),
+        'with_data_table': with_data_table,
+    }
+
+
 @register.inclusion_tag("redis_metrics/_metric_list.html")
 def metric_list():
     r = get_r()
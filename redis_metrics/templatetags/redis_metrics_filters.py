@@ -68,6 +68,7 @@ def metric_slug(value):
     * Converts ``m:foo:w:<num>`` to ``foo``
     * Converts ``m:foo:m:<yyyy-mm>`` to ``foo``
     * Converts ``m:foo:y:<yyyy>`` to ``foo``
+    * Converts ``m:{foo}:y:<yyyy>`` (with HASH_TAG_KEYS) to ``foo``
 
     """
-    return value.split(":")[1]
+    return value.split(":")[1].strip("{}")
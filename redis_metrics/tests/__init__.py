@@ -1,6 +1,22 @@
+from .test_agent import TestAgent, TestMetricAggregator
+from .test_aio import TestAsyncR
+from .test_breaker import (
+    TestAsyncRWithCircuitBreaker,
+    TestCircuitBreaker,
+    TestRWithCircuitBreaker,
+)
+from .test_buffer import TestMetricBuffer
+from .test_cluster import TestCluster
 from .test_forms import TestAggregateMetricForm, TestMetricCategoryForm
-from .test_models import TestR
+from .test_keys import TestKeySchema
+from .test_middleware import TestRequestMetricsMiddleware
+from .test_models import TestR, TestRCluster
+from .test_recorder import TestCallRecorder
+from .test_registry import TestSlugRegistry
+from .test_replicas import TestReplicaPool, TestRWithReplicas
 from .test_settings import TestAppSettings
+from .test_sharding import TestHashRing, TestShardedR
 from .test_templatetags import TestTemplateTags, TestTemplateFilters
 from .test_views import TestViews
+from .test_writer import TestBackgroundWriter
 from .test_utils import TestUtils
@@ -0,0 +1,176 @@
+from __future__ import unicode_literals
+from datetime import datetime
+import socket
+import threading
+
+try:
+    from unittest.mock import call, patch
+except ImportError:
+    from mock import call, patch
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from redis.exceptions import ConnectionError
+
+from ..agent import Agent, MetricAggregator
+from ..models import R
+
+
+TEST_SETTINGS = {
+    "HOST": "localhost",
+    "PORT": 6379,
+    "DB": 0,
+    "PASSWORD": None,
+    "SOCKET_TIMEOUT": None,
+    "SOCKET_CONNECTION_POOL": None,
+    "MIN_GRANULARITY": "daily",
+    "MAX_GRANULARITY": "yearly",
+    "MONDAY_FIRST_DAY_OF_WEEK": False,
+    "USE_ISO_WEEK_NUMBER": False,
+}
+
+
+class TestMetricAggregator(TestCase):
+    """Tests for the ``MetricAggregator`` class."""
+
+    def test_feed_counters(self):
+        agg = MetricAggregator()
+        agg.feed(b"foo:1|c\nfoo:2|c\nbar:1|c|@0.1\n")
+        agg.feed(b"foo:3|c")
+        self.assertEqual(agg.lines, 4)
+        self.assertEqual(agg.parse_errors, 0)
+        self.assertEqual(agg.take(), ({"foo": 6, "bar": 10}, {}))
+        self.assertEqual(agg.take(), ({}, {}))
+
+    def test_feed_gauges(self):
+        agg = MetricAggregator()
+        agg.feed(b"load:1.5|g\nload:2.25|g")
+        self.assertEqual(agg.take(), ({}, {"load": "2.25"}))
+
+    def test_feed_parse_errors(self):
+        agg = MetricAggregator()
+        agg.feed(
+            b"nope\n"
+            b":1|c\n"
+            b"foo:x|c\n"
+            b"foo:1|ms\n"
+            b"foo:1|c|0.5\n"
+            b"foo:1|c|@0\n"
+            b"foo:abc|g\n"
+            b"foo:1|c"
+        )
+        self.assertEqual(agg.lines, 8)
+        self.assertEqual(agg.parse_errors, 7)
+        self.assertEqual(agg.take(), ({"foo": 1}, {}))
+
+    def test_feed_non_finite_values(self):
+        agg = MetricAggregator()
+        agg.feed(
+            b"foo:nan|c\n"
+            b"foo:inf|c\n"
+            b"foo:-inf|c\n"
+            b"foo:1e400|c\n"
+            b"foo:1|c|@1e-320\n"
+            b"load:nan|g\n"
+            b"load:inf|g\n"
+            b"foo:1|c"
+        )
+        self.assertEqual(agg.parse_errors, 7)
+        self.assertEqual(agg.take(), ({"foo": 1}, {}))
+
+    def test_feed_overflowing_total(self):
+        agg = MetricAggregator()
+        agg.feed(b"foo:1e308|c\nfoo:1e308|c")
+        self.assertEqual(agg.parse_errors, 1)
+        self.assertEqual(agg.take(), ({"foo": int(1e308)}, {}))
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestAgent(TestCase):
+    """Tests for the ``Agent`` class."""
+
+    def setUp(self):
+        self.redis_patcher = patch("redis_metrics.models.redis.StrictRedis")
+        mock_StrictRedis = self.redis_patcher.start()
+        self.redis = mock_StrictRedis.return_value
+        self.pipe = self.redis.pipeline.return_value
+        self.r = R()
+        self.agent = Agent(self.r, port=0, flush_interval=60)
+
+    def tearDown(self):
+        self.agent.close()
+        self.redis_patcher.stop()
+        super(TestAgent, self).tearDown()
+
+    @patch("redis_metrics.agent.datetime")
+    def test_flush(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2014, 7, 2, 12, 6, 34)
+        self.agent.aggregator.feed(b"foo:2|c\nfoo:3|c\nload:0.5|g")
+        self.agent.flush()
+
+        self.redis.pipeline.assert_called_with(transaction=False)
+        self.pipe.assert_has_calls([
+            call.sadd("metric-slugs", "foo"),
+            call.incr("m:foo:2014-07-02", 5),
+            call.incr("m:foo:w:2014-26", 5),
+            call.incr("m:foo:m:2014-07", 5),
+            call.incr("m:foo:y:2014", 5),
+            call.execute(),
+            call.sadd("gauge-slugs", "load"),
+            call.set("g:load", "0.5"),
+            call.zadd("gh:load", {"1404302794.000000:0.5": 1404302794.0}),
+            call.zremrangebyrank("gh:load", 0, -1001),
+            call.zremrangebyscore("gh:load", "-inf", "(1403697994.0"),
+            call.expire("gh:load", 604800),
+            call.execute(),
+        ])
+        self.assertEqual(self.agent.stats()["flushes"], 1)
+
+    def test_flush_when_empty(self):
+        self.agent.flush()
+        self.assertFalse(self.redis.pipeline.called)
+
+    def test_flush_with_redis_error(self):
+        self.pipe.execute.side_effect = ConnectionError
+        self.agent.aggregator.feed(b"foo:1|c")
+        with self.assertLogs("redis_metrics.agent", level="ERROR"):
+            self.agent.flush()
+        stats = self.agent.stats()
+        self.assertEqual(stats["write_errors"], 1)
+        self.assertEqual(stats["flushes"], 0)
+
+    def test_flush_with_other_error(self):
+        self.agent.aggregator.feed(b"foo:1|c\nbar:nan|c")
+        self.agent.aggregator.counters[b"baz"] = float("nan")
+        with self.assertLogs("redis_metrics.agent", level="ERROR"):
+            self.agent.flush()
+        self.assertEqual(self.agent.stats()["write_errors"], 1)
+
+        # The agent keeps going.
+        self.agent.aggregator.feed(b"foo:1|c")
+        self.agent.flush()
+        self.assertEqual(self.agent.stats()["flushes"], 1)
+
+    def test_serve_forever(self):
+        self.agent.bind()
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        for i in range(100):
+            client.sendto(b"foo:1|c\nbar:2|c", self.agent.address)
+
+        flushed = threading.Event()
+        self.agent.flush_interval = 0.01
+        thread = threading.Thread(
+            target=self.agent.serve_forever,
+            kwargs={"on_flush": lambda agent: flushed.set()}
+        )
+        thread.start()
+        self.assertTrue(flushed.wait(5))
+        self.agent.stop()
+        thread.join(5)
+
+        stats = self.agent.stats()
+        self.assertEqual(stats["packets"], 100)
+        self.assertEqual(stats["lines"], 200)
+        self.pipe.incr.assert_any_call("m:foo:{0}".format(
+            datetime.utcnow().strftime("%Y-%m-%d")), 100)
@@ -0,0 +1,275 @@
+from __future__ import unicode_literals
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    from unittest.mock import AsyncMock, MagicMock, call, patch
+except ImportError:
+    from mock import AsyncMock, MagicMock, call, patch
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..aio import AsyncR
+from .. import scripts, utils
+
+
+TEST_SETTINGS = {
+    "HOST": "localhost",
+    "PORT": 6379,
+    "DB": 0,
+    "PASSWORD": None,
+    "SOCKET_TIMEOUT": None,
+    "SOCKET_CONNECTION_POOL": None,
+    "MIN_GRANULARITY": "daily",
+    "MAX_GRANULARITY": "yearly",
+    "MONDAY_FIRST_DAY_OF_WEEK": False,
+    "USE_ISO_WEEK_NUMBER": False,
+}
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestAsyncR(TestCase):
+    """Tests for the ``AsyncR`` class."""
+
+    def setUp(self):
+        self.redis_patcher = patch("redis_metrics.aio.redis.asyncio.StrictRedis")
+        mock_StrictRedis = self.redis_patcher.start()
+
+        # Commands on the client are coroutines, but building a pipeline
+        # isn't; only the pipeline's ``execute`` is awaited.
+        self.redis = MagicMock()
+        self.redis.smembers = AsyncMock()
+        self.redis.mget = AsyncMock()
+        self.redis.get = AsyncMock()
+        self.redis.keys = AsyncMock()
+        self.redis.zrangebyscore = AsyncMock()
+        self.pipe = MagicMock()
+        self.pipe.execute = AsyncMock()
+        self.redis.pipeline.return_value = self.pipe
+        mock_StrictRedis.return_value = self.redis
+
+        self.r = AsyncR()
+        self.date = datetime(2014, 7, 2, 12, 6, 34)
+
+    def tearDown(self):
+        self.redis_patcher.stop()
+        super(TestAsyncR, self).tearDown()
+
+    async def test_metric(self):
+        await self.r.metric("foo", 2, category="Stuff", expire=60, date=self.date)
+        self.pipe.assert_has_calls([
+            call.sadd("metric-slugs", "foo"),
+            call.sadd("c:Stuff", "foo"),
+            call.sadd("categories", "Stuff"),
+            call.incr("m:foo:2014-07-02", 2),
+            call.expire("m:foo:2014-07-02", 60),
+            call.incr("m:foo:w:2014-26", 2),
+            call.expire("m:foo:w:2014-26", 60),
+            call.incr("m:foo:m:2014-07", 2),
+            call.expire("m:foo:m:2014-07", 60),
+            call.incr("m:foo:y:2014", 2),
+            call.expire("m:foo:y:2014", 60),
+            call.execute(),
+        ])
+        self.pipe.execute.assert_awaited_once_with()
+
+    async def test_metrics_bulk(self):
+        recorded = await self.r.metrics_bulk(
+            [("foo", 1, self.date), ("foo", 2, self.date), ("bar", 1, self.date)]
+        )
+        self.assertEqual(recorded, 3)
+        self.pipe.incr.assert_any_call("m:foo:2014-07-02", 3)
+        self.pipe.incr.assert_any_call("m:bar:2014-07-02", 1)
+        self.pipe.execute.assert_awaited_once_with()
+
+    async def test_metric_with_lua_script(self):
+        script = AsyncMock()
+        self.redis.register_script.return_value = script
+        settings = dict(TEST_SETTINGS, USE_LUA_SCRIPTS=True)
+        with override_settings(REDIS_METRICS=settings):
+            await self.r.metric("foo", date=self.date)
+            await self.r.metric("foo", date=self.date)
+
+        self.redis.register_script.assert_called_once_with(scripts.METRIC)
+        self.assertEqual(script.await_count, 2)
+        self.assertFalse(self.pipe.execute.called)
+
+    async def test_metric_with_known_slugs_cache(self):
+        settings = dict(TEST_SETTINGS, CACHE_KNOWN_SLUGS=True)
+        with override_settings(REDIS_METRICS=settings):
+            await self.r.metric("foo", category="Stuff", date=self.date)
+            await self.r.metric("foo", category="Stuff", date=self.date)
+        self.assertEqual(self.pipe.sadd.call_count, 3)
+        self.assertEqual(self.pipe.execute.await_count, 2)
+
+    async def test_set_metric(self):
+        await self.r.set_metric("foo", 42, date=self.date)
+        self.pipe.assert_has_calls([
+            call.sadd("metric-slugs", "foo"),
+            call.set("m:foo:2014-07-02", 42),
+            call.set("m:foo:w:2014-26", 42),
+            call.set("m:foo:m:2014-07", 42),
+            call.set("m:foo:y:2014", 42),
+            call.execute(),
+        ])
+
+    async def test_get_metric(self):
+        self.redis.mget.return_value = [1, 2, 3, 4]
+        with patch.object(self.r, "_build_keys") as mock_build_keys:
+            mock_build_keys.return_value = ["k1", "k2", "k3", "k4"]
+            result = await self.r.get_metric("foo")
+
+        self.redis.mget.assert_awaited_once_with(["k1", "k2", "k3", "k4"])
+        self.assertEqual(
+            result,
+            OrderedDict([("daily", 1), ("weekly", 2), ("monthly", 3), ("yearly", 4)])
+        )
+
+    async def test_get_metrics(self):
+        self.redis.mget.return_value = [1, 2, 3, 4, None, None, None, None]
+        result = await self.r.get_metrics(["foo", "bar"])
+        self.redis.mget.assert_awaited_once_with(
+            self.r._build_keys("foo") + self.r._build_keys("bar")
+        )
+        self.assertEqual(
+            result,
+            [("foo", {"day": 1, "week": 2, "month": 3, "year": 4})]
+        )
+
+    async def test_get_metric_history(self):
+        self.redis.mget.return_value = [1, None]
+        keys = ["m:foo:2014-07-01", "m:foo:2014-07-02"]
+        with patch.object(self.r, "_metric_history_keys") as mock_history_keys:
+            mock_history_keys.return_value = keys
+            result = await self.r.get_metric_history("foo")
+
+        self.assertEqual(result, [(keys[0], 1), (keys[1], 0)])
+
+    async def test_get_metric_history_as_columns(self):
+        self.redis.mget.return_value = ["1", None]
+        keys = ["m:foo:2014-07-01", "m:foo:2014-07-02"]
+        with patch.object(self.r, "_metric_history_keys") as mock_history_keys:
+            mock_history_keys.return_value = keys
+            result = await self.r.get_metric_history_as_columns(["foo"])
+
+        self.assertEqual(
+            result, [("Period", "foo"), ("2014-07-01", "1"), ("2014-07-02", 0)]
+        )
+
+    async def test_metric_slugs_by_category(self):
+        self.redis.smembers.return_value = {"Bar", "Foo"}
+        self.pipe.execute.return_value = [{"b"}, {"f"}, {"b", "f", "x"}]
+        result = await self.r.metric_slugs_by_category()
+        self.assertEqual(
+            result,
+            OrderedDict([("Bar", {"b"}), ("Foo", {"f"}), ("Uncategorized", ["x"])])
+        )
+        self.assertEqual(self.pipe.execute.await_count, 1)
+
+    async def test_delete_metric(self):
+        self.redis.keys.return_value = ["m:foo:2014-07-02"]
+        await self.r.delete_metric("foo")
+        self.pipe.assert_has_calls([
+            call.delete("m:foo:2014-07-02"),
+            call.srem("metric-slugs", "foo"),
+            call.execute(),
+        ])
+
+    async def test_gauge(self):
+        await self.r.gauge("foo", 10, date=datetime(2014, 7, 2, 12, 6, 34))
+        self.pipe.assert_has_calls([
+            call.sadd("gauge-slugs", "foo"),
+            call.set("g:foo", 10),
+            call.zadd("gh:foo", {"1404302794.000000:10": 1404302794.0}),
+            call.zremrangebyrank("gh:foo", 0, -1001),
+            call.zremrangebyscore("gh:foo", "-inf", "(1403697994.0"),
+            call.expire("gh:foo", 604800),
+            call.execute(),
+        ])
+
+        self.redis.get.return_value = 10
+        self.assertEqual(await self.r.get_gauge("foo"), 10)
+        self.redis.get.assert_awaited_once_with("g:foo")
+
+        self.redis.zrangebyscore.return_value = [("1404302794.000000:10", 1404302794.0)]
+        self.assertEqual(
+            await self.r.get_gauge_history("foo", since=datetime(2014, 7, 2)),
+            [(datetime(2014, 7, 2, 12, 6, 34), "10")],
+        )
+        self.redis.zrangebyscore.assert_awaited_once_with(
+            "gh:foo", 1404259200.0, "+inf", withscores=True
+        )
+
+    async def test_gauge_with_stats(self):
+        script = AsyncMock()
+        script.sha = "sha"
+        self.redis.register_script.return_value = script
+        self.pipe.scripts = set()
+        settings = dict(TEST_SETTINGS, GAUGE_STATS=True, GAUGE_HISTORY_SIZE=0)
+        with override_settings(REDIS_METRICS=settings):
+            await self.r.gauge("queue", 12, date=self.date)
+
+        self.redis.register_script.assert_called_once_with(scripts.GAUGE_STATS)
+        self.assertEqual(self.pipe.scripts, {script})
+        self.pipe.evalsha.assert_called_once_with(
+            "sha", 4,
+            "gs:queue:2014-07-02", "gs:queue:w:2014-26",
+            "gs:queue:m:2014-07", "gs:queue:y:2014",
+            12, 0, 0, 0, 0,
+        )
+        self.assertFalse(script.called)
+        self.pipe.execute.assert_awaited_once_with()
+
+    async def test_get_gauge_stats(self):
+        self.pipe.execute.return_value = [
+            {"count": "2", "sum": "10", "min": "3", "max": "7", "last": "7"},
+            {}, {}, {},
+        ]
+        stats = await self.r.get_gauge_stats("queue", self.date)
+        self.assertEqual(stats["daily"]["avg"], 5.0)
+        self.assertIsNone(stats["yearly"])
+        self.pipe.hgetall.assert_any_call("gs:queue:2014-07-02")
+
+    async def test_timing(self):
+        settings = dict(TEST_SETTINGS, HISTOGRAM_BUCKETS=(10, 100))
+        with override_settings(REDIS_METRICS=settings):
+            await self.r.timing("view", 5, date=self.date)
+        self.pipe.assert_has_calls([
+            call.sadd("timer-slugs", "view"),
+            call.hincrby("t:view:2014-07-02", "10", 1),
+            call.hincrby("t:view:2014-07-02", "count", 1),
+            call.hincrbyfloat("t:view:2014-07-02", "sum", 5),
+        ])
+        self.pipe.execute.assert_awaited_once_with()
+
+        self.pipe.execute.return_value = [{"10": "1", "count": "1", "sum": "5"}]
+        with override_settings(REDIS_METRICS=settings):
+            histogram = await self.r.get_timing(
+                "view", since=self.date, to=self.date
+            )
+        self.assertEqual(histogram["count"], 1)
+        self.assertEqual(histogram["p50"], 5.0)
+
+    async def test_unique(self):
+        await self.r.unique("visitors", "alice", date=self.date)
+        self.pipe.assert_has_calls([
+            call.sadd("unique-slugs", "visitors"),
+            call.pfadd("u:visitors:2014-07-02", "alice"),
+            call.pfadd("u:visitors:w:2014-26", "alice"),
+        ])
+        self.pipe.execute.assert_awaited_once_with()
+
+        self.redis.pfcount = AsyncMock(return_value=7)
+        count = await self.r.get_unique_count(
+            "visitors", since=self.date, to=self.date
+        )
+        self.assertEqual(count, 7)
+        self.redis.pfcount.assert_awaited_once_with("u:visitors:2014-07-02")
+
+    async def test_utils_ametric(self):
+        utils._async_redis_model = None
+        await utils.ametric("foo", date=self.date)
+        self.pipe.execute.assert_awaited_once_with()
+        self.assertIsInstance(utils.get_async_r(), AsyncR)
+        utils._async_redis_model = None
@@ -0,0 +1,234 @@
+from __future__ import unicode_literals
+from datetime import datetime
+
+try:
+    from unittest.mock import AsyncMock, MagicMock, patch
+except ImportError:
+    from mock import AsyncMock, MagicMock, patch
+
+from asgiref.sync import async_to_sync
+from django.test import TestCase
+from django.test.utils import override_settings
+from redis.exceptions import ConnectionError
+
+from ..aio import AsyncR
+from ..breaker import CircuitBreaker, CircuitOpenError
+from ..buffer import MetricBuffer
+from ..models import R
+
+
+TEST_SETTINGS = {
+    "HOST": "localhost",
+    "PORT": 6379,
+    "DB": 0,
+    "PASSWORD": None,
+    "SOCKET_TIMEOUT": None,
+    "SOCKET_CONNECTION_POOL": None,
+    "MIN_GRANULARITY": "daily",
+    "MAX_GRANULARITY": "yearly",
+    "MONDAY_FIRST_DAY_OF_WEEK": False,
+    "USE_ISO_WEEK_NUMBER": False,
+    "CIRCUIT_BREAKER": True,
+    "WRITE_TIMEOUT": 0.5,
+    "BREAKER_FAILURES": 2,
+    "BREAKER_RESET_TIMEOUT": 30,
+    "BREAKER_SPOOL_SIZE": 100,
+}
+
+
+class TestCircuitBreaker(TestCase):
+    """Tests for the ``CircuitBreaker`` class."""
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(failures=2, reset_timeout=30, budget=0.5)
+
+    def test_opens_after_consecutive_failures(self):
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(0.1, ConnectionError("down"))
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record(0.1)  # A success resets the count
+        self.assertEqual(self.breaker.state, "closed")
+
+        for _ in range(2):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record(0.1, ConnectionError("down"))
+        self.assertEqual(self.breaker.state, "open")
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.stats(), {
+            "state": "open",
+            "consecutive_failures": 2,
+            "calls": 4,
+            "errors": 3,
+            "timeouts": 0,
+            "rejected": 1,
+            "opened": 1,
+            "last_error": "down",
+        })
+
+    def test_slow_writes_count_as_failures(self):
+        self.breaker.record(0.6)
+        self.breaker.record(0.7)
+        self.assertEqual(self.breaker.state, "open")
+        self.assertEqual(self.breaker.timeouts, 2)
+
+    @patch("redis_metrics.breaker.time.monotonic")
+    def test_probe(self, mock_monotonic):
+        mock_monotonic.return_value = 100
+        self.breaker.record(0.6)
+        self.breaker.record(0.6)
+
+        # After the reset timeout, only one probe is let through.
+        mock_monotonic.return_value = 130
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, "half-open")
+        self.assertFalse(self.breaker.allow())
+
+        # A failed probe opens the circuit again...
+        self.assertFalse(self.breaker.record(0.1, ConnectionError()))
+        self.assertEqual(self.breaker.state, "open")
+        self.assertFalse(self.breaker.allow())
+
+        # ...and a successful one closes it.
+        mock_monotonic.return_value = 160
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.record(0.1))
+        self.assertEqual(self.breaker.state, "closed")
+        self.assertTrue(self.breaker.allow())
+
+    def test_abandoned_probe(self):
+        self.breaker.record(0.6)
+        self.breaker.record(0.6)
+        self.breaker.reset_timeout = 0
+        self.assertTrue(self.breaker.allow())
+        self.breaker.abandon()
+        self.assertEqual(self.breaker.state, "open")
+        self.assertTrue(self.breaker.allow())  # The next write probes instead
+        self.assertTrue(self.breaker.record(0.1))
+        self.assertEqual(self.breaker.state, "closed")
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestRWithCircuitBreaker(TestCase):
+    """Tests for ``R`` with CIRCUIT_BREAKER."""
+
+    def setUp(self):
+        self.redis_patcher = patch("redis_metrics.models.redis.StrictRedis")
+        self.mock_StrictRedis = self.redis_patcher.start()
+        self.redis = self.mock_StrictRedis.return_value
+        self.pipe = self.redis.pipeline.return_value
+        self.r = R()
+        self.date = datetime(2014, 7, 2, 12, 6, 34)
+
+    def tearDown(self):
+        self.redis_patcher.stop()
+        super(TestRWithCircuitBreaker, self).tearDown()
+
+    def _fail(self):
+        self.pipe.execute.side_effect = ConnectionError("down")
+        self.r.metric("foo", date=self.date)
+        self.r.gauge("bar", 1)
+        self.assertEqual(self.r.breaker.state, "open")
+        self.pipe.reset_mock()
+        self.redis.reset_mock()
+
+    def test__init__uses_write_timeout(self):
+        self.assertEqual(self.r.socket_timeout, 0.5)
+        self.assertEqual(
+            self.mock_StrictRedis.call_args[1]["socket_timeout"], 0.5
+        )
+        with override_settings(REDIS_METRICS=dict(TEST_SETTINGS, CIRCUIT_BREAKER=False)):
+            r = R()
+        self.assertIsNone(r.breaker)
+        self.assertIsNone(r.socket_timeout)
+        self.assertIsNone(r.circuit_stats())
+
+    def test_errors_are_not_raised(self):
+        self.pipe.execute.side_effect = ConnectionError("down")
+        self.assertIsNone(self.r.metric("foo", date=self.date))
+        self.assertEqual(self.r.breaker.errors, 1)
+
+    def test_open_circuit_skips_writes(self):
+        self._fail()
+        self.r.gauge("bar", 2)
+        self.r.timing("baz", 10)
+        self.r.unique("qux", "a")
+        self.r.set_metric("foo", 1)
+        self.assertFalse(self.redis.pipeline.called)
+        self.assertEqual(self.r.breaker.rejected, 4)
+
+    def test_metrics_are_spooled_while_open(self):
+        self._fail()
+        self.r.metric("foo", 2, date=self.date)
+        self.r.metric("foo", 3, date=self.date)
+        self.assertFalse(self.redis.pipeline.called)
+        stats = self.r.circuit_stats()
+        self.assertEqual(stats["state"], "open")
+        self.assertEqual(stats["spooled"], 4)  # daily through yearly
+
+        # The spool is written once a probe succeeds.
+        self.pipe.execute.side_effect = None
+        self.r.breaker.reset_timeout = 0
+        self.r.gauge("bar", 1)
+        self.assertEqual(self.r.breaker.state, "closed")
+        self.pipe.incr.assert_any_call("m:foo:2014-07-02", 5)
+        self.assertEqual(self.r.circuit_stats()["spooled"], 0)
+
+    def test_probe_that_raises_another_error(self):
+        self._fail()
+        self.pipe.execute.side_effect = None
+        self.r.breaker.reset_timeout = 0
+        with self.assertRaises(TypeError):
+            self.r.metric("foo", date="bad")
+        self.assertEqual(self.r.breaker.state, "open")
+
+        self.r.gauge("bar", 1)
+        self.assertEqual(self.r.breaker.state, "closed")
+        self.r.gauge("bar", 2)
+        self.assertEqual(self.pipe.execute.call_count, 2)
+
+    def test_spool_size(self):
+        self._fail()
+        with override_settings(REDIS_METRICS=dict(TEST_SETTINGS, BREAKER_SPOOL_SIZE=4)):
+            self.r.metric("foo", date=self.date)
+            self.r.metric("bar", date=self.date)
+        self.assertEqual(self.r.circuit_stats()["spooled"], 4)
+
+    def test_write_counts_raises_while_open(self):
+        self._fail()
+        with self.assertRaises(CircuitOpenError):
+            self.r.metrics_bulk({"foo": 1})
+
+        # ``MetricBuffer`` counts them as dropped.
+        buffer = MetricBuffer(self.r)
+        buffer.metric("foo", date=self.date)
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(buffer.dropped, 1)
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestAsyncRWithCircuitBreaker(TestCase):
+    """Tests for ``AsyncR`` with CIRCUIT_BREAKER."""
+
+    def setUp(self):
+        self.redis_patcher = patch("redis_metrics.aio.redis.asyncio.StrictRedis")
+        mock_StrictRedis = self.redis_patcher.start()
+        self.redis = MagicMock()
+        self.pipe = MagicMock()
+        self.pipe.execute = AsyncMock(side_effect=ConnectionError("down"))
+        self.redis.pipeline.return_value = self.pipe
+        mock_StrictRedis.return_value = self.redis
+        self.r = AsyncR()
+
+    def tearDown(self):
+        self.redis_patcher.stop()
+        super(TestAsyncRWithCircuitBreaker, self).tearDown()
+
+    def test_open_circuit_skips_writes(self):
+        @async_to_sync
+        async def run():
+            for _ in range(3):
+                await self.r.metric("foo")
+        run()
+        self.assertEqual(self.pipe.execute.await_count, 2)
+        self.assertEqual(self.r.circuit_stats()["rejected"], 1)
+        self.assertEqual(self.r.circuit_stats()["spooled"], 0)
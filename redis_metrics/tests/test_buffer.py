@@ -0,0 +1,176 @@
+from __future__ import unicode_literals
+from datetime import datetime
+
+try:
+    from unittest.mock import call, patch
+except ImportError:
+    from mock import call, patch
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from redis.exceptions import ConnectionError
+
+from ..buffer import MetricBuffer
+from ..models import R
+from .. import utils
+
+
+TEST_SETTINGS = {
+    "HOST": "localhost",
+    "PORT": 6379,
+    "DB": 0,
+    "PASSWORD": None,
+    "SOCKET_TIMEOUT": None,
+    "SOCKET_CONNECTION_POOL": None,
+    "MIN_GRANULARITY": "daily",
+    "MAX_GRANULARITY": "yearly",
+    "MONDAY_FIRST_DAY_OF_WEEK": False,
+    "USE_ISO_WEEK_NUMBER": False,
+    "WRITE_MODE": "buffered",
+    "BUFFER_MAX_SIZE": 100,
+    "BUFFER_FLUSH_INTERVAL": 60,
+}
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestMetricBuffer(TestCase):
+    """Tests for the ``MetricBuffer`` class."""
+
+    def setUp(self):
+        self.redis_patcher = patch("redis_metrics.models.redis.StrictRedis")
+        mock_StrictRedis = self.redis_patcher.start()
+        self.redis = mock_StrictRedis.return_value
+        self.pipe = self.redis.pipeline.return_value
+        self.r = R()
+        self.buffer = MetricBuffer(self.r)
+        self.date = datetime(2014, 7, 2, 12, 6, 34)
+
+    def tearDown(self):
+        self.buffer.flush()  # Stops its timer
+        self.redis_patcher.stop()
+        super(TestMetricBuffer, self).tearDown()
+
+    def test__init__with_default_settings(self):
+        self.assertEqual(self.buffer.max_size, 100)
+        self.assertEqual(self.buffer.flush_interval, 60)
+
+    def test_metric_does_not_write(self):
+        self.buffer.metric("foo", date=self.date)
+        self.assertFalse(self.redis.pipeline.called)
+        self.assertEqual(self.buffer.depth, 4)  # daily through yearly
+
+    def test_metric_sums_increments_per_key(self):
+        self.buffer.metric("foo", date=self.date)
+        self.buffer.metric("foo", 4, date=self.date)
+        self.buffer.metric("foo", 2, date=datetime(2014, 7, 3))
+        self.assertEqual(self.buffer._counts["m:foo:2014-07-02"], 5)
+        self.assertEqual(self.buffer._counts["m:foo:2014-07-03"], 2)
+        self.assertEqual(self.buffer._counts["m:foo:y:2014"], 7)
+        self.assertEqual(self.buffer.stats()["pending"], 3)
+
+    def test_flush(self):
+        self.buffer.metric("foo", 2, category="Stuff", date=self.date)
+        self.buffer.metric("foo", 3, expire=60, date=self.date)
+        self.assertEqual(self.buffer.flush(), 2)
+
+        self.redis.pipeline.assert_called_once_with(transaction=False)
+        self.pipe.assert_has_calls(
+            [
+                call.sadd("metric-slugs", "foo"),
+                call.sadd("c:Stuff", "foo"),
+                call.sadd("categories", "Stuff"),
+                call.incr("m:foo:2014-07-02", 5),
+                call.expire("m:foo:2014-07-02", 60),
+                call.incr("m:foo:w:2014-26", 5),
+                call.expire("m:foo:w:2014-26", 60),
+                call.incr("m:foo:m:2014-07", 5),
+                call.expire("m:foo:m:2014-07", 60),
+                call.incr("m:foo:y:2014", 5),
+                call.expire("m:foo:y:2014", 60),
+                call.execute(),
+            ]
+        )
+        self.assertEqual(self.buffer.depth, 0)
+        self.assertEqual(self.buffer.stats()["flushed"], 2)
+        self.assertEqual(self.buffer.stats()["flushes"], 1)
+
+    def test_flush_with_retention(self):
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["RETENTION"] = {"daily": 86400}
+        with override_settings(REDIS_METRICS=test_settings):
+            self.buffer.metric("foo", date=self.date)
+            self.buffer.flush()
+        self.pipe.expire.assert_called_once_with("m:foo:2014-07-02", 86400)
+
+    def test_flush_when_empty(self):
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertFalse(self.redis.pipeline.called)
+
+    def test_flush_on_max_size(self):
+        self.buffer.max_size = 8
+        self.buffer.metric("foo", date=self.date)
+        self.assertFalse(self.pipe.execute.called)
+        self.buffer.metric("bar", date=self.date)
+        self.pipe.execute.assert_called_once_with()
+        self.assertEqual(self.buffer.depth, 0)
+
+    def test_flush_on_interval(self):
+        self.buffer.flush_interval = 0
+        self.buffer.metric("foo", date=self.date)
+        self.pipe.execute.assert_called_once_with()
+
+    def test_flush_on_timer(self):
+        self.buffer.flush_interval = 0.05
+        self.buffer.metric("foo", date=self.date)
+        self.buffer.metric("bar", date=self.date)
+        self.assertFalse(self.pipe.execute.called)
+        self.buffer._timer.join(1)
+        self.pipe.execute.assert_called_once_with()
+        self.assertEqual(self.buffer.depth, 0)
+        self.assertIsNone(self.buffer._timer)
+
+    def test_flush_cancels_timer(self):
+        self.buffer.metric("foo", date=self.date)
+        timer = self.buffer._timer
+        self.assertTrue(timer.is_alive())
+        self.buffer.flush()
+        timer.join(1)
+        self.assertFalse(timer.is_alive())
+        self.pipe.execute.assert_called_once_with()
+
+    def test_no_timer_for_infinite_interval(self):
+        buffer = MetricBuffer(self.r, max_size=float("inf"),
+                              flush_interval=float("inf"))
+        with patch("threading.excepthook") as excepthook:
+            buffer.metric("foo", date=self.date)
+            self.assertIsNone(buffer._timer)
+            self.assertEqual(buffer.flush(), 1)
+        self.assertFalse(excepthook.called)
+
+    def test_flush_drops_metrics_on_redis_error(self):
+        self.pipe.execute.side_effect = ConnectionError
+        self.buffer.metric("foo", date=self.date)
+        self.buffer.metric("bar", date=self.date)
+        with self.assertLogs("redis_metrics.buffer", level="ERROR"):
+            self.assertEqual(self.buffer.flush(), 0)
+
+        stats = self.buffer.stats()
+        self.assertEqual(stats["dropped"], 2)
+        self.assertEqual(stats["flushed"], 0)
+        self.assertEqual(stats["depth"], 0)
+
+    def test_utils_metric_uses_buffer(self):
+        utils._redis_model = None
+        utils._metric_buffer = None
+        with patch("redis_metrics.utils._at_exit") as mock_at_exit:
+            utils.metric("foo", date=self.date)
+            buffer = utils.get_buffer()
+            mock_at_exit.assert_called_once_with(buffer.flush)
+
+        self.assertEqual(buffer.depth, 4)
+        self.assertFalse(self.redis.pipeline.called)
+
+        utils.flush_metrics()
+        self.pipe.execute.assert_called_once_with()
+        utils._metric_buffer = None
+        utils._redis_model = None
@@ -0,0 +1,251 @@
+"""
+Tests that run ``R`` and ``AsyncR`` against a real Redis Cluster.
+
+The cluster (three primaries, with no replicas) is started on free local ports
+from ``redis-server`` for the duration of the tests, which are skipped if it
+isn't installed.
+
+"""
+from __future__ import unicode_literals
+from datetime import datetime
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import unittest
+
+import redis
+from redis.crc import key_slot, REDIS_CLUSTER_HASH_SLOTS
+
+from asgiref.sync import async_to_sync
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..aio import AsyncR
+from ..models import R
+
+
+NODES = 3
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class LocalCluster(object):
+    """Starts a Redis Cluster of ``size`` primaries in a temporary
+    directory."""
+
+    def __init__(self, size=NODES):
+        self.size = size
+        self.ports = []
+        self.processes = []
+        self.directory = None
+
+    def start(self, timeout=30):
+        self.directory = tempfile.mkdtemp(prefix="redis-metrics-cluster-")
+        for _ in range(self.size):
+            port = _free_port()
+            self.ports.append(port)
+            self.processes.append(subprocess.Popen(
+                [
+                    "redis-server",
+                    "--port", str(port),
+                    "--bind", "127.0.0.1",
+                    "--cluster-enabled", "yes",
+                    "--cluster-config-file", "nodes-{0}.conf".format(port),
+                    "--dir", self.directory,
+                    "--save", "",
+                    "--appendonly", "no",
+                ],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            ))
+        clients = [self._client(port, timeout) for port in self.ports]
+
+        # Split the hash slots between the nodes, and introduce them.
+        per_node = REDIS_CLUSTER_HASH_SLOTS // self.size
+        for i, client in enumerate(clients):
+            start = i * per_node
+            end = REDIS_CLUSTER_HASH_SLOTS if i == self.size - 1 else start + per_node
+            client.execute_command("CLUSTER ADDSLOTS", *range(start, end))
+        for port in self.ports[1:]:
+            clients[0].execute_command("CLUSTER MEET", "127.0.0.1", port)
+
+        deadline = time.monotonic() + timeout
+        while not all(self._ready(client) for client in clients):
+            if time.monotonic() > deadline:
+                raise RuntimeError("The Redis Cluster didn't come up")
+            time.sleep(0.1)
+
+    def _client(self, port, timeout):
+        client = redis.StrictRedis(port=port, decode_responses=True)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                client.ping()
+                return client
+            except redis.ConnectionError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def _ready(self, client):
+        info = client.execute_command("CLUSTER INFO")
+        if isinstance(info, dict):
+            state, known = info["cluster_state"], info["cluster_known_nodes"]
+        else:
+            info = dict(
+                line.split(":", 1) for line in info.splitlines() if ":" in line
+            )
+            state, known = info["cluster_state"], info["cluster_known_nodes"]
+        return state == "ok" and int(known) == self.size
+
+    def stop(self):
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait(10)
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+
+@unittest.skipUnless(shutil.which("redis-server"), "redis-server is not installed")
+class TestCluster(TestCase):
+    """Tests for ``R`` and ``AsyncR`` with CLUSTER and HASH_TAG_KEYS."""
+
+    @classmethod
+    def setUpClass(cls):
+        super(TestCluster, cls).setUpClass()
+        cls.cluster = LocalCluster()
+        try:
+            cls.cluster.start()
+        except Exception:
+            cls.cluster.stop()
+            raise
+        cls.settings = {
+            "HOST": "127.0.0.1",
+            "PORT": cls.cluster.ports[0],
+            "CLUSTER": True,
+            "HASH_TAG_KEYS": True,
+            "MIN_GRANULARITY": "daily",
+            "MAX_GRANULARITY": "yearly",
+            "GAUGE_STATS": True,
+        }
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.cluster.stop()
+        super(TestCluster, cls).tearDownClass()
+
+    def setUp(self):
+        self.override = override_settings(REDIS_METRICS=self.settings)
+        self.override.enable()
+        self.r = R()
+        self.r.r.flushall(target_nodes=self.r.r.PRIMARIES)
+        self.slugs = ["slug-{0}".format(i) for i in range(20)]
+        self.date = datetime(2014, 7, 2, 12, 6, 34)
+
+    def tearDown(self):
+        self.r.r.close()
+        self.override.disable()
+        super(TestCluster, self).tearDown()
+
+    def test_slugs_keys_share_a_slot(self):
+        for slug in self.slugs:
+            self.r.metric(slug, date=self.date)
+            self.r.timing(slug, 10, date=self.date)
+            slots = set(
+                key_slot(key.encode())
+                for key in self.r._scan_keys("*{" + slug + "}*")
+            )
+            self.assertEqual(len(slots), 1)
+
+        # The slugs are spread across the cluster's nodes.
+        nodes = set(
+            self.r.r.get_node_from_key(self.r._build_keys(slug)[0]).name
+            for slug in self.slugs
+        )
+        self.assertGreater(len(nodes), 1)
+
+    def test_metric_history(self):
+        for i, slug in enumerate(self.slugs):
+            self.r.metric(slug, i + 1, date=self.date)
+        history = self.r.get_metric_history(
+            self.slugs,
+            since=self.date,
+            to=self.date,
+            granularity="monthly",
+        )
+        self.assertEqual(
+            dict(history),
+            dict(
+                ("m:{{{0}}}:m:2014-07".format(slug), str(i + 1))
+                for i, slug in enumerate(self.slugs)
+            ),
+        )
+
+    def test_set_metric_and_delete_metric(self):
+        self.r.set_metric("foo", 5, expire=60, date=self.date)
+        self.assertEqual(
+            self.r.get_metric_history("foo", since=self.date, to=self.date),
+            [("m:{foo}:2014-07-02", "5")],
+        )
+        self.r.delete_metric("foo")
+        self.assertEqual(self.r._scan_keys("m:{foo}:*"), [])
+        self.assertNotIn("foo", self.r.metric_slugs())
+
+    def test_gauge_stats(self):
+        self.r.gauge("load", 1, date=self.date)
+        self.r.gauge("load", 3, date=self.date)
+        stats = self.r.get_gauge_stats("load", date=self.date)
+        self.assertEqual(stats["daily"]["count"], 2)
+        self.assertEqual(stats["daily"]["avg"], 2)
+        self.r.delete_gauge("load")
+        self.assertEqual(self.r._scan_keys("*{load}*"), [])
+
+    def test_unique_count(self):
+        self.r.unique("visitors", ["a", "b"], date=self.date)
+        self.r.unique("visitors", ["b", "c"], date=datetime(2014, 7, 3))
+        count = self.r.get_unique_count(
+            "visitors",
+            since=self.date,
+            to=datetime(2014, 7, 3),
+        )
+        self.assertEqual(count, 3)
+
+    def test_async(self):
+        @async_to_sync
+        async def run():
+            r = AsyncR()
+            try:
+                for i, slug in enumerate(self.slugs):
+                    await r.metric(slug, i + 1, date=self.date)
+                history = await r.get_metric_history(
+                    self.slugs,
+                    since=self.date,
+                    to=self.date,
+                    granularity="yearly",
+                )
+                await r.delete_metric(self.slugs[0])
+                remaining = await r._scan_keys("m:*")
+            finally:
+                await r.close()
+            return history, remaining
+
+        history, remaining = run()
+        self.assertEqual(
+            dict(history),
+            dict(
+                ("m:{{{0}}}:y:2014".format(slug), str(i + 1))
+                for i, slug in enumerate(self.slugs)
+            ),
+        )
+        # Each of the remaining slugs has a daily, weekly, monthly and yearly
+        # key.
+        self.assertEqual(len(remaining), 4 * (len(self.slugs) - 1))
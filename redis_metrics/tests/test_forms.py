@@ -14,7 +14,7 @@ class TestAggregateMetricForm(TestCase):
         """Test that form has choices populated from R.metric_slugs"""
         # Set up a mock result for R.metric_slugs
         config = {'return_value.metric_slugs.return_value': ['test-slug']}
-        with patch('redis_metrics.forms.R', **config) as mock_R:
+        with patch('redis_metrics.forms.get_r', **config) as mock_R:
             form = AggregateMetricForm()
             mock_R.assert_has_calls([
                 call(),
@@ -29,7 +29,7 @@ class TestAggregateMetricForm(TestCase):
         """Verify we get expected results from cleaned_data"""
         # Set up a mock result for R.metric_slugs
         config = {'return_value.metric_slugs.return_value': ['test-slug']}
-        with patch('redis_metrics.forms.R', **config):
+        with patch('redis_metrics.forms.get_r', **config):
             form = AggregateMetricForm({"metrics": ["test-slug"]})
             self.assertTrue(form.is_valid())
             self.assertEqual(form.cleaned_data, {"metrics": ["test-slug"]})
@@ -46,7 +46,7 @@ class TestMetricCategoryForm(TestCase):
             'return_value.metric_slugs.return_value': ['test-slug'],
             'return_value._category_slugs.return_value': ['test-slug']
         }
-        with patch('redis_metrics.forms.R', **config) as mock_R:
+        with patch('redis_metrics.forms.get_r', **config) as mock_R:
             # No Category
             form = MetricCategoryForm()
             self.assertFalse(form.fields['metrics'].required)
@@ -85,7 +85,7 @@ class TestMetricCategoryForm(TestCase):
             'return_value.metric_slugs.return_value': ['test-slug'],
             'return_value._category_slugs.return_value': ['test-slug']
         }
-        with patch('redis_metrics.forms.R', **config):
+        with patch('redis_metrics.forms.get_r', **config):
             data = {
                 'category_name': 'Sample Data',
                 'metrics': ['test-slug'],
@@ -101,7 +101,7 @@ class TestMetricCategoryForm(TestCase):
             'return_value.metric_slugs.return_value': ['foo', 'bar', 'baz'],
             'return_value._category_slugs.return_value': ['foo', 'bar'],
         }
-        with patch('redis_metrics.forms.R', **k) as mock_R:
+        with patch('redis_metrics.forms.get_r', **k) as mock_R:
             data = {'category_name': 'Foo', 'metrics': ['foo', 'bar']}
             form = MetricCategoryForm(data)
             self.assertTrue(form.is_valid())
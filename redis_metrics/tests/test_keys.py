@@ -0,0 +1,237 @@
+from __future__ import unicode_literals
+from datetime import datetime, timedelta, timezone
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from .. import keys
+
+
+TEST_SETTINGS = {
+    "MIN_GRANULARITY": "seconds",
+    "MAX_GRANULARITY": "yearly",
+    "MONDAY_FIRST_DAY_OF_WEEK": False,
+    "USE_ISO_WEEK_NUMBER": False,
+    "SLUG_CACHE_SIZE": 10,
+}
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestKeySchema(TestCase):
+    """Tests for the ``KeySchema`` class."""
+
+    def setUp(self):
+        self.schema = keys.KeySchema.from_settings()
+        self.date = datetime(2014, 7, 2, 12, 6, 34)
+
+    def test_from_settings(self):
+        self.assertEqual(
+            self.schema.granularities,
+            ("seconds", "minutes", "hourly", "daily", "weekly", "monthly", "yearly"),
+        )
+        self.assertEqual(self.schema.weekly_date_format, "%Y-%U")
+        self.assertFalse(self.schema.use_iso_week_number)
+        self.assertEqual(self.schema.slugify.cache_info().maxsize, 10)
+
+    def test_granularities_range(self):
+        schema = keys.KeySchema("hourly", "weekly")
+        self.assertEqual(schema.granularities, ("hourly", "daily", "weekly"))
+
+    def test_period(self):
+        self.assertEqual(self.schema.period("hourly", self.date), "2014-07-02-12")
+        self.assertEqual(self.schema.period("weekly", self.date), "2014-26")
+
+        schema = keys.KeySchema(use_iso_week_number=True)
+        self.assertEqual(schema.period("weekly", datetime(2018, 12, 31)), "2019-1")
+
+    def test_periods_are_cached_for_the_current_second(self):
+        periods = self.schema.periods(self.date)
+        self.assertEqual(
+            periods,
+            (
+                "2014-07-02-12-06-34",
+                "2014-07-02-12-06",
+                "2014-07-02-12",
+                "2014-07-02",
+                "2014-26",
+                "2014-07",
+                "2014",
+            ),
+        )
+        with patch.object(self.schema, "period") as mock_period:
+            same_second = self.date.replace(microsecond=999)
+            self.assertIs(self.schema.periods(same_second), periods)
+            self.assertFalse(mock_period.called)
+
+            self.schema.periods(datetime(2014, 7, 2, 12, 6, 35))
+            self.assertEqual(mock_period.call_count, 7)
+
+    def test_periods_for_aware_dates_follow_wall_time(self):
+        utc = datetime(2014, 7, 2, 23, 6, 34, tzinfo=timezone.utc)
+        tokyo = utc.astimezone(timezone(timedelta(hours=9)))
+        self.assertEqual(utc, tokyo)  # The same instant
+        self.assertEqual(self.schema.periods(utc)[3], "2014-07-02")
+        self.assertEqual(self.schema.periods(tokyo)[3], "2014-07-03")
+
+    def test_build_keys(self):
+        self.assertEqual(
+            self.schema.build_keys("Test Slug", self.date),
+            [
+                "m:test-slug:s:2014-07-02-12-06-34",
+                "m:test-slug:i:2014-07-02-12-06",
+                "m:test-slug:h:2014-07-02-12",
+                "m:test-slug:2014-07-02",
+                "m:test-slug:w:2014-26",
+                "m:test-slug:m:2014-07",
+                "m:test-slug:y:2014",
+            ],
+        )
+        self.assertEqual(
+            self.schema.build_keys("Test Slug", self.date, "monthly"),
+            ["m:test-slug:m:2014-07"],
+        )
+
+    def test_build_keys_with_disabled_granularity(self):
+        schema = keys.KeySchema("daily", "yearly")
+        with self.assertRaises(KeyError):
+            schema.build_keys("test-slug", self.date, "hourly")
+
+    def test_build_keys_memoizes_slugs(self):
+        self.schema.build_keys("Test Slug", self.date)
+        self.schema.build_keys("Test Slug", self.date)
+        info = self.schema.slugify.cache_info()
+        self.assertEqual(info.misses, 1)
+        self.assertEqual(info.hits, 1)
+
+    def test_range_periods(self):
+        self.assertEqual(
+            self.schema.range_periods("hourly", self.date, 3),
+            ["2014-07-02-10", "2014-07-02-11", "2014-07-02-12"],
+        )
+        self.assertEqual(
+            self.schema.range_periods("minutes", datetime(2014, 1, 1), 2),
+            ["2013-12-31-23-59", "2014-01-01-00-00"],
+        )
+        self.assertEqual(
+            self.schema.range_periods("monthly", self.date, 40),
+            ["2014-05", "2014-06", "2014-07"],
+        )
+        self.assertEqual(self.schema.range_periods("daily", self.date, 0), [])
+        with self.assertRaises(KeyError):
+            keys.KeySchema("daily", "yearly").range_periods("hourly", self.date, 1)
+
+    def test_range_periods_match_strftime(self):
+        steps = {
+            "seconds": timedelta(seconds=1),
+            "minutes": timedelta(minutes=1),
+            "hourly": timedelta(hours=1),
+        }
+        for options in ({}, {"monday_first_day_of_week": True},
+                        {"use_iso_week_number": True}):
+            schema = keys.KeySchema("seconds", "yearly", **options)
+            for to in (datetime(2014, 1, 3, 0, 0, 1), datetime(2016, 1, 1, 0, 59),
+                       datetime(2019, 1, 5), datetime(2020, 12, 31, 23, 59, 59)):
+                for granularity in schema.granularities:
+                    step = steps.get(granularity, timedelta(days=1))
+                    expected = sorted(set(
+                        schema.period(granularity, to - step * i) for i in range(400)
+                    ))
+                    self.assertEqual(
+                        schema.range_periods(granularity, to, 400), expected,
+                        (options, to, granularity),
+                    )
+
+    def test_history_keys(self):
+        history_keys = self.schema.history_keys(
+            ["foo", "Bar", "foo"], "daily", ["2014-07-01", "2014-07-02"]
+        )
+        self.assertEqual(list(history_keys), [
+            "m:bar:2014-07-01",
+            "m:bar:2014-07-02",
+            "m:foo:2014-07-01",
+            "m:foo:2014-07-02",
+        ])
+
+    def test_hash_field(self):
+        self.assertFalse(self.schema.hashed)
+        self.assertTrue(keys.KeySchema(storage_layout="hashes").hashed)
+        for key in self.schema.build_keys("foo", self.date):
+            name, field = self.schema.hash_field(key)
+            self.assertEqual(key, "{0}:{1}".format(name.rsplit(":", 1)[0], field))
+        self.assertEqual(
+            self.schema.hash_field("m:foo:h:2014-07-02-12"),
+            ("m:foo:h:2014-07-02", "2014-07-02-12"),
+        )
+        self.assertEqual(
+            self.schema.hash_field("m:foo:2014-07-02"), ("m:foo:2014-07", "2014-07-02")
+        )
+        self.assertEqual(
+            self.schema.hash_field("m:foo:w:2019-1"), ("m:foo:w:2019", "2019-1")
+        )
+        self.assertEqual(self.schema.hash_field("m:foo:y:2014"), ("m:foo:y:", "2014"))
+
+    def test_hash_tags(self):
+        schema = keys.KeySchema("daily", "monthly", hash_tags=True)
+        self.assertEqual(schema.tag("foo"), "{foo}")
+        self.assertEqual(self.schema.tag("foo"), "foo")
+        self.assertEqual(
+            schema.build_keys("Test Slug", self.date),
+            [
+                "m:{test-slug}:2014-07-02",
+                "m:{test-slug}:w:2014-26",
+                "m:{test-slug}:m:2014-07",
+            ],
+        )
+        self.assertEqual(
+            schema.key("weekly", "foo", self.date), "m:{foo}:w:2014-26"
+        )
+        self.assertEqual(
+            schema.hash_field("m:{foo}:2014-07-02"), ("m:{foo}:2014-07", "2014-07-02")
+        )
+
+    def test_expires(self):
+        schema = keys.KeySchema(
+            "hourly",
+            retention={"hourly": 3600, "daily": timedelta(days=2), "yearly": 0}
+        )
+        self.assertEqual(schema.ttls, (3600, 172800, None, None, None))
+        self.assertEqual(schema.expires(), schema.ttls)
+        self.assertEqual(schema.expires(60), (60, 60, 60, 60, 60))
+        self.assertEqual(self.schema.expires(), (None,) * 7)
+
+    def test_bucket(self):
+        schema = keys.KeySchema(histogram_buckets=(100, 10, 2.5))
+        self.assertEqual(schema.buckets, (2.5, 10, 100))
+        self.assertEqual(schema.bucket_fields, ("2.5", "10", "100", "+Inf"))
+        self.assertEqual(schema.bucket(0), "2.5")
+        self.assertEqual(schema.bucket(10), "10")
+        self.assertEqual(schema.bucket(10.1), "100")
+        self.assertEqual(schema.bucket(1000), "+Inf")
+        self.assertEqual(keys.KeySchema().bucket(1), "+Inf")
+
+    def test_truncate(self):
+        d = datetime(2014, 7, 2, 12, 6, 34, 123)
+        self.assertEqual(self.schema.truncate(d), datetime(2014, 7, 2, 12, 6, 34))
+        self.assertEqual(
+            keys.KeySchema("hourly").truncate(d), datetime(2014, 7, 2, 12)
+        )
+        self.assertEqual(keys.KeySchema("monthly").truncate(d), datetime(2014, 7, 2))
+
+    def test_get_schema_is_rebuilt_when_settings_change(self):
+        schema = keys.get_schema()
+        self.assertIs(keys.get_schema(), schema)
+
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["MIN_GRANULARITY"] = "daily"
+        with override_settings(REDIS_METRICS=test_settings):
+            self.assertEqual(
+                keys.get_schema().granularities,
+                ("daily", "weekly", "monthly", "yearly"),
+            )
+        self.assertIsNot(keys.get_schema(), schema)
+        self.assertEqual(len(keys.get_schema().granularities), 7)
@@ -0,0 +1,137 @@
+from __future__ import unicode_literals
+import asyncio
+
+try:
+    from unittest.mock import call, patch
+except ImportError:
+    from mock import call, patch
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase
+from django.test.utils import override_settings
+from django.urls import ResolverMatch
+
+from ..middleware import RequestMetricsMiddleware, count_query
+
+
+TEST_SETTINGS = {
+    "REQUEST_METRICS_PREFIX": "view-",
+    "REQUEST_METRICS_COUNT_QUERIES": True,
+}
+
+
+def view(request):
+    pass
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestRequestMetricsMiddleware(TestCase):
+    """Tests for the ``RequestMetricsMiddleware`` class."""
+
+    def setUp(self):
+        self.recorder_patcher = patch("redis_metrics.middleware.get_recorder")
+        self.recorder = self.recorder_patcher.start().return_value
+        self.request = RequestFactory().get("/posts/1/")
+        self.request.resolver_match = ResolverMatch(
+            view, (), {"pk": 1}, url_name="post-detail", namespaces=["blog"]
+        )
+
+    def tearDown(self):
+        self.recorder_patcher.stop()
+        super(TestRequestMetricsMiddleware, self).tearDown()
+
+    def test_records_request(self):
+        def get_response(request):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.execute("SELECT 2")
+            return HttpResponse(status=201)
+
+        middleware = RequestMetricsMiddleware(get_response)
+        self.assertFalse(middleware.async_mode)
+        with patch("redis_metrics.middleware.time.perf_counter", side_effect=[1.0, 1.25]):
+            response = middleware(self.request)
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.recorder.count.call_args_list, [
+            call("view-blog-post-detail-requests"),
+            call("view-blog-post-detail-2xx"),
+            call("view-blog-post-detail-db-queries", 2),
+        ])
+        self.recorder.timing.assert_called_once_with(
+            "view-blog-post-detail-response-time", 250.0
+        )
+
+    def test_unresolved_request(self):
+        request = RequestFactory().get("/missing/")
+        middleware = RequestMetricsMiddleware(lambda r: HttpResponse(status=404))
+        middleware(request)
+        self.assertEqual(self.recorder.count.call_args_list, [
+            call("view-unresolved-requests"),
+            call("view-unresolved-4xx"),
+        ])
+
+    def test_without_counting_queries(self):
+        def get_response(request):
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return HttpResponse()
+
+        test_settings = dict(TEST_SETTINGS, REQUEST_METRICS_COUNT_QUERIES=False)
+        with override_settings(REDIS_METRICS=test_settings):
+            middleware = RequestMetricsMiddleware(get_response)
+        middleware(self.request)
+        self.assertEqual(self.recorder.count.call_count, 2)
+        self.assertEqual(connection.execute_wrappers, [])
+
+    def test_recording_errors_are_logged(self):
+        self.recorder.count.side_effect = ValueError
+        middleware = RequestMetricsMiddleware(lambda r: HttpResponse())
+        with self.assertLogs("redis_metrics.middleware", "ERROR"):
+            response = middleware(self.request)
+        self.assertEqual(response.status_code, 200)
+
+    def test_async_mode(self):
+        async def get_response(request):
+            return HttpResponse(status=503)
+
+        middleware = RequestMetricsMiddleware(get_response)
+        self.assertTrue(middleware.async_mode)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        response = async_to_sync(middleware)(self.request)
+        self.assertEqual(response.status_code, 503)
+        self.recorder.count.assert_any_call("view-blog-post-detail-5xx")
+        self.assertEqual(
+            self.recorder.timing.call_args[0][0],
+            "view-blog-post-detail-response-time"
+        )
+
+    def test_async_mode_counts_queries(self):
+        def query():
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+
+        async def get_response(request):
+            # Once in this thread, and once in another one.
+            await sync_to_async(query)()
+            await sync_to_async(query, thread_sensitive=False)()
+            return HttpResponse()
+
+        middleware = RequestMetricsMiddleware(get_response)
+        self.addCleanup(connection.execute_wrappers.remove, count_query)
+        self.addCleanup(
+            connection_created.disconnect,
+            dispatch_uid="redis_metrics_query_counter",
+        )
+        async_to_sync(middleware)(self.request)
+        self.recorder.count.assert_any_call("view-blog-post-detail-db-queries", 2)
+
+        # Queries outside of a request aren't counted.
+        self.recorder.reset_mock()
+        query()
+        async_to_sync(middleware)(self.request)
+        self.recorder.count.assert_any_call("view-blog-post-detail-db-queries", 2)
@@ -5,17 +5,22 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 from __future__ import unicode_literals
-from datetime import datetime, timedelta
+from collections import OrderedDict
+import unittest
+from datetime import datetime, timedelta, timezone
 
 try:
     from unittest.mock import call, patch, Mock
 except ImportError:
     from mock import call, patch, Mock
 
+import redis
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
 from django.test.utils import override_settings
 
-from ..models import R, dedupe
+from ..models import R, dedupe, numpy
+from .. import scripts
 
 
 TEST_SETTINGS = {
@@ -119,6 +124,34 @@ class TestR(TestCase):
             self.assertEqual(inst._gauge_slugs_key, "gauge-slugs")
             mock_redis.assert_called_once_with(**r_kwargs)
 
+    def test__init__with_blocking_pool(self):
+        """Test that BLOCKING_POOL creates a ``BlockingConnectionPool``."""
+        test_settings = dict(
+            TEST_SETTINGS, BLOCKING_POOL=True, MAX_CONNECTIONS=10, POOL_TIMEOUT=2
+        )
+        with override_settings(REDIS_METRICS=test_settings):
+            with patch("redis_metrics.models.redis.StrictRedis") as mock_redis:
+                inst = R()
+        pool = inst.connection_pool
+        self.assertIsInstance(pool, redis.BlockingConnectionPool)
+        self.assertEqual(pool.max_connections, 10)
+        self.assertEqual(pool.timeout, 2)
+        self.assertEqual(pool.connection_kwargs["host"], "localhost")
+        self.assertEqual(
+            mock_redis.call_args[1]["connection_pool"], pool
+        )
+
+    def test__init__with_max_connections(self):
+        """Test that MAX_CONNECTIONS limits the connection pool."""
+        test_settings = dict(TEST_SETTINGS, MAX_CONNECTIONS=10, SSL=True)
+        with override_settings(REDIS_METRICS=test_settings):
+            with patch("redis_metrics.models.redis.StrictRedis"):
+                inst = R()
+        pool = inst.connection_pool
+        self.assertIs(type(pool), redis.ConnectionPool)
+        self.assertEqual(pool.max_connections, 10)
+        self.assertIs(pool.connection_class, redis.SSLConnection)
+
     def test__date_range(self):
         """Tests ``R._date_range`` at various granularities *without* a
         ``since`` date."""
@@ -458,6 +491,74 @@ class TestR(TestCase):
             ]
         )
 
+    def test_metric_with_known_slugs_cache(self):
+        """With CACHE_KNOWN_SLUGS, a slug & category are only registered once."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["CACHE_KNOWN_SLUGS"] = True
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.metric("foo", category="Stuff")
+            self.r.metric("foo", category="Stuff")
+            self.r.set_metric("foo", 1, category="Stuff")
+            self.r.gauge("bar", 1)
+            self.r.gauge("bar", 2)
+
+        self.assertEqual(
+            self.redis.sadd.call_args_list,
+            [
+                call("metric-slugs", "foo"),
+                call("c:Stuff", "foo"),
+                call("categories", "Stuff"),
+            ]
+        )
+        self.assertEqual(
+            self.redis.pipeline().sadd.call_args_list,
+            [call("gauge-slugs", "bar")]
+        )
+        self.assertEqual(self.redis.pipeline().execute.call_count, 4)
+
+    def test_metric_without_known_slugs_cache(self):
+        self.r.metric("foo")
+        self.r.metric("foo")
+        self.assertEqual(self.redis.sadd.call_count, 2)
+
+    def test_deleting_invalidates_known_slugs(self):
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["CACHE_KNOWN_SLUGS"] = True
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.metric("foo", category="Stuff")
+            self.redis.keys.return_value = ["m:foo:y:2014"]
+            self.r.delete_metric("foo")
+            self.r.delete_category("Stuff")
+            self.redis.sadd.reset_mock()
+
+            self.r.metric("foo", category="Stuff")
+            self.redis.sadd.assert_has_calls([
+                call("metric-slugs", "foo"),
+                call("c:Stuff", "foo"),
+                call("categories", "Stuff"),
+            ])
+
+            self.r.gauge("bar", 1)
+            self.r.delete_gauge("bar")
+            self.r.gauge("bar", 1)
+            self.assertEqual(
+                self.redis.pipeline().sadd.call_args_list,
+                [call("gauge-slugs", "bar")] * 2
+            )
+
+    def test_known_slugs_are_registered_after_a_failed_pipeline(self):
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["CACHE_KNOWN_SLUGS"] = True
+        with override_settings(REDIS_METRICS=test_settings):
+            self.redis.pipeline().execute.side_effect = [Exception, None]
+            with self.assertRaises(Exception):
+                self.r.metrics_bulk([("foo", 1)])
+            self.r.metrics_bulk([("foo", 1)])
+            self.assertEqual(
+                self.redis.pipeline().sadd.call_args_list,
+                [call("metric-slugs", "foo")] * 2
+            )
+
     @patch.object(R, "_build_keys")
     def test_set_metric(self, mock_build_keys):
         """Test setting metrics using ``R.set_metric``."""
@@ -514,8 +615,8 @@ class TestR(TestCase):
         # get the metric keys so we can check for the appropriate calls
         self.r.set_metric(slug, value, expire=500)
 
-        # Verify that each key had an expiration set.
-        self.redis.expire.assert_has_calls(
+        # Verify that each key had an expiration set, in the same pipeline.
+        self.redis.pipeline().expire.assert_has_calls(
             [
                 call("m:test-slug:s:2000-01-02-11-45-30", 500),
                 call("m:test-slug:i:2000-01-02-11-45", 500),
@@ -526,6 +627,11 @@ class TestR(TestCase):
                 call("m:test-slug:y:2000", 500),
             ]
         )
+        self.redis.pipeline().mset.assert_called_once_with(
+            dict.fromkeys(mock_build_keys.return_value, 42)
+        )
+        self.redis.pipeline().execute.assert_called_once_with()
+        self.assertFalse(self.redis.expire.called)
 
     @patch.object(R, "_categorize")
     def test_set_metric_with_category(self, mock_categorize):
@@ -567,6 +673,96 @@ class TestR(TestCase):
         # Expiration should not have gotten called
         self.assertFalse(self.redis.expire.called)
 
+    def test_metric_with_retention(self):
+        """Keys expire according to the RETENTION setting, unless an explicit
+        ``expire`` is given."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["MIN_GRANULARITY"] = "hourly"
+        test_settings["RETENTION"] = {"hourly": 3600, "daily": 86400}
+        with override_settings(REDIS_METRICS=test_settings):
+            d = datetime(2014, 7, 2, 12, 6, 34)
+            self.r.metric("foo", date=d)
+            pipe = self.redis.pipeline()
+            self.assertEqual(
+                pipe.expire.call_args_list,
+                [call("m:foo:h:2014-07-02-12", 3600), call("m:foo:2014-07-02", 86400)]
+            )
+
+            pipe.reset_mock()
+            self.r.metric("foo", expire=60, date=d)
+            self.assertEqual(pipe.expire.call_count, 5)
+
+            pipe.reset_mock()
+            self.r.set_metric("foo", 1, date=d)
+            pipe.mset.assert_called_once_with({
+                "m:foo:h:2014-07-02-12": 1,
+                "m:foo:2014-07-02": 1,
+                "m:foo:w:2014-26": 1,
+                "m:foo:m:2014-07": 1,
+                "m:foo:y:2014": 1,
+            })
+            self.assertEqual(
+                pipe.expire.call_args_list,
+                [call("m:foo:h:2014-07-02-12", 3600), call("m:foo:2014-07-02", 86400)]
+            )
+            self.assertFalse(self.redis.expire.called)
+
+    def test_metric_with_retention_and_lua_script(self):
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["MIN_GRANULARITY"] = "daily"
+        test_settings["RETENTION"] = {"daily": 86400}
+        test_settings["USE_LUA_SCRIPTS"] = True
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.metric("foo", date=datetime(2014, 7, 2))
+            script = self.redis.register_script.return_value
+            self.assertEqual(
+                script.call_args[1]["args"],
+                ["foo", "", 1, 86400, 0, 0, 0]
+            )
+
+    @patch("redis_metrics.models.random.random")
+    def test_metric_with_sample_rate(self, mock_random):
+        """Sampled metrics are skipped or scaled up by 1 / sample_rate."""
+        mock_random.return_value = 0.5
+        self.r.metric("foo", sample_rate=0.25)
+        self.assertFalse(self.redis.sadd.called)
+        self.assertFalse(self.redis.pipeline.called)
+
+        mock_random.side_effect = [0.1, 0.99]
+        self.r.metric("foo", num=2, sample_rate=0.25)
+        self.redis.pipeline().incr.assert_called_with(
+            "m:foo:y:{0}".format(datetime.utcnow().year), 8
+        )
+
+    @patch("redis_metrics.models.random.random")
+    def test__sample(self, mock_random):
+        # 1 / 0.3 = 3.33..., so it rounds up a third of the time.
+        mock_random.side_effect = [0.0, 0.3]
+        self.assertEqual(self.r._sample("foo", 1, 0.3), 4)
+        mock_random.side_effect = [0.0, 0.4]
+        self.assertEqual(self.r._sample("foo", 1, 0.3), 3)
+
+        mock_random.reset_mock(side_effect=True)
+        self.assertEqual(self.r._sample("foo", 5, 1), 5)
+        self.assertFalse(mock_random.called)
+
+        mock_random.return_value = 0.0
+        self.assertIsNone(self.r._sample("foo", 5, 0))
+
+    def test__sample_is_unbiased(self):
+        total = sum(self.r._sample("foo", 1, 0.3) or 0 for i in range(30000))
+        self.assertAlmostEqual(total / 30000.0, 1, delta=0.05)
+
+    @patch("redis_metrics.models.random.random")
+    def test__sample_with_default_sample_rates(self, mock_random):
+        mock_random.return_value = 0.0
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["SAMPLE_RATES"] = {"hot-path": 0.5}
+        with override_settings(REDIS_METRICS=test_settings):
+            self.assertEqual(self.r._sample("hot-path", 1), 2)
+            self.assertEqual(self.r._sample("hot-path", 1, sample_rate=1), 1)
+            self.assertEqual(self.r._sample("other", 1), 1)
+
     def test_metric_with_overridden_granularities(self):
         test_settings = TEST_SETTINGS.copy()
         test_settings["MIN_GRANULARITY"] = "daily"
@@ -653,23 +849,229 @@ class TestR(TestCase):
         # Make sure nothing was categorized.
         self.assertFalse(mock_categorize.called)
 
+    def test_metric_with_lua_script(self):
+        """With USE_LUA_SCRIPTS, ``R.metric`` should make a single call to
+        the registered METRIC script."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["USE_LUA_SCRIPTS"] = True
+        with override_settings(REDIS_METRICS=test_settings):
+            d = datetime(2014, 7, 2, 12, 6, 34)
+            keys = self.r._build_keys("test-metric", date=d)
+            self.r.metric("test-metric", 5, category="Stuff", expire=60, date=d)
+            self.r.metric("test-metric", date=d)
+
+            # The script is only registered once.
+            self.redis.register_script.assert_called_once_with(scripts.METRIC)
+            script = self.redis.register_script.return_value
+            script_keys = ["metric-slugs", "categories", "c:Stuff"] + keys
+            self.assertEqual(
+                script.call_args_list[0],
+                call(keys=script_keys, args=["test-metric", "Stuff", 5] + [60] * 7),
+            )
+            script_keys = ["metric-slugs", "categories", "c:"] + keys
+            self.assertEqual(
+                script.call_args_list[1],
+                call(keys=script_keys, args=["test-metric", "", 1] + [0] * 7),
+            )
+            self.assertFalse(self.redis.sadd.called)
+            self.assertFalse(self.redis.pipeline.called)
+
+    def test_set_metric_with_lua_script(self):
+        """With USE_LUA_SCRIPTS, ``R.set_metric`` should make a single call
+        to the registered SET_METRIC script."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["USE_LUA_SCRIPTS"] = True
+        with override_settings(REDIS_METRICS=test_settings):
+            d = datetime(2014, 7, 2, 12, 6, 34)
+            keys = self.r._build_keys("test-metric", date=d)
+            self.r.set_metric("test-metric", 42, expire=500, date=d)
+
+            self.redis.register_script.assert_called_once_with(scripts.SET_METRIC)
+            script = self.redis.register_script.return_value
+            script.assert_called_once_with(
+                keys=["metric-slugs", "categories", "c:"] + keys,
+                args=["test-metric", "", 42] + [500] * 7,
+            )
+            self.assertFalse(self.redis.mset.called)
+            self.assertFalse(self.redis.expire.called)
+
+    def test_metric_with_hashes_storage_layout(self):
+        """In the "hashes" layout, ``R.metric`` increments hash fields."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["STORAGE_LAYOUT"] = "hashes"
+        with override_settings(REDIS_METRICS=test_settings):
+            d = datetime(2014, 7, 2, 12, 6, 34)
+            self.r.metric("test-metric", num=2, expire=60, date=d)
+            self.redis.assert_has_calls(
+                [
+                    call.sadd(self.r._metric_slugs_key, "test-metric"),
+                    call.pipeline(),
+                    call.pipeline().hincrby(
+                        "m:test-metric:s:2014-07-02-12-06", "2014-07-02-12-06-34", 2
+                    ),
+                    call.pipeline().expire("m:test-metric:s:2014-07-02-12-06", 60),
+                    call.pipeline().hincrby(
+                        "m:test-metric:i:2014-07-02-12", "2014-07-02-12-06", 2
+                    ),
+                    call.pipeline().expire("m:test-metric:i:2014-07-02-12", 60),
+                    call.pipeline().hincrby(
+                        "m:test-metric:h:2014-07-02", "2014-07-02-12", 2
+                    ),
+                    call.pipeline().expire("m:test-metric:h:2014-07-02", 60),
+                    call.pipeline().hincrby("m:test-metric:2014-07", "2014-07-02", 2),
+                    call.pipeline().expire("m:test-metric:2014-07", 60),
+                    call.pipeline().hincrby("m:test-metric:w:2014", "2014-26", 2),
+                    call.pipeline().expire("m:test-metric:w:2014", 60),
+                    call.pipeline().hincrby("m:test-metric:m:2014", "2014-07", 2),
+                    call.pipeline().expire("m:test-metric:m:2014", 60),
+                    call.pipeline().hincrby("m:test-metric:y:", "2014", 2),
+                    call.pipeline().expire("m:test-metric:y:", 60),
+                    call.pipeline().execute(),
+                ]
+            )
+            self.assertFalse(self.redis.pipeline().incr.called)
+
+    def test_set_metric_with_hashes_storage_layout(self):
+        """In the "hashes" layout, ``R.set_metric`` sets hash fields."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["STORAGE_LAYOUT"] = "hashes"
+        test_settings["MIN_GRANULARITY"] = "monthly"
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.set_metric("test-metric", 42, date=datetime(2014, 7, 2))
+            self.redis.assert_has_calls(
+                [
+                    call.sadd(self.r._metric_slugs_key, "test-metric"),
+                    call.pipeline(),
+                    call.pipeline().hset("m:test-metric:m:2014", "2014-07", 42),
+                    call.pipeline().hset("m:test-metric:y:", "2014", 42),
+                    call.pipeline().execute(),
+                ]
+            )
+            self.assertFalse(self.redis.mset.called)
+            self.assertFalse(self.redis.pipeline().expire.called)
+
+    def test_metric_with_lua_script_and_hashes_storage_layout(self):
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["USE_LUA_SCRIPTS"] = True
+        test_settings["STORAGE_LAYOUT"] = "hashes"
+        test_settings["MIN_GRANULARITY"] = "monthly"
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.metric("test-metric", date=datetime(2014, 7, 2))
+            script = self.redis.register_script.return_value
+            script.assert_called_once_with(
+                keys=[
+                    "metric-slugs",
+                    "categories",
+                    "c:",
+                    "m:test-metric:m:2014",
+                    "m:test-metric:y:",
+                ],
+                args=["test-metric", "", 1, 0, 0, "2014-07", "2014"],
+            )
+
+    def test_metrics_bulk(self):
+        """Tests recording many metrics with ``R.metrics_bulk``."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["MIN_GRANULARITY"] = "daily"
+        with override_settings(REDIS_METRICS=test_settings):
+            d1 = datetime(2014, 7, 2, 12, 6, 34)
+            d2 = datetime(2014, 7, 3, 1, 2, 3)
+            with patch.object(self.r, "_write_counts") as mock_write_counts:
+                recorded = self.r.metrics_bulk([
+                    ("foo", 1, d1, "Stuff"),
+                    ("foo", 2, d1),
+                    ("foo", 3, d2, None),
+                ], expire=60)
+
+            self.assertEqual(recorded, 3)
+            counts = {
+                "m:foo:2014-07-02": 3,
+                "m:foo:2014-07-03": 3,
+                "m:foo:w:2014-26": 6,
+                "m:foo:m:2014-07": 6,
+                "m:foo:y:2014": 6,
+            }
+            mock_write_counts.assert_called_once_with(
+                counts,
+                {"foo"},
+                {("foo", "Stuff")},
+                dict.fromkeys(counts, 60),
+            )
+
+    def test_metrics_bulk_builds_keys_once_per_period(self):
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["MIN_GRANULARITY"] = "hourly"
+        with override_settings(REDIS_METRICS=test_settings):
+            metrics = [
+                ("foo", 1, datetime(2014, 7, 2, 12, minute))
+                for minute in range(60)
+            ]
+            with patch("redis_metrics.keys.KeySchema.build_keys") as mock_build_keys:
+                mock_build_keys.return_value = ["m:foo:h:2014-07-02-12"]
+                self.r.metrics_bulk(metrics)
+            mock_build_keys.assert_called_once_with("foo", metrics[0][2])
+            self.redis.pipeline().incr.assert_called_once_with(
+                "m:foo:h:2014-07-02-12", 60
+            )
+
+    def test_metrics_bulk_with_mapping(self):
+        with patch.object(self.r, "_write_counts") as mock_write_counts:
+            self.assertEqual(self.r.metrics_bulk({"foo": 1, "bar": 2}), 2)
+        counts = mock_write_counts.call_args[0][0]
+        self.assertEqual(len(counts), 14)  # 2 slugs * 7 granularities
+        self.assertEqual(set(counts.values()), {1, 2})
+
+    def test_metrics_bulk_in_chunks(self):
+        """Each chunk of distinct keys is sent in its own pipeline."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["MIN_GRANULARITY"] = "yearly"
+        with override_settings(REDIS_METRICS=test_settings):
+            metrics = (
+                ("slug-{0}".format(i), 1, datetime(2014, 7, 2))
+                for i in range(25)
+            )
+            with patch.object(self.r, "_write_counts") as mock_write_counts:
+                self.assertEqual(self.r.metrics_bulk(metrics, chunk_size=10), 25)
+
+            sizes = [len(c[0][0]) for c in mock_write_counts.call_args_list]
+            self.assertEqual(sizes, [10, 10, 5])
+
+    def test__write_counts(self):
+        self.r._write_counts(
+            {"m:foo:2014-07-02": 3},
+            {"foo"},
+            {("foo", "Stuff")},
+            {"m:foo:2014-07-02": 60},
+        )
+        self.redis.assert_has_calls([
+            call.pipeline(transaction=False),
+            call.pipeline().sadd("metric-slugs", "foo"),
+            call.pipeline().sadd("c:Stuff", "foo"),
+            call.pipeline().sadd("categories", "Stuff"),
+            call.pipeline().incr("m:foo:2014-07-02", 3),
+            call.pipeline().expire("m:foo:2014-07-02", 60),
+            call.pipeline().execute(),
+        ])
+
     def test_get_metric(self):
         """Tests getting a single metric; ``R.get_metric``."""
         slug = "test-metric"
-        self.r.get_metric(slug)
+        self.redis.mget.return_value = ["1", "2", "3", "4", "5", "6", "7"]
+        result = self.r.get_metric(slug)
 
-        # Verify that we GET the keys from redis
-        sec, min, hour, day, week, month, year = self.r._build_keys(slug)
-        self.redis.assert_has_calls(
+        # Verify that we MGET the keys from redis
+        self.redis.mget.assert_called_once_with(self.r._build_keys(slug))
+        self.assertEqual(
+            list(result.items()),
             [
-                call.get(sec),
-                call.get(min),
-                call.get(hour),
-                call.get(day),
-                call.get(week),
-                call.get(month),
-                call.get(year),
-            ]
+                ("seconds", "1"),
+                ("minutes", "2"),
+                ("hourly", "3"),
+                ("daily", "4"),
+                ("weekly", "5"),
+                ("monthly", "6"),
+                ("yearly", "7"),
+            ],
         )
 
     def test_get_metric_with_overridden_granularities(self):
@@ -680,40 +1082,62 @@ class TestR(TestCase):
             slug = "test-metric"
             self.r.get_metric(slug)
 
-            # Verify that we GET the keys from redis
-            day, week = self.r._build_keys(slug)
-            self.redis.assert_has_calls(
-                [
-                    call.get(day),
-                    call.get(week),
-                ]
-            )
+            # Verify that we MGET the keys from redis
+            self.redis.mget.assert_called_once_with(self.r._build_keys(slug))
 
     def test_get_metrics(self):
         # Set a return value for mget, so all of the method gets exercised.
         prev_return = self.redis.mget.return_value
-        self.redis.mget.return_value = ["1", "2"]
+        self.redis.mget.return_value = ["1", "2", "3", "4", "5", "6", "7"] + [None] * 7
 
         # Slugs for metrics we want
         slugs = ["metric-1", "metric-2"]
 
-        # Build the various keys for each metric
-        keys_list = []
-        for s in slugs:
-            keys_list.append(self.r._build_keys(s))
-
-        # construct the calls to redis.mget
-        calls = [call(*keys) for keys in keys_list]
+        # The keys for every metric are read with a single mget
+        keys = self.r._build_keys("metric-1") + self.r._build_keys("metric-2")
 
         # Test our method
-        self.r.get_metrics(slugs)
-        self.assertEqual(self.redis.mget.call_args_list, calls)
-        self.assertTrue(self.redis.mget.called)  # mget was called...
-        self.assertEqual(self.redis.mget.call_count, 2)  # ...twice
+        result = self.r.get_metrics(slugs)
+        self.redis.mget.assert_called_once_with(keys)
+        self.assertEqual(
+            result,
+            [
+                (
+                    "metric-1",
+                    {
+                        "seconds": "1",
+                        "minutes": "2",
+                        "hours": "3",
+                        "day": "4",
+                        "week": "5",
+                        "month": "6",
+                        "year": "7",
+                    },
+                ),
+            ],
+        )
 
         # Reset mget's previous return value
         self.redis.mget.return_value = prev_return
 
+    def test_get_metrics_in_chunks(self):
+        test_settings = dict(TEST_SETTINGS, MGET_CHUNK_SIZE=5)
+        with override_settings(REDIS_METRICS=test_settings):
+            pipe = self.redis.pipeline.return_value
+            pipe.execute.return_value = [["1"] * 5, ["2"] * 5, ["3"] * 4]
+            keys = self.r._build_keys("metric-1") + self.r._build_keys("metric-2")
+
+            result = self.r.get_metrics(["metric-1", "metric-2"])
+            self.assertFalse(self.redis.mget.called)
+            pipe.mget.assert_has_calls(
+                [call(keys[:5]), call(keys[5:10]), call(keys[10:])]
+            )
+            self.assertEqual(pipe.execute.call_count, 1)
+            self.assertEqual(result[0][1]["year"], "2")
+            self.assertEqual(result[1][1]["year"], "3")
+
+        self.assertEqual(self.r.get_metrics([]), [])
+
     def test_get_metrics_with_overridden_granularities(self):
         test_settings = TEST_SETTINGS.copy()
         test_settings["MIN_GRANULARITY"] = "daily"
@@ -726,19 +1150,12 @@ class TestR(TestCase):
             # Slugs for metrics we want
             slugs = ["metric-1", "metric-2"]
 
-            # Build the various keys for each metric
-            keys_list = []
-            for s in slugs:
-                keys_list.append(self.r._build_keys(s))
-
-            # construct the calls to redis.mget
-            calls = [call(*keys) for keys in keys_list]
+            # The keys for every metric are read with a single mget
+            keys = self.r._build_keys("metric-1") + self.r._build_keys("metric-2")
 
             # Test our method
             self.r.get_metrics(slugs)
-            self.assertEqual(self.redis.mget.call_args_list, calls)
-            self.assertTrue(self.redis.mget.called)  # mget was called...
-            self.assertEqual(self.redis.mget.call_count, 2)  # ...twice
+            self.redis.mget.assert_called_once_with(keys)
 
             # Reset mget's previous return value
             self.redis.mget.return_value = prev_return
@@ -817,14 +1234,21 @@ class TestR(TestCase):
         for slug in slugs:
             for date in self.r._date_range(granularity, since, to):
                 keys += self.r._build_keys(slug, date, granularity)
-        keys = list(dedupe(keys))
-        return keys
+        # ``get_metric_history`` reads the keys in sorted order.
+        return sorted(dedupe(keys))
 
     def _test_get_metric_history(self, slugs, since=None, to=None, granularity=None):
         """actual test code for ``R.get_metric_history``."""
         keys = self._metric_history_keys(slugs, since, to, granularity)
         self.r.get_metric_history(slugs, since=since, to=to, granularity=granularity)
-        self.redis.assert_has_calls([call.mget(keys)])
+        if len(keys) <= 1000:
+            self.redis.assert_has_calls([call.mget(keys)])
+        else:
+            # Large ranges are read with an MGET per MGET_CHUNK_SIZE keys,
+            # in a single pipeline.
+            self.redis.pipeline.return_value.mget.assert_has_calls(
+                [call(keys[i:i + 1000]) for i in range(0, len(keys), 1000)]
+            )
 
     def test_get_metric_history_hourly(self):
         """Tests ``R.get_metric_history`` with hourly granularity."""
@@ -941,26 +1365,20 @@ class TestR(TestCase):
             granularity="yearly",
         )
 
-    @patch.object(R, "_date_range")
-    def test_get_metric_history_replaces_none_with_zero(self, mock_date_range):
+    def test_get_metric_history_replaces_none_with_zero(self):
         """Ensure that None-values get replaced with Zeros in
         ``R.get_metric_history``."""
 
-        # Mock the _date_range method so we can specify it's return values.
-        mock_date_range.return_value = [
-            datetime(2000, 1, 1),
-            datetime(2000, 1, 2),
-            datetime(2000, 1, 3),
-            datetime(2000, 1, 4),
-        ]
-
         # Temporarily change the return value for mget
         mget_return = self.redis.mget.return_value
         self.redis.mget.return_value = ["1", "2", None, "3"]
 
-        # Note: we're not providing a since parameter here, since we've
-        # mocked the R._date_range method.
-        results = self.r.get_metric_history("foo", granularity="daily")
+        results = self.r.get_metric_history(
+            "foo",
+            since=datetime(2000, 1, 1),
+            to=datetime(2000, 1, 4),
+            granularity="daily",
+        )
 
         # Format the range of dates that for which we should get results
         expected = [
@@ -974,6 +1392,40 @@ class TestR(TestCase):
         # Reset mget's previous return value
         self.redis.mget.return_value = mget_return
 
+    def test_get_metric_history_with_hashes_storage_layout(self):
+        """A month of daily history is read with one HMGET per month."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["STORAGE_LAYOUT"] = "hashes"
+        with override_settings(REDIS_METRICS=test_settings):
+            pipe = self.redis.pipeline.return_value
+            pipe.execute.return_value = [
+                ["3", "2"],
+                [None, "1"],
+            ]
+            results = self.r.get_metric_history(
+                "foo",
+                since=datetime(2014, 7, 30),
+                to=datetime(2014, 8, 2),
+                granularity="daily",
+            )
+            self.assertEqual(
+                results,
+                [
+                    ("m:foo:2014-07-30", "3"),
+                    ("m:foo:2014-07-31", "2"),
+                    ("m:foo:2014-08-01", 0),
+                    ("m:foo:2014-08-02", "1"),
+                ],
+            )
+            pipe.assert_has_calls(
+                [
+                    call.hmget("m:foo:2014-07", ["2014-07-30", "2014-07-31"]),
+                    call.hmget("m:foo:2014-08", ["2014-08-01", "2014-08-02"]),
+                    call.execute(),
+                ]
+            )
+            self.assertFalse(self.redis.mget.called)
+
     @patch.object(R, "get_metric_history")
     def test_get_metric_history_as_columns(self, mock_metric_hist):
         # set up some sample (yearly) metrics
@@ -998,6 +1450,46 @@ class TestR(TestCase):
             results = r.get_metric_history_as_columns(**kwargs)
             self.assertEqual(results, expected_results)
 
+    @patch.object(R, "get_metric_history")
+    def test_get_metric_history_as_columns_fills_gaps(self, mock_metric_hist):
+        mock_metric_hist.return_value = [
+            ("m:foo-bar:2014-07-01", "1"),
+            ("m:foo-bar:2014-07-02", "2"),
+            ("m:baz:2014-07-02", "3"),
+        ]
+        results = self.r.get_metric_history_as_columns(["Foo Bar", "baz", "qux"])
+        self.assertEqual(results, [
+            ("Period", "Foo Bar", "baz", "qux"),
+            ("2014-07-01", "1", 0, 0),
+            ("2014-07-02", "2", "3", 0),
+        ])
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    @patch.object(R, "get_metric_history")
+    def test_get_metric_history_as_columns_as_array(self, mock_metric_hist):
+        mock_metric_hist.return_value = [
+            ("m:bar:y:2012", "1"),
+            ("m:bar:y:2013", "2"),
+            ("m:foo:y:2012", "3"),
+            ("m:foo:y:2013", "4.5"),
+        ]
+        periods, values = self.r.get_metric_history_as_columns(
+            ["foo", "bar"], granularity="yearly", as_array=True
+        )
+        self.assertEqual(periods, ["y:2012", "y:2013"])
+        self.assertEqual(values.tolist(), [[3.0, 1.0], [4.5, 2.0]])
+
+        mock_metric_hist.return_value = []
+        periods, values = self.r.get_metric_history_as_columns(
+            ["foo", "bar"], as_array=True
+        )
+        self.assertEqual(values.shape, (0, 2))
+
+    @patch("redis_metrics.models.numpy", None)
+    def test_get_metric_history_as_columns_as_array_without_numpy(self):
+        with self.assertRaises(ImportError):
+            self.r.get_metric_history_as_columns(["foo"], as_array=True)
+
     def _test_get_metric_history_as_columns(self, slugs, granularity):
         """Test that R.get_metric_history_as_columns makes calls to the
         following functions:
@@ -1063,6 +1555,26 @@ class TestR(TestCase):
             results = r.get_metric_history_chart_data(**kwargs)
             self.assertEqual(results, expected_results)
 
+    @override_settings(REDIS_METRICS=dict(TEST_SETTINGS, HASH_TAG_KEYS=True))
+    @patch.object(R, "get_metric_history")
+    def test_get_metric_history_chart_data_with_hash_tags(self, mock_metric_hist):
+        mock_metric_hist.return_value = [
+            ("m:{bar}:y:2012", "1"),
+            ("m:{bar}:y:2013", "2"),
+            ("m:{foo}:y:2012", "3"),
+            ("m:{foo}:y:2013", "4"),
+        ]
+        results = self.r.get_metric_history_chart_data(
+            ["foo", "bar"], since=None, granularity="yearly"
+        )
+        self.assertEqual(results, {
+            "periods": ["y:2012", "y:2013"],
+            "data": [
+                {"slug": "bar", "values": ["1", "2"]},
+                {"slug": "foo", "values": ["3", "4"]},
+            ],
+        })
+
     def test_gauge_slugs(self):
         """Tests that ``R.gauge_slugs`` calls the SMEMBERS command."""
         self.r.gauge_slugs()
@@ -1073,14 +1585,44 @@ class TestR(TestCase):
         key = self.r._gauge_key("test-gauge")
         self.assertEqual(key, "g:test-gauge")
 
-    def test_gauge(self):
+    @patch("redis_metrics.models.datetime")
+    def test_gauge(self, mock_datetime):
         """Tests setting a gauge with ``R.gauge``. Verifies that the gauge slug
-        is added to the set of gauge slugs and that the value gets set."""
+        is added to the set of gauge slugs and that the value gets set and
+        added to the gauge's history, in a single pipeline."""
+        mock_datetime.utcnow.return_value = datetime(2014, 7, 2, 12, 6, 34)
         self.r.gauge("test-gauge", 9000)
-        self.redis.assert_has_calls(
+        self.redis.pipeline.assert_called_once_with(transaction=False)
+        self.redis.pipeline().assert_has_calls(
             [
                 call.sadd(self.r._gauge_slugs_key, "test-gauge"),
                 call.set("g:test-gauge", 9000),
+                call.zadd("gh:test-gauge", {"1404302794.000000:9000": 1404302794.0}),
+                call.zremrangebyrank("gh:test-gauge", 0, -1001),
+                call.zremrangebyscore("gh:test-gauge", "-inf", "(1403697994.0"),
+                call.expire("gh:test-gauge", 604800),
+                call.execute(),
+            ]
+        )
+
+    def test_gauge_with_aware_datetime(self):
+        date = datetime(2014, 7, 2, 14, 6, 34, tzinfo=timezone(timedelta(hours=2)))
+        self.r.gauge("test-gauge", 9000, date=date)
+        self.redis.pipeline().zadd.assert_called_once_with(
+            "gh:test-gauge", {"1404302794.000000:9000": 1404302794.0}
+        )
+
+    def test_gauge_without_history(self):
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["GAUGE_HISTORY_SIZE"] = 0
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.gauge("test-gauge", 9000)
+        self.assertEqual(
+            self.redis.pipeline().mock_calls,
+            [
+                call.sadd(self.r._gauge_slugs_key, "test-gauge"),
+                call.set("g:test-gauge", 9000),
+                call.execute(),
             ]
         )
 
@@ -1090,12 +1632,384 @@ class TestR(TestCase):
         self.r.get_gauge("test-gauge")
         self.redis.assert_has_calls([call.get("g:test-gauge")])
 
+    def test_gauge_with_stats(self):
+        """With GAUGE_STATS, the GAUGE_STATS script is queued on the same
+        pipeline, for each period's statistics hash."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["GAUGE_STATS"] = True
+        test_settings["GAUGE_HISTORY_SIZE"] = 0
+        test_settings["RETENTION"] = {"daily": 86400}
+        test_settings["MIN_GRANULARITY"] = "daily"
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.gauge("queue", 12, date=datetime(2014, 7, 2, 12, 6, 34))
+
+        self.redis.register_script.assert_called_once_with(scripts.GAUGE_STATS)
+        script = self.redis.register_script.return_value
+        script.assert_called_once_with(
+            keys=[
+                "gs:queue:2014-07-02",
+                "gs:queue:w:2014-26",
+                "gs:queue:m:2014-07",
+                "gs:queue:y:2014",
+            ],
+            args=[12, 86400, 0, 0, 0],
+            client=self.redis.pipeline.return_value,
+        )
+        self.assertEqual(self.redis.pipeline().execute.call_count, 1)
+
+    def test_get_gauge_stats(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [
+            {"count": "4", "sum": "20", "min": "2", "max": "9", "last": "4"},
+            {},
+            {},
+            {},
+        ]
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["MIN_GRANULARITY"] = "daily"
+        with override_settings(REDIS_METRICS=test_settings):
+            stats = self.r.get_gauge_stats("queue", datetime(2014, 7, 2))
+        pipe.assert_has_calls([
+            call.hgetall("gs:queue:2014-07-02"),
+            call.hgetall("gs:queue:w:2014-26"),
+            call.hgetall("gs:queue:m:2014-07"),
+            call.hgetall("gs:queue:y:2014"),
+            call.execute(),
+        ])
+        self.assertEqual(list(stats), ["daily", "weekly", "monthly", "yearly"])
+        self.assertEqual(stats["daily"], {
+            "count": 4, "sum": 20.0, "min": 2.0, "max": 9.0, "last": 4.0,
+            "avg": 5.0,
+        })
+        self.assertIsNone(stats["yearly"])
+
+    def test_get_gauge_stats_history(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [
+            {"count": "1", "sum": "3", "min": "3", "max": "3", "last": "3"},
+            {},
+        ]
+        history = self.r.get_gauge_stats_history(
+            "queue",
+            since=datetime(2014, 7, 1),
+            to=datetime(2014, 7, 2),
+        )
+        self.assertEqual(
+            pipe.hgetall.call_args_list,
+            [call("gs:queue:2014-07-01"), call("gs:queue:2014-07-02")]
+        )
+        self.assertEqual([k for k, v in history], [
+            "gs:queue:2014-07-01", "gs:queue:2014-07-02"
+        ])
+        self.assertEqual(history[0][1]["avg"], 3.0)
+        self.assertIsNone(history[1][1])
+
+    def test_get_gauge_history(self):
+        self.redis.zrangebyscore.return_value = [
+            ("1404302794.000000:0.5", 1404302794.0),
+            ("1404302795.500000:0.5", 1404302795.5),
+        ]
+        history = self.r.get_gauge_history(
+            "load",
+            since=datetime(2014, 7, 2),
+            to=datetime(2014, 7, 3),
+        )
+        self.redis.zrangebyscore.assert_called_once_with(
+            "gh:load", 1404259200.0, 1404345600.0, withscores=True
+        )
+        self.assertEqual(history, [
+            (datetime(2014, 7, 2, 12, 6, 34), "0.5"),
+            (datetime(2014, 7, 2, 12, 6, 35, 500000), "0.5"),
+        ])
+
+        self.r.get_gauge_history("load")
+        self.redis.zrangebyscore.assert_called_with(
+            "gh:load", "-inf", "+inf", withscores=True
+        )
+
+    def test_get_gauge_history_with_aware_datetimes(self):
+        self.redis.zrangebyscore.return_value = []
+        self.r.get_gauge_history(
+            "load",
+            since=datetime(2014, 7, 2, 2, tzinfo=timezone(timedelta(hours=2))),
+            to=datetime(2014, 7, 3, tzinfo=timezone.utc),
+        )
+        self.redis.zrangebyscore.assert_called_once_with(
+            "gh:load", 1404259200.0, 1404345600.0, withscores=True
+        )
+
     def test_delete_gauge(self):
         """Tests deltion of a gauge."""
         self.r.delete_gauge("test-gauge")
         self.redis.assert_has_calls(
             [
-                call.delete("g:test-gauge"),
+                call.delete("g:test-gauge", "gh:test-gauge"),
                 call.srem(self.r._gauge_slugs_key, "test-gauge"),
             ]
         )
+
+    def test_timer_slugs(self):
+        self.r.timer_slugs()
+        self.redis.smembers.assert_called_once_with("timer-slugs")
+
+    def test_timing(self):
+        """``R.timing`` counts the value in a bucket of each period's hash,
+        in a single pipeline."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["MIN_GRANULARITY"] = "monthly"
+        test_settings["HISTOGRAM_BUCKETS"] = (10, 100)
+        test_settings["RETENTION"] = {"monthly": 3600}
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.timing("view", 42.5, date=datetime(2014, 7, 2))
+
+        self.redis.pipeline.assert_called_once_with(transaction=False)
+        self.assertEqual(self.redis.pipeline().mock_calls, [
+            call.sadd("timer-slugs", "view"),
+            call.hincrby("t:view:m:2014-07", "100", 1),
+            call.hincrby("t:view:m:2014-07", "count", 1),
+            call.hincrbyfloat("t:view:m:2014-07", "sum", 42.5),
+            call.expire("t:view:m:2014-07", 3600),
+            call.hincrby("t:view:y:2014", "100", 1),
+            call.hincrby("t:view:y:2014", "count", 1),
+            call.hincrbyfloat("t:view:y:2014", "sum", 42.5),
+            call.execute(),
+        ])
+
+    def test_get_timing(self):
+        """Histograms are merged across periods, and percentiles are
+        interpolated within buckets."""
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [
+            {"10": "50", "100": "30", "count": "80", "sum": "1600"},
+            {"100": "10", "+Inf": "10", "count": "20", "sum": "2400"},
+        ]
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["HISTOGRAM_BUCKETS"] = (10, 100)
+        with override_settings(REDIS_METRICS=test_settings):
+            histogram = self.r.get_timing(
+                "view",
+                since=datetime(2014, 7, 1),
+                to=datetime(2014, 7, 2),
+            )
+
+        self.assertEqual(
+            pipe.hgetall.call_args_list,
+            [call("t:view:2014-07-01"), call("t:view:2014-07-02")]
+        )
+        self.assertEqual(histogram["count"], 100)
+        self.assertEqual(histogram["sum"], 4000.0)
+        self.assertEqual(histogram["mean"], 40.0)
+        self.assertEqual(
+            list(histogram["buckets"].items()),
+            [(10.0, 50), (100.0, 40), (float("inf"), 10)]
+        )
+        self.assertEqual(histogram["p50"], 10.0)
+        self.assertEqual(histogram["p95"], 100.0)  # Capped at the last bound
+        self.assertEqual(histogram["p99"], 100.0)
+
+    def test__percentile(self):
+        buckets = OrderedDict([(10.0, 4), (20.0, 4), (float("inf"), 0)])
+        self.assertEqual(self.r._percentile(buckets, 0.25), 5.0)
+        self.assertEqual(self.r._percentile(buckets, 0.75), 15.0)
+        self.assertIsNone(self.r._percentile(OrderedDict([(10.0, 0)]), 0.5))
+
+    def test_get_timing_history(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [
+            {"10": "2", "count": "2", "sum": "10"},
+            {},
+        ]
+        history = self.r.get_timing_history(
+            "view",
+            since=datetime(2014, 7, 1),
+            to=datetime(2014, 7, 2),
+        )
+        self.assertEqual(
+            [(k, h["count"], h["mean"]) for k, h in history],
+            [("t:view:2014-07-01", 2, 5.0), ("t:view:2014-07-02", 0, None)]
+        )
+        self.assertIsNone(history[1][1]["p50"])
+
+    def test_delete_timer(self):
+        self.redis.keys.return_value = ["t:view:y:2014"]
+        self.r.delete_timer("view")
+        self.redis.assert_has_calls([
+            call.keys("t:view:*"),
+            call.delete("t:view:y:2014"),
+            call.srem("timer-slugs", "view"),
+        ])
+
+    def test_unique(self):
+        """``R.unique`` adds members to each period's HyperLogLog, in a single
+        pipeline."""
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["MIN_GRANULARITY"] = "monthly"
+        test_settings["RETENTION"] = {"monthly": 3600}
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.unique("visitors", "alice", date=datetime(2014, 7, 2))
+            self.r.unique("visitors", ["bob", "carol"], date=datetime(2014, 7, 2))
+            self.r.unique("visitors", [], date=datetime(2014, 7, 2))
+
+        self.assertEqual(self.redis.pipeline().mock_calls, [
+            call.sadd("unique-slugs", "visitors"),
+            call.pfadd("u:visitors:m:2014-07", "alice"),
+            call.expire("u:visitors:m:2014-07", 3600),
+            call.pfadd("u:visitors:y:2014", "alice"),
+            call.execute(),
+            call.sadd("unique-slugs", "visitors"),
+            call.pfadd("u:visitors:m:2014-07", "bob", "carol"),
+            call.expire("u:visitors:m:2014-07", 3600),
+            call.pfadd("u:visitors:y:2014", "bob", "carol"),
+            call.execute(),
+        ])
+
+    def test_get_unique(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [10, 20]
+        test_settings = TEST_SETTINGS.copy()
+        test_settings["MIN_GRANULARITY"] = "monthly"
+        with override_settings(REDIS_METRICS=test_settings):
+            counts = self.r.get_unique("visitors", datetime(2014, 7, 2))
+        self.assertEqual(
+            pipe.pfcount.call_args_list,
+            [call("u:visitors:m:2014-07"), call("u:visitors:y:2014")]
+        )
+        self.assertEqual(list(counts.items()), [("monthly", 10), ("yearly", 20)])
+
+    def test_get_unique_history(self):
+        pipe = self.redis.pipeline.return_value
+        pipe.execute.return_value = [3, 4]
+        history = self.r.get_unique_history(
+            "visitors",
+            since=datetime(2014, 7, 1),
+            to=datetime(2014, 7, 2),
+        )
+        self.assertEqual(history, [
+            ("u:visitors:2014-07-01", 3),
+            ("u:visitors:2014-07-02", 4),
+        ])
+
+    def test_get_unique_count(self):
+        """Ranges are merged by a single PFCOUNT."""
+        self.redis.pfcount.return_value = 5
+        count = self.r.get_unique_count(
+            "visitors",
+            since=datetime(2014, 7, 1),
+            to=datetime(2014, 7, 2),
+        )
+        self.assertEqual(count, 5)
+        self.redis.pfcount.assert_called_once_with(
+            "u:visitors:2014-07-01", "u:visitors:2014-07-02"
+        )
+        self.assertFalse(self.redis.pipeline.called)
+
+    def test_delete_unique(self):
+        self.redis.keys.return_value = ["u:visitors:y:2014"]
+        self.r.delete_unique("visitors")
+        self.redis.assert_has_calls([
+            call.keys("u:visitors:*"),
+            call.delete("u:visitors:y:2014"),
+            call.srem("unique-slugs", "visitors"),
+        ])
+
+
+@override_settings(REDIS_METRICS=dict(TEST_SETTINGS, CLUSTER=True, HASH_TAG_KEYS=True))
+class TestRCluster(TestCase):
+    """Tests for the ``R`` class connected to a Redis Cluster."""
+
+    def setUp(self):
+        self.redis_patcher = patch("redis_metrics.models.redis.cluster.RedisCluster")
+        self.mock_RedisCluster = self.redis_patcher.start()
+        self.redis = self.mock_RedisCluster.return_value
+        self.pipe = self.redis.pipeline.return_value
+        self.r = R()
+        self.date = datetime(2014, 7, 2, 12, 6, 34)
+
+    def tearDown(self):
+        self.redis_patcher.stop()
+        super(TestRCluster, self).tearDown()
+
+    def test__init__(self):
+        self.assertTrue(self.r.cluster)
+        self.mock_RedisCluster.assert_called_once_with(
+            host="localhost",
+            port=6379,
+            password=None,
+            ssl=None,
+            socket_timeout=None,
+            decode_responses=True,
+        )
+
+    def test__init__requires_hash_tags(self):
+        with override_settings(REDIS_METRICS=dict(TEST_SETTINGS, CLUSTER=True)):
+            with self.assertRaises(ImproperlyConfigured):
+                R()
+
+    def test_keys_share_a_slot(self):
+        self.assertEqual(
+            self.r._build_keys("foo", self.date, "daily"), ["m:{foo}:2014-07-02"]
+        )
+        self.assertEqual(
+            self.r._timer_keys("foo", self.date, "daily"), ["t:{foo}:2014-07-02"]
+        )
+        self.assertEqual(self.r._gauge_key("foo"), "g:{foo}")
+        self.assertEqual(self.r._gauge_history_key("foo"), "gh:{foo}")
+
+    def test_get_metric_history_uses_mget_by_slot(self):
+        self.redis.mget_nonatomic.return_value = ["1", "2", "3", "4"]
+        history = self.r.get_metric_history(
+            ["foo", "bar"],
+            since=datetime(2014, 7, 1),
+            to=datetime(2014, 7, 2),
+        )
+        keys = [
+            "m:{bar}:2014-07-01",
+            "m:{bar}:2014-07-02",
+            "m:{foo}:2014-07-01",
+            "m:{foo}:2014-07-02",
+        ]
+        self.redis.mget_nonatomic.assert_called_once_with(keys)
+        self.assertFalse(self.redis.mget.called)
+        self.assertEqual(dict(history), dict(zip(keys, ["1", "2", "3", "4"])))
+
+    def test_delete_metric_scans_every_node(self):
+        self.redis.scan_iter.return_value = iter(["m:{foo}:y:2014"])
+        self.r.delete_metric("foo")
+        self.redis.scan_iter.assert_called_once_with(match="m:{foo}:*")
+        self.redis.delete.assert_called_once_with("m:{foo}:y:2014")
+        self.assertFalse(self.redis.keys.called)
+
+    def test_set_metric_sets_each_key(self):
+        with override_settings(REDIS_METRICS=dict(
+                TEST_SETTINGS, CLUSTER=True, MIN_GRANULARITY="monthly")):
+            self.r.set_metric("foo", 5, expire=60, date=self.date)
+        self.pipe.assert_has_calls([
+            call.set("m:foo:m:2014-07", 5, ex=60),
+            call.set("m:foo:y:2014", 5, ex=60),
+            call.execute(),
+        ])
+        self.assertFalse(self.redis.mset.called)
+
+    def test_metric_ignores_lua_scripts(self):
+        test_settings = dict(TEST_SETTINGS, CLUSTER=True, USE_LUA_SCRIPTS=True)
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.metric("foo", date=self.date)
+        self.assertFalse(self.redis.register_script.called)
+        self.pipe.incr.assert_any_call("m:foo:y:2014", 1)
+
+    def test_gauge_stats_script_uses_eval(self):
+        test_settings = dict(
+            TEST_SETTINGS,
+            CLUSTER=True,
+            HASH_TAG_KEYS=True,
+            MIN_GRANULARITY="monthly",
+            GAUGE_STATS=True,
+            GAUGE_HISTORY_SIZE=0,
+        )
+        with override_settings(REDIS_METRICS=test_settings):
+            self.r.gauge("foo", 3, date=self.date)
+        self.pipe.execute_command.assert_called_once_with(
+            "EVAL", scripts.GAUGE_STATS, 2,
+            "gs:{foo}:m:2014-07", "gs:{foo}:y:2014", 3, 0, 0,
+        )
+        self.assertFalse(self.redis.register_script.called)
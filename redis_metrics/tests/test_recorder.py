@@ -0,0 +1,168 @@
+from __future__ import unicode_literals
+from datetime import datetime
+import time
+
+try:
+    from unittest.mock import call, patch
+except ImportError:
+    from mock import call, patch
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from redis.exceptions import ConnectionError
+
+from ..models import R
+from ..recorder import CallRecorder
+
+
+TEST_SETTINGS = {
+    "HOST": "localhost",
+    "PORT": 6379,
+    "DB": 0,
+    "PASSWORD": None,
+    "SOCKET_TIMEOUT": None,
+    "SOCKET_CONNECTION_POOL": None,
+    "MIN_GRANULARITY": "daily",
+    "MAX_GRANULARITY": "yearly",
+    "MONDAY_FIRST_DAY_OF_WEEK": False,
+    "USE_ISO_WEEK_NUMBER": False,
+    "BUFFER_FLUSH_INTERVAL": 60,
+    "HISTOGRAM_BUCKETS": (10, 100),
+}
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestCallRecorder(TestCase):
+    """Tests for the ``CallRecorder`` class."""
+
+    def setUp(self):
+        self.redis_patcher = patch("redis_metrics.models.redis.StrictRedis")
+        mock_StrictRedis = self.redis_patcher.start()
+        self.redis = mock_StrictRedis.return_value
+        self.pipe = self.redis.pipeline.return_value
+        self.r = R()
+        self.recorder = CallRecorder(self.r)
+
+    def tearDown(self):
+        self.recorder.stop()
+        self.redis_patcher.stop()
+        super(TestCallRecorder, self).tearDown()
+
+    def test__init__with_default_settings(self):
+        self.assertEqual(self.recorder.flush_interval, 60)
+        self.assertIsNone(self.recorder._thread)  # Started on first use
+
+    def test_recording_does_not_write(self):
+        self.recorder.count("calls")
+        self.recorder.timing("view", 5)
+        self.assertEqual(self.recorder.depth, 2)
+        self.assertTrue(self.recorder._thread.is_alive())
+        self.assertFalse(self.redis.pipeline.called)
+
+    @patch("redis_metrics.recorder.datetime")
+    def test_flush(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2014, 7, 2, 12, 6, 34)
+        self.recorder.count("calls")
+        self.recorder.count("calls", 2)
+        for value in [5, 50, 60]:
+            self.recorder.timing("view", value)
+        self.assertEqual(self.recorder.flush(), 5)
+
+        self.redis.pipeline.assert_called_once_with(transaction=False)
+        self.pipe.assert_has_calls([
+            call.sadd("metric-slugs", "calls"),
+            call.incr("m:calls:2014-07-02", 3),
+            call.incr("m:calls:w:2014-26", 3),
+            call.incr("m:calls:m:2014-07", 3),
+            call.incr("m:calls:y:2014", 3),
+            call.sadd("timer-slugs", "view"),
+            call.hincrby("t:view:2014-07-02", "10", 1),
+            call.hincrby("t:view:2014-07-02", "100", 2),
+            call.hincrby("t:view:2014-07-02", "count", 3),
+            call.hincrbyfloat("t:view:2014-07-02", "sum", 115.0),
+        ])
+        self.pipe.execute.assert_called_once_with()
+        self.assertEqual(self.recorder.depth, 0)
+        self.assertEqual(self.recorder.stats()["flushed"], 5)
+        self.assertEqual(self.recorder.flush(), 0)  # Nothing left
+
+    @patch("redis_metrics.recorder.datetime")
+    def test_flush_sums_slugs_that_share_keys(self, mock_datetime):
+        mock_datetime.utcnow.return_value = datetime(2014, 7, 2, 12, 6, 34)
+        self.recorder.count("Signups", 2)
+        self.recorder.count("signups", 3)
+        self.assertEqual(self.recorder.flush(), 2)
+
+        self.pipe.incr.assert_any_call("m:signups:2014-07-02", 5)
+        self.pipe.incr.assert_any_call("m:signups:y:2014", 5)
+
+    def test_flush_with_redis_error(self):
+        self.pipe.execute.side_effect = ConnectionError
+        self.recorder.count("calls")
+        with self.assertLogs("redis_metrics.recorder", "ERROR"):
+            self.assertEqual(self.recorder.flush(), 0)
+        self.assertEqual(self.recorder.stats()["dropped"], 1)
+        self.assertEqual(self.recorder.depth, 0)
+
+    def test_flush_uses_the_write_path(self):
+        self.recorder.count("calls")
+        self.recorder.flush()
+        self.assertNotEqual(self.r._last_write, float("-inf"))  # For READ_YOUR_WRITES
+
+        test_settings = dict(TEST_SETTINGS, CIRCUIT_BREAKER=True, BREAKER_FAILURES=1)
+        with override_settings(REDIS_METRICS=test_settings):
+            recorder = CallRecorder(R())
+            self.pipe.execute.side_effect = ConnectionError
+            recorder.count("calls")
+            with self.assertLogs("redis_metrics.recorder", "ERROR"):
+                recorder.flush()
+            self.assertEqual(recorder.r.breaker.state, "open")
+
+            # While the circuit is open, nothing is sent.
+            self.pipe.reset_mock()
+            recorder.timing("view", 5)
+            with self.assertLogs("redis_metrics.recorder", "ERROR"):
+                self.assertEqual(recorder.flush(), 0)
+            self.assertFalse(self.pipe.execute.called)
+            self.assertEqual(recorder.stats()["dropped"], 2)
+            recorder.stop()
+
+    def test_flushes_periodically(self):
+        recorder = CallRecorder(self.r, flush_interval=0.01)
+        recorder.count("calls")
+        for i in range(500):
+            if recorder.flushes:
+                break
+            time.sleep(0.01)
+        self.assertEqual(recorder.flushed, 1)
+        recorder.stop()
+
+    def test_stop_writes_recorded_calls(self):
+        self.recorder.count("calls")
+        thread = self.recorder._thread
+        self.recorder.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(self.recorder.flushed, 1)
+
+    def test_restarts_after_fork(self):
+        self.recorder.count("calls")
+        parent_thread = self.recorder._thread
+        with patch("redis_metrics.recorder.os.getpid", return_value=-1):
+            self.recorder.count("other")
+            self.assertIsNot(self.recorder._thread, parent_thread)
+            # The parent's calls aren't written by the child.
+            self.assertEqual(self.recorder.depth, 1)
+            self.recorder.stop()
+        parent_thread.join(5)
+
+    def test_overhead(self):
+        """Recording a call shouldn't take more than a few microseconds; this
+        bound is loose so the test isn't flaky (see benchmarks/bench_timed.py
+        for measurements)."""
+        calls = 20000
+        start = time.perf_counter()
+        for i in range(calls):
+            self.recorder.timing("view", 5)
+        per_call = (time.perf_counter() - start) / calls
+        self.assertLess(per_call, 50e-6)
+        self.assertFalse(self.redis.pipeline.called)
@@ -0,0 +1,50 @@
+from __future__ import unicode_literals
+
+try:
+    from unittest.mock import patch
+except ImportError:
+    from mock import patch
+
+from django.test import TestCase
+
+from ..registry import SlugRegistry
+
+
+class TestSlugRegistry(TestCase):
+    """Tests for the ``SlugRegistry`` class."""
+
+    def test_unknown(self):
+        registry = SlugRegistry()
+        self.assertEqual(registry.unknown("metric-slugs", ["a", "b"]), ["a", "b"])
+        registry.add("metric-slugs", ["a"])
+        self.assertEqual(registry.unknown("metric-slugs", ["a", "b"]), ["b"])
+        self.assertEqual(registry.unknown("gauge-slugs", ["a"]), ["a"])
+
+    @patch("redis_metrics.registry.time.monotonic")
+    def test_unknown_after_ttl(self, mock_monotonic):
+        registry = SlugRegistry(ttl=60)
+        mock_monotonic.return_value = 1000
+        registry.add("metric-slugs", ["a"])
+
+        mock_monotonic.return_value = 1059
+        self.assertEqual(registry.unknown("metric-slugs", ["a"]), [])
+        mock_monotonic.return_value = 1061
+        self.assertEqual(registry.unknown("metric-slugs", ["a"]), ["a"])
+
+    def test_discard(self):
+        registry = SlugRegistry()
+        registry.add("c:Stuff", ["a", "b"])
+        registry.add("categories", ["Stuff"])
+        registry.discard("c:Stuff", "a")
+        self.assertEqual(registry.unknown("c:Stuff", ["a", "b"]), ["a"])
+
+        registry.discard("c:Stuff")
+        self.assertEqual(registry.unknown("c:Stuff", ["a", "b"]), ["a", "b"])
+        self.assertEqual(len(registry), 1)
+
+    def test_max_size(self):
+        registry = SlugRegistry(max_size=3)
+        registry.add("metric-slugs", ["a", "b", "c"])
+        self.assertEqual(len(registry), 3)
+        registry.add("metric-slugs", ["d"])
+        self.assertEqual(len(registry), 1)
@@ -0,0 +1,162 @@
+from __future__ import unicode_literals
+from datetime import datetime
+
+try:
+    from unittest.mock import MagicMock, call, patch
+except ImportError:
+    from mock import MagicMock, call, patch
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from redis.exceptions import ConnectionError
+
+from ..models import R
+from ..replicas import ReplicaClient, ReplicaPool
+
+
+TEST_SETTINGS = {
+    "HOST": "primary",
+    "MIN_GRANULARITY": "daily",
+    "MAX_GRANULARITY": "yearly",
+    "MONDAY_FIRST_DAY_OF_WEEK": False,
+    "USE_ISO_WEEK_NUMBER": False,
+    "READ_REPLICAS": [{"HOST": "replica-1"}, {"HOST": "replica-2", "PORT": 6380}],
+}
+
+
+class TestReplicaPool(TestCase):
+    """Tests for the ``ReplicaPool`` class."""
+
+    def setUp(self):
+        self.primary = MagicMock()
+        self.replicas = [MagicMock(), MagicMock()]
+
+    def test__init__with_unknown_selection(self):
+        with self.assertRaises(ValueError):
+            ReplicaPool(self.primary, self.replicas, selection="random")
+
+    def test_round_robin(self):
+        pool = ReplicaPool(self.primary, self.replicas)
+        self.assertEqual([pool.choose() for _ in range(4)], [0, 1, 0, 1])
+
+    def test_least_latency(self):
+        pool = ReplicaPool(self.primary, self.replicas, selection="least-latency")
+        self.assertEqual(pool.choose(), 0)
+        pool.record(0, 0.5)
+        self.assertEqual(pool.choose(), 1)  # Not measured yet
+        pool.record(1, 0.1)
+        self.assertEqual(pool.choose(), 1)
+        pool.record(1, 1.1)
+        self.assertAlmostEqual(pool.latencies[1], 0.3)
+        self.assertEqual(pool.choose(), 1)
+        pool.record(1, 2.3)
+        self.assertEqual(pool.choose(), 0)
+
+    def test_failed_replicas_are_left_out(self):
+        pool = ReplicaPool(self.primary, self.replicas, retry_after=30)
+        with patch("redis_metrics.replicas.time.monotonic", return_value=100):
+            pool.failed(0, ConnectionError())
+            self.assertEqual([pool.choose() for _ in range(3)], [1, 1, 1])
+            self.assertEqual(pool.stats()["down"], [True, False])
+            pool.failed(1, ConnectionError())
+            self.assertIs(pool.client(), self.primary)
+        with patch("redis_metrics.replicas.time.monotonic", return_value=131):
+            self.assertIsInstance(pool.client(), ReplicaClient)
+
+    def test_client_falls_back_to_the_primary(self):
+        pool = ReplicaPool(self.primary, self.replicas)
+        self.replicas[0].get.side_effect = ConnectionError()
+        self.primary.get.return_value = "5"
+        self.assertEqual(pool.client().get("g:foo"), "5")
+        self.primary.get.assert_called_once_with("g:foo")
+        self.assertEqual(pool.choose(), 1)
+
+        self.replicas[1].get.return_value = "4"
+        self.assertEqual(pool.client().get("g:foo"), "4")
+        self.assertIsNotNone(pool.latencies[1])
+
+    def test_pipeline_is_replayed_on_the_primary(self):
+        pool = ReplicaPool(self.primary, self.replicas)
+        replica_pipe = self.replicas[0].pipeline.return_value
+        replica_pipe.execute.side_effect = ConnectionError()
+        primary_pipe = self.primary.pipeline.return_value
+        primary_pipe.execute.return_value = [{"a": "1"}, {}]
+
+        pipe = pool.client().pipeline(transaction=False)
+        pipe.hgetall("t:foo:2014")
+        pipe.hgetall("t:foo:2015")
+        self.assertEqual(pipe.execute(), [{"a": "1"}, {}])
+        primary_pipe.assert_has_calls([
+            call.hgetall("t:foo:2014"),
+            call.hgetall("t:foo:2015"),
+            call.execute(),
+        ])
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestRWithReplicas(TestCase):
+    """Tests for ``R`` with READ_REPLICAS."""
+
+    def setUp(self):
+        self.clients = {}
+
+        def client(**kwargs):
+            redis = self.clients[kwargs["host"]] = MagicMock()
+            return redis
+        self.redis_patcher = patch(
+            "redis_metrics.models.redis.StrictRedis", side_effect=client
+        )
+        self.mock_StrictRedis = self.redis_patcher.start()
+        self.r = R()
+        self.primary = self.clients["primary"]
+        self.date = datetime(2014, 7, 2, 12, 6, 34)
+
+    def tearDown(self):
+        self.redis_patcher.stop()
+        super(TestRWithReplicas, self).tearDown()
+
+    def test__init__(self):
+        self.assertEqual(sorted(self.clients), ["primary", "replica-1", "replica-2"])
+        self.mock_StrictRedis.assert_any_call(
+            host="replica-2",
+            port=6380,
+            db=0,
+            password=None,
+            ssl=False,
+            socket_timeout=None,
+            connection_pool=None,
+            decode_responses=True,
+        )
+
+    def test_reads_use_the_replicas(self):
+        for name in ["replica-1", "replica-2"]:
+            self.clients[name].mget.return_value = [name]
+        history = [
+            self.r.get_metric_history("foo", since=self.date, to=self.date)
+            for _ in range(2)
+        ]
+        self.assertEqual(history, [
+            [("m:foo:2014-07-02", "replica-1")],
+            [("m:foo:2014-07-02", "replica-2")],
+        ])
+        self.r.gauge_slugs()
+        self.clients["replica-1"].smembers.assert_called_once_with("gauge-slugs")
+        self.assertFalse(self.primary.mget.called)
+        self.assertFalse(self.primary.smembers.called)
+
+    def test_writes_use_the_primary(self):
+        self.r.metric("foo", date=self.date)
+        self.assertTrue(self.primary.pipeline.called)
+        self.assertFalse(self.clients["replica-1"].pipeline.called)
+        self.assertFalse(self.clients["replica-2"].pipeline.called)
+
+    def test_read_your_writes(self):
+        test_settings = dict(TEST_SETTINGS, READ_YOUR_WRITES=5)
+        with override_settings(REDIS_METRICS=test_settings):
+            with patch("redis_metrics.models.time.monotonic", return_value=100):
+                self.assertIsNot(self.r._reader(), self.primary)
+                self.r.set_metric("foo", 1, date=self.date)
+            with patch("redis_metrics.models.time.monotonic", return_value=104):
+                self.assertIs(self.r._reader(), self.primary)
+            with patch("redis_metrics.models.time.monotonic", return_value=106):
+                self.assertIsNot(self.r._reader(), self.primary)
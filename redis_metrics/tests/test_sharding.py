@@ -0,0 +1,286 @@
+from __future__ import unicode_literals
+from datetime import datetime
+from fnmatch import fnmatchcase
+
+try:
+    from unittest.mock import MagicMock, patch
+except ImportError:
+    from mock import MagicMock, patch
+
+from django.core.exceptions import ImproperlyConfigured
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from .. import scripts
+from ..sharding import HashRing, ShardedR, shard_name
+
+
+SHARDS = [{"HOST": "a"}, {"HOST": "b"}, {"HOST": "c"}]
+
+TEST_SETTINGS = {
+    "MIN_GRANULARITY": "daily",
+    "MAX_GRANULARITY": "yearly",
+    "MONDAY_FIRST_DAY_OF_WEEK": False,
+    "USE_ISO_WEEK_NUMBER": False,
+    "SHARDS": SHARDS,
+}
+
+
+class TestHashRing(TestCase):
+    """Tests for the ``HashRing`` class."""
+
+    def test_get_is_stable(self):
+        ring = HashRing(["a", "b", "c"])
+        owners = [ring.get("slug-{0}".format(i)) for i in range(100)]
+        self.assertEqual(owners, [ring.get("slug-{0}".format(i)) for i in range(100)])
+        self.assertEqual(set(owners), set([0, 1, 2]))
+
+    def test_adding_a_node_only_moves_keys_to_it(self):
+        before = HashRing(["a", "b", "c"])
+        after = HashRing(["a", "b", "c", "d"])
+        moved = 0
+        for i in range(1000):
+            key = "slug-{0}".format(i)
+            if before.get(key) != after.get(key):
+                self.assertEqual(after.get(key), 3)
+                moved += 1
+        # Roughly a quarter of the keys move to the new node.
+        self.assertGreater(moved, 150)
+        self.assertLess(moved, 350)
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestShardedR(TestCase):
+    """Tests for the ``ShardedR`` class."""
+
+    def setUp(self):
+        self.clients = {}
+
+        def client(**kwargs):
+            redis = self.clients[kwargs["host"]] = MagicMock()
+            redis.pipeline.side_effect = lambda **kw: MagicMock()
+            return redis
+        self.redis_patcher = patch(
+            "redis_metrics.models.redis.StrictRedis", side_effect=client
+        )
+        self.redis_patcher.start()
+        self.r = ShardedR()
+        self.date = datetime(2014, 7, 2, 12, 6, 34)
+
+    def tearDown(self):
+        self.redis_patcher.stop()
+        super(TestShardedR, self).tearDown()
+
+    def _client(self, slug):
+        return self.r.shard(slug).r
+
+    def _slugs_by_shard(self):
+        """Returns a slug owned by each shard."""
+        slugs = {}
+        for i in range(100):
+            slug = "slug-{0}".format(i)
+            slugs.setdefault(self.r.r.shard_for_slug(slug), slug)
+        return [slugs[shard] for shard in range(len(SHARDS))]
+
+    def test__init__(self):
+        self.assertEqual(len(self.r.shards), 3)
+        self.assertEqual(sorted(self.clients), ["a", "b", "c"])
+        self.assertEqual(shard_name(SHARDS[0]), "a:6379/0")
+        self.assertEqual(shard_name({"NAME": "one", "HOST": "a"}), "one")
+
+    def test_metric_is_written_to_its_shard(self):
+        self.r.metric("foo", 2, date=self.date)
+        client = self._client("foo")
+        client.pipeline.assert_called_once_with(transaction=False)
+        for other in self.clients.values():
+            if other is not client:
+                self.assertFalse(other.pipeline.called)
+
+    def test_pipeline_results_are_in_order(self):
+        slugs = self._slugs_by_shard()
+        for i, slug in enumerate(slugs):
+            pipe = MagicMock()
+            pipe.execute.return_value = [slug + "-value"]
+            self.r.shards[i].r.pipeline.side_effect = None
+            self.r.shards[i].r.pipeline.return_value = pipe
+
+        pipe = self.r.r.pipeline()
+        for slug in reversed(slugs):
+            pipe.get("g:" + slug)
+        self.assertEqual(
+            pipe.execute(),
+            [slug + "-value" for slug in reversed(slugs)],
+        )
+
+    def test_get_metric_history_fans_out(self):
+        slugs = self._slugs_by_shard()
+        for slug in slugs:
+            self._client(slug).mget.return_value = [slug]
+        history = self.r.get_metric_history(
+            slugs, since=self.date, to=self.date, granularity="yearly"
+        )
+        self.assertEqual(
+            history, sorted(("m:{0}:y:2014".format(s), s) for s in slugs)
+        )
+        for slug in slugs:
+            self._client(slug).mget.assert_called_once_with(
+                ["m:{0}:y:2014".format(slug)]
+            )
+
+    def test_metric_slugs_are_merged(self):
+        slugs = self._slugs_by_shard()
+        for slug in slugs:
+            self._client(slug).smembers.return_value = set([slug])
+        self.assertEqual(self.r.metric_slugs(), set(slugs))
+
+    def test_slug_sets_are_split_by_member(self):
+        slugs = self._slugs_by_shard()
+        self.r.r.srem("metric-slugs", *slugs)
+        for slug in slugs:
+            self._client(slug).srem.assert_called_once_with("metric-slugs", slug)
+
+    def test_delete_category_deletes_from_every_shard(self):
+        self.r.delete_category("Stuff")
+        for client in self.clients.values():
+            client.delete.assert_called_once_with("c:Stuff")
+
+    def test_lua_scripts_are_not_used(self):
+        with override_settings(REDIS_METRICS=dict(TEST_SETTINGS, USE_LUA_SCRIPTS=True)):
+            self.r.metric("foo", category="Stuff", date=self.date)
+            self.r.delete_category("Stuff")
+
+        owner = self.r.r.ring.get("Stuff")
+        for shard in self.r.shards:
+            self.assertFalse(shard.r.register_script.called)
+        self.r.shards[owner].r.sadd.assert_any_call("categories", "Stuff")
+        self.r.shards[owner].r.srem.assert_called_once_with("categories", "Stuff")
+
+    def _store(self, client, keys):
+        """Makes ``client`` (and only it) hold ``keys`` when ``rebalance``
+        scans the shards."""
+        for other in self.clients.values():
+            if other.scan_iter.side_effect is None:
+                other.scan_iter.return_value = []
+                other.exists.return_value = 0
+        client.scan_iter.side_effect = lambda match, count: [
+            key for key in keys if fnmatchcase(key, match)
+        ]
+        client.exists.side_effect = lambda key: int(key in keys)
+
+    def test_rebalance(self):
+        slugs = self._slugs_by_shard()
+        misplaced = "m:{0}:y:2014".format(slugs[1])
+        source = self._client(slugs[0])
+        target = self._client(slugs[1])
+        self._store(source, [misplaced, "metric-slugs"])
+        source.smembers.return_value = set([slugs[0], slugs[1]])
+        source.pttl.return_value = -1
+        source.dump.return_value = b"data"
+
+        self.assertEqual(
+            self.r.rebalance(dry_run=True), {"keys": 1, "members": 1}
+        )
+        self.assertFalse(target.restore.called)
+
+        self.assertEqual(self.r.rebalance(), {"keys": 1, "members": 1})
+        target.restore.assert_called_once_with(misplaced, 0, b"data", replace=True)
+        source.delete.assert_called_once_with(misplaced)
+        target.sadd.assert_called_once_with("metric-slugs", slugs[1])
+        source.srem.assert_called_once_with("metric-slugs", slugs[1])
+
+    def test_rebalance_only_scans_own_keys(self):
+        slugs = self._slugs_by_shard()
+        source = self._client(slugs[0])
+        self._store(source, [
+            ":1:views.decorators.cache.cache_page",
+            "session:{0}".format(slugs[1]),
+            "metrics:{0}".format(slugs[1]),
+        ])
+        self.assertEqual(self.r.rebalance(), {"keys": 0, "members": 0})
+        for client in self.clients.values():
+            self.assertFalse(client.dump.called)
+            self.assertFalse(client.delete.called)
+        patterns = [c[1]["match"] for c in source.scan_iter.call_args_list]
+        self.assertEqual(
+            patterns, ["m:*", "g:*", "gh:*", "gs:*", "t:*", "u:*", "c:*"]
+        )
+
+    def test_rebalance_skips_expired_keys(self):
+        slugs = self._slugs_by_shard()
+        expired = "m:{0}:y:2014".format(slugs[1])
+        source = self._client(slugs[0])
+        target = self._client(slugs[1])
+        self._store(source, [expired])
+        source.pttl.return_value = -2
+        source.dump.return_value = None
+
+        self.assertEqual(self.r.rebalance(), {"keys": 0, "members": 0})
+        self.assertFalse(target.restore.called)
+        self.assertFalse(source.delete.called)
+
+    def test_rebalance_merges_counts(self):
+        slugs = self._slugs_by_shard()
+        misplaced = "m:{0}:y:2014".format(slugs[1])
+        source = self._client(slugs[0])
+        target = self._client(slugs[1])
+        self._store(source, [misplaced])
+        self._store(target, [misplaced])
+        source.type.return_value = "string"
+        source.get.return_value = "5"
+
+        self.r.rebalance()
+        target.incrby.assert_called_once_with(misplaced, 5)
+        source.delete.assert_called_once_with(misplaced)
+
+    def _misplace(self, key_pattern):
+        """Returns a key on the wrong shard, with its source and target
+        clients, set up to be merged by ``rebalance``."""
+        slugs = self._slugs_by_shard()
+        misplaced = key_pattern.format(slugs[1])
+        source = self._client(slugs[0])
+        target = self._client(slugs[1])
+        self._store(source, [misplaced])
+        self._store(target, [misplaced])
+        source.type.return_value = "hash"
+        return misplaced, source, target
+
+    def test_rebalance_merges_float_gauge_stats(self):
+        misplaced, source, target = self._misplace("gs:{0}:y:2014")
+        source.hgetall.return_value = {
+            "count": "2", "sum": "3.5", "min": "1", "max": "2.5", "last": "2.5"
+        }
+
+        self.r.rebalance()
+        target.register_script.assert_called_once_with(scripts.MERGE_GAUGE_STATS)
+        target.register_script.return_value.assert_called_once_with(
+            keys=[misplaced], args=["2", "3.5", "1", "2.5"]
+        )
+        self.assertFalse(target.hincrby.called)
+        source.delete.assert_called_once_with(misplaced)
+
+    def test_rebalance_merges_hashes_with_floats(self):
+        misplaced, source, target = self._misplace("m:{0}:y")
+        source.hgetall.return_value = {"2014": "3", "2015": "1.5", "2016": "2"}
+        target.hgetall.return_value = {"2014": "0.5", "2016": "4"}
+        pipe = MagicMock()
+        target.pipeline.side_effect = None
+        target.pipeline.return_value = pipe
+
+        self.r.rebalance()
+        pipe.hincrbyfloat.assert_any_call(misplaced, "2014", 3)
+        pipe.hincrbyfloat.assert_any_call(misplaced, "2015", 1.5)
+        pipe.hincrby.assert_called_once_with(misplaced, "2016", 2)
+
+    def test_get_r_returns_sharded_r(self):
+        from .. import utils
+        utils._redis_model = None
+        self.assertIsInstance(utils.get_r(), ShardedR)
+        utils._redis_model = None
+        with override_settings(REDIS_METRICS=dict(TEST_SETTINGS, SHARDS=[])):
+            self.assertNotIsInstance(utils.get_r(), ShardedR)
+        utils._redis_model = None
+
+    def test_get_async_r_is_not_supported(self):
+        from .. import utils
+        with self.assertRaises(ImproperlyConfigured):
+            utils.get_async_r()
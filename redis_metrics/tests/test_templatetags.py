@@ -153,6 +153,25 @@ class TestTemplateTags(TestCase):
             mock_r.assert_called_once_with()
             inst.get_gauge.assert_called_once_with("test-slug")
 
+    def test_gauge_history(self):
+        with patch("redis_metrics.templatetags.redis_metric_tags.get_r") as mock_r:
+            history = [(datetime(2014, 7, 2, 12, 6, 34), "0.5")]
+            inst = mock_r.return_value
+            inst.get_gauge_history.return_value = history
+
+            result = taglib.gauge_history("load", "2014-07-01", with_data_table=True)
+            expected_result = {
+                'slug': "load",
+                'gauge_history': history,
+                'since': datetime(2014, 7, 1),
+                'to': None,
+                'with_data_table': True,
+            }
+            self.assertEqual(result, expected_result)
+            inst.get_gauge_history.assert_called_once_with(
+                "load", since=datetime(2014, 7, 1), to=None
+            )
+
     def test_metric_list(self):
         with patch("redis_metrics.templatetags.redis_metric_tags.get_r") as mock_r:
             inst = mock_r.return_value
@@ -456,3 +475,7 @@ class TestTemplateFilters(TestCase):
 
         # Converts ``m:foo:y:<yyyy>`` to ``foo``
         self.assertEqual(metric_slug("m:foo:y:2000"), "foo")
+
+        # Strips the hash tag from ``m:{foo}:y:<yyyy>``
+        self.assertEqual(metric_slug("m:{foo}:y:2000"), "foo")
+        self.assertEqual(metric_slug("m:{foo}:2000-01-31"), "foo")
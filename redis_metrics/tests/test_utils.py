@@ -1,11 +1,15 @@
 from __future__ import unicode_literals
 from datetime import datetime
+import os
+import threading
+import time
 
 try:
     from unittest.mock import call, patch, Mock
 except ImportError:
     from mock import call, patch, Mock
 
+from asgiref.sync import async_to_sync
 from django.test import TestCase
 from django.test.utils import override_settings
 
@@ -60,6 +64,51 @@ class TestUtils(TestCase):
             self.assertEqual(r, utils._redis_model)
             mock_redis.assert_called_once_with(**r_kwargs)
 
+    def test_get_r_is_shared_between_threads(self):
+        with patch("redis_metrics.models.redis.StrictRedis") as mock_redis:
+            results = []
+            threads = [
+                threading.Thread(target=lambda: results.append(utils.get_r()))
+                for _ in range(8)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(set(map(id, results))), 1)
+            mock_redis.assert_called_once_with(
+                host="localhost",
+                port=6379,
+                db=0,
+                password=None,
+                ssl=False,
+                socket_timeout=None,
+                connection_pool=None,
+                decode_responses=True,
+            )
+
+    def test_get_r_after_fork(self):
+        with patch("redis_metrics.models.redis.StrictRedis"):
+            r = utils.get_r()
+            self.assertIs(utils.get_r(), r)
+            with patch("redis_metrics.utils.os.getpid", return_value=-1):
+                child_r = utils.get_r()
+                self.assertIsNot(child_r, r)
+                self.assertIs(utils.get_r(), child_r)
+        utils._pid = os.getpid()
+        utils._redis_model = None
+
+    def test_at_exit_skips_forked_processes(self):
+        func = Mock()
+        with patch("redis_metrics.utils.atexit") as mock_atexit:
+            utils._at_exit(func)
+        run = mock_atexit.register.call_args[0][0]
+        with patch("redis_metrics.utils.os.getpid", return_value=-1):
+            run()
+        self.assertFalse(func.called)
+        run()
+        func.assert_called_once_with()
+
     def test_set_metric(self):
         with patch("redis_metrics.utils.get_r") as mock_get_r:
             utils.set_metric("test-slug", 42)
@@ -103,7 +152,8 @@ class TestUtils(TestCase):
                 [
                     call(),
                     call().metric(
-                        "test-slug", num=1, category=None, expire=None, date=None
+                        "test-slug", num=1, category=None, expire=None, date=None,
+                        sample_rate=None
                     ),
                 ]
             )
@@ -115,7 +165,8 @@ class TestUtils(TestCase):
                 [
                     call(),
                     call().metric(
-                        "test-slug", num=1, category="Woo", expire=None, date=None
+                        "test-slug", num=1, category="Woo", expire=None, date=None,
+                        sample_rate=None
                     ),
                 ]
             )
@@ -127,7 +178,8 @@ class TestUtils(TestCase):
                 [
                     call(),
                     call().metric(
-                        "test-slug", num=1, category=None, expire=300, date=None
+                        "test-slug", num=1, category=None, expire=300, date=None,
+                        sample_rate=None
                     ),
                 ]
             )
@@ -144,10 +196,19 @@ class TestUtils(TestCase):
                         category=None,
                         expire=None,
                         date=datetime(2000, 1, 2),
+                        sample_rate=None,
                     ),
                 ]
             )
 
+    def test_metric_with_sample_rate(self):
+        with patch("redis_metrics.utils.get_r") as mock_get_r:
+            utils.metric("test-slug", sample_rate=0.1)
+            mock_get_r.return_value.metric.assert_called_once_with(
+                "test-slug", num=1, category=None, expire=None, date=None,
+                sample_rate=0.1
+            )
+
     def test_gauge(self):
         with patch("redis_metrics.utils.get_r") as mock_get_r:
             utils.gauge("test-slug", 9000)
@@ -158,126 +219,228 @@ class TestUtils(TestCase):
                 ]
             )
 
+    def test_timing(self):
+        with patch("redis_metrics.utils.get_r") as mock_get_r:
+            utils.timing("test-slug", 42.5)
+            mock_get_r.return_value.timing.assert_called_once_with(
+                "test-slug", 42.5, date=None
+            )
+
+    def test_unique(self):
+        with patch("redis_metrics.utils.get_r") as mock_get_r:
+            utils.unique("test-slug", "alice")
+            mock_get_r.return_value.unique.assert_called_once_with(
+                "test-slug", "alice", date=None
+            )
+
+    def test_timed_decorator(self):
+        @utils.timed("work")
+        def work(x):
+            return x * 2
+
+        with patch("redis_metrics.utils.get_recorder") as mock_get_recorder:
+            self.assertEqual(work(2), 4)
+            recorder = mock_get_recorder.return_value
+            slug, value = recorder.timing.call_args[0]
+            self.assertEqual(slug, "work")
+            self.assertGreaterEqual(value, 0)
+        self.assertEqual(work.__name__, "work")
+
+    def test_timed_records_exceptions(self):
+        @utils.timed("work")
+        def work():
+            raise ValueError
+
+        with patch("redis_metrics.utils.get_recorder") as mock_get_recorder:
+            with self.assertRaises(ValueError):
+                work()
+            self.assertTrue(mock_get_recorder.return_value.timing.called)
+
+    def test_timed_context_manager(self):
+        with patch("redis_metrics.utils.time.perf_counter", side_effect=[1.0, 1.5]):
+            with patch("redis_metrics.utils.get_recorder") as mock_get_recorder:
+                with utils.timed("block"):
+                    pass
+        mock_get_recorder.return_value.timing.assert_called_once_with(
+            "block", 500.0
+        )
+
+    def test_timed_context_manager_nested_and_shared(self):
+        block = utils.timed("block")
+        times = iter([1.0, 2.0, 2.5, 4.0])
+        with patch("redis_metrics.utils.time.perf_counter", side_effect=lambda: next(times)):
+            with patch("redis_metrics.utils.get_recorder") as mock_get_recorder:
+                with block:
+                    with block:
+                        pass
+        mock_get_recorder.return_value.timing.assert_has_calls([
+            call("block", 500.0),
+            call("block", 3000.0),
+        ])
+
+        # Each thread has its own start times.
+        first_entered = threading.Event()
+        second_exited = threading.Event()
+
+        def first():
+            with block:
+                first_entered.set()
+                second_exited.wait()
+
+        def second():
+            first_entered.wait()
+            time.sleep(0.1)
+            with block:
+                pass
+            second_exited.set()
+
+        with patch("redis_metrics.utils.get_recorder") as mock_get_recorder:
+            threads = [threading.Thread(target=first), threading.Thread(target=second)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        timing = mock_get_recorder.return_value.timing
+        first_ms = timing.call_args_list[1][0][1]
+        second_ms = timing.call_args_list[0][0][1]
+        self.assertGreaterEqual(first_ms, 100)
+        self.assertLess(second_ms, first_ms)
+
+    def test_timed_coroutine(self):
+        @utils.timed("work")
+        async def work():
+            return 42
+
+        with patch("redis_metrics.utils.get_recorder") as mock_get_recorder:
+            self.assertEqual(async_to_sync(work)(), 42)
+            self.assertEqual(
+                mock_get_recorder.return_value.timing.call_args[0][0], "work"
+            )
+
+    def test_count_calls(self):
+        @utils.count_calls("calls")
+        def work():
+            return 42
+
+        @utils.count_calls("acalls")
+        async def awork():
+            return 43
+
+        with patch("redis_metrics.utils.get_recorder") as mock_get_recorder:
+            self.assertEqual(work(), 42)
+            self.assertEqual(async_to_sync(awork)(), 43)
+            mock_get_recorder.return_value.count.assert_has_calls([
+                call("calls"), call("acalls")
+            ])
+
+    def _test_metrics_r(self, **settings):
+        """Returns the ``R`` that ``get_r`` returns, and its mock Redis
+        client, for the test metrics helpers. ``_date_range`` yields one
+        date."""
+        with override_settings(REDIS_METRICS=dict(TEST_SETTINGS, **settings)):
+            with patch("redis_metrics.models.redis.StrictRedis") as mock_redis:
+                r = R()
+        date_range = patch.object(r, "_date_range", return_value=[datetime(2000, 1, 2)])
+        date_range.start()
+        self.addCleanup(date_range.stop)
+        get_r = patch("redis_metrics.utils.get_r", return_value=r)
+        get_r.start()
+        self.addCleanup(get_r.stop)
+        return r, mock_redis.return_value
+
     def test_generate_test_metrics(self):
-        keys = [
-            "m:test-slug:s:2000-01-02-03-04-05",
-            "m:test-slug:i:2000-01-02-03-04",
-            "m:test-slug:h:2000-01-02-03",
-            "m:test-slug:2000-01-02",
-            "m:test-slug:w:2000-01",
-            "m:test-slug:m:2000-01",
-            "m:test-slug:y:2000",
-        ]
-        config = {
-            "_build_keys.return_value": keys,
-            "_metric_slugs_key": "MSK",
-            "_date_range.return_value": [datetime.utcnow()],
-        }
-        mock_r = Mock(**config)
-        config = {"return_value": mock_r}
-        with patch("redis_metrics.utils.get_r", **config) as mock_get_r:
-            # When called with random = True
-            with patch("redis_metrics.utils.random") as mock_random:
-                mock_random.randint.return_value = 9999
-                utils.generate_test_metrics(
-                    slug="test-slug", num=1, randomize=True, increment_value=1
-                )
-                mock_get_r.assert_called_once_with()
-                mock_r.r.sadd.assert_called_once_with("MSK", "test-slug")
-                mock_random.seed.assert_called_once_with()
-                mock_random.randint.assert_has_calls(
-                    [
-                        call(0, 1),
-                        call(0, 1),
-                        call(0, 1),
-                        call(0, 1),
-                    ]
-                )
-                mock_r.r.incr.assert_has_calls(
-                    [
-                        call("m:test-slug:2000-01-02", 9999),
-                        call("m:test-slug:w:2000-01", 9999),
-                        call("m:test-slug:m:2000-01", 9999),
-                        call("m:test-slug:y:2000", 9999),
-                    ]
-                )
-
-            mock_get_r.reset_mock()
-            mock_r.reset_mock()
-
-            # When called with random = False
+        r, redis = self._test_metrics_r()
+        pipe = redis.pipeline.return_value
+
+        # When called with random = True
+        with patch("redis_metrics.utils.random") as mock_random:
+            mock_random.randint.return_value = 9999
             utils.generate_test_metrics(
-                slug="test-slug", num=1, randomize=False, increment_value=1
-            )
-            mock_get_r.assert_called_once_with()
-            mock_r.r.sadd.assert_called_once_with("MSK", "test-slug")
-            mock_r.r.incr.assert_has_calls(
-                [
-                    call("m:test-slug:2000-01-02", 0),
-                    call("m:test-slug:w:2000-01", 0),
-                    call("m:test-slug:m:2000-01", 0),
-                    call("m:test-slug:y:2000", 0),
-                ]
+                slug="test-slug", num=1, randomize=True, increment_value=1
             )
+            redis.sadd.assert_called_once_with("metric-slugs", "test-slug")
+            mock_random.seed.assert_called_once_with()
+            mock_random.randint.assert_has_calls([call(0, 1)] * 4)
+            self.assertEqual(pipe.mock_calls, [
+                call.incr("m:test-slug:2000-01-02", 9999),
+                call.incr("m:test-slug:w:2000-01", 9999),
+                call.incr("m:test-slug:m:2000-01", 9999),
+                call.incr("m:test-slug:y:2000", 9999),
+                call.execute(),
+            ])
+
+        # When called with random = False
+        pipe.reset_mock()
+        utils.generate_test_metrics(
+            slug="test-slug", num=1, randomize=False, increment_value=1
+        )
+        pipe.incr.assert_has_calls([
+            call("m:test-slug:2000-01-02", 0),
+            call("m:test-slug:w:2000-01", 0),
+            call("m:test-slug:m:2000-01", 0),
+            call("m:test-slug:y:2000", 0),
+        ])
 
     def test_generate_test_metrics_with_cap(self):
-        keys = [
-            "m:test-slug:s:2000-01-02-03-04-05",
-            "m:test-slug:i:2000-01-02-03-04",
-            "m:test-slug:h:2000-01-02-03",
+        r, redis = self._test_metrics_r()
+        redis.mget.return_value = ["100", "1", None, "5"]
+        pipe = redis.pipeline.return_value
+        utils.generate_test_metrics(
+            slug="test-slug", num=1, cap=5, increment_value=1
+        )
+        redis.mget.assert_called_once_with([
             "m:test-slug:2000-01-02",
             "m:test-slug:w:2000-01",
             "m:test-slug:m:2000-01",
             "m:test-slug:y:2000",
-        ]
-        config = {
-            "_build_keys.return_value": keys,
-            "_metric_slugs_key": "MSK",
-            "r.get.return_value": 100,
-            "_date_range.return_value": [datetime.utcnow()],
-        }
-        mock_r = Mock(**config)
-        config = {"return_value": mock_r}
-        with patch("redis_metrics.utils.get_r", **config) as mock_get_r:
-            # When called with random = True
-            with patch("redis_metrics.utils.random") as mock_random:
-                mock_random.randint.return_value = 9999
-                utils.generate_test_metrics(
-                    slug="test-slug", num=1, randomize=True, cap=5, increment_value=1
-                )
-                mock_get_r.assert_called_once_with()
-                mock_r.r.sadd.assert_called_once_with("MSK", "test-slug")
-                mock_random.seed.assert_called_once_with()
-                mock_random.randint.assert_has_calls(
-                    [
-                        call(0, 1),
-                        call(0, 1),
-                        call(0, 1),
-                        call(0, 1),
-                    ]
-                )
-                # Should be no increment due to cap
-                mock_r.r.incr.assert_has_calls(
-                    [
-                        call("m:test-slug:2000-01-02", 0),
-                        call("m:test-slug:w:2000-01", 0),
-                        call("m:test-slug:m:2000-01", 0),
-                        call("m:test-slug:y:2000", 0),
-                    ]
-                )
-
-            mock_get_r.reset_mock()
-            mock_r.reset_mock()
+        ])
+        # Should be no increment for the keys at the cap
+        pipe.incr.assert_has_calls([
+            call("m:test-slug:2000-01-02", 0),
+            call("m:test-slug:w:2000-01", 0),
+            call("m:test-slug:m:2000-01", 0),
+            call("m:test-slug:y:2000", 0),
+        ])
+
+    def test_generate_test_metrics_with_hashes_storage_layout(self):
+        settings = dict(TEST_SETTINGS, MIN_GRANULARITY="daily", STORAGE_LAYOUT="hashes")
+        r, redis = self._test_metrics_r(**settings)
+        with override_settings(REDIS_METRICS=settings):
+            utils.generate_test_metrics(slug="test-slug", num=1)
+        self.assertEqual(redis.pipeline.return_value.mock_calls, [
+            call.hincrby("m:test-slug:2000-01", "2000-01-02", 0),
+            call.hincrby("m:test-slug:w:2000", "2000-01", 0),
+            call.hincrby("m:test-slug:m:2000", "2000-01", 0),
+            call.hincrby("m:test-slug:y:", "2000", 0),
+            call.execute(),
+        ])
 
     def test_delete_test_metrics(self):
-        d = datetime.utcnow()
-        with patch("redis_metrics.utils.get_r") as mock_get_r:
-            mock_r = mock_get_r.return_value
-            mock_r._metric_slugs_key = "MSK"
-            mock_r._build_keys.return_value = ["keys"]
-            mock_r._date_range.return_value = [d]
+        settings = dict(TEST_SETTINGS, MIN_GRANULARITY="daily")
+        r, redis = self._test_metrics_r(**settings)
+        with override_settings(REDIS_METRICS=settings):
+            utils.delete_test_metrics(slug="test-metric", num=1)
+        self.assertEqual(redis.pipeline.return_value.mock_calls, [
+            call.delete(
+                "m:test-metric:2000-01-02",
+                "m:test-metric:w:2000-01",
+                "m:test-metric:m:2000-01",
+                "m:test-metric:y:2000",
+            ),
+            call.srem("metric-slugs", "test-metric"),
+            call.execute(),
+        ])
 
+    def test_delete_test_metrics_with_hashes_storage_layout(self):
+        settings = dict(TEST_SETTINGS, MIN_GRANULARITY="daily", STORAGE_LAYOUT="hashes")
+        r, redis = self._test_metrics_r(**settings)
+        with override_settings(REDIS_METRICS=settings):
             utils.delete_test_metrics(slug="test-metric", num=1)
-            mock_r._build_keys.assert_called_once_with("test-metric", date=d)
-            mock_r.r.srem.assert_called_once_with("MSK", "test-metric")
-            mock_r.r.delete.assert_called_once_with("keys")
+        self.assertEqual(redis.pipeline.return_value.mock_calls, [
+            call.hdel("m:test-metric:2000-01", "2000-01-02"),
+            call.hdel("m:test-metric:w:2000", "2000-01"),
+            call.hdel("m:test-metric:m:2000", "2000-01"),
+            call.hdel("m:test-metric:y:", "2000"),
+            call.srem("metric-slugs", "test-metric"),
+            call.execute(),
+        ])
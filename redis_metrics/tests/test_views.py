@@ -125,7 +125,9 @@ class TestViews(TestCase):
                 ]
             )
 
-    def test_metric_detail(self):
+    @patch("redis_metrics.templatetags.redis_metric_tags.get_r")
+    def test_metric_detail(self, mock_tags_get_r):
+        mock_tags_get_r.return_value.get_metric.return_value = {}
         with patch("redis_metrics.views.get_r") as mock_get_r:
             inst = mock_get_r.return_value
             inst._granularities.return_value = ["daily", "weekly"]
@@ -210,7 +212,7 @@ class TestViews(TestCase):
         expected."""
         url = reverse("redis_metric_aggregate")
         with patch("redis_metrics.views.get_r"):
-            with patch("redis_metrics.forms.R") as mock_r:
+            with patch("redis_metrics.forms.get_r") as mock_r:
                 # Set up a return value for ``R.metric_slugs``, which is used
                 # in the ``AggregateMetricForm``
                 r = mock_r.return_value  # An instance of our Mocked R class
@@ -321,7 +323,7 @@ class TestViews(TestCase):
             "return_value.metric_slugs.return_value": ["foo", "bar", "baz"],
             "return_value._category_slugs.return_value": [],
         }
-        with patch("redis_metrics.forms.R", **k):
+        with patch("redis_metrics.forms.get_r", **k):
             resp = self.client.get(url)
             self.assertEqual(resp.status_code, 200)
             self.assertIn("form", resp.context_data)
@@ -342,7 +344,7 @@ class TestViews(TestCase):
             "return_value.metric_slugs.return_value": ["foo", "bar", "baz"],
             "return_value._category_slugs.return_value": ["foo", "bar"],
         }
-        with patch("redis_metrics.forms.R", **k) as mock_R:
+        with patch("redis_metrics.forms.get_r", **k) as mock_R:
             resp = self.client.get(url)
             self.assertEqual(resp.status_code, 200)
             self.assertIn("form", resp.context_data)
@@ -378,7 +380,7 @@ class TestViews(TestCase):
             "return_value.metric_slugs.return_value": ["foo", "bar", "baz"],
             "return_value._category_slugs.return_value": ["foo", "bar"],
         }
-        with patch("redis_metrics.forms.R", **k) as mock_R:
+        with patch("redis_metrics.forms.get_r", **k) as mock_R:
             data = {"category_name": "Foo", "metrics": ["foo", "bar"]}
             resp = self.client.post(url, data)
             self.assertEqual(resp.status_code, 302)
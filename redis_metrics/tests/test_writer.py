@@ -0,0 +1,221 @@
+from __future__ import unicode_literals
+from datetime import datetime
+import threading
+
+try:
+    from unittest.mock import call, patch
+except ImportError:
+    from mock import call, patch
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ..models import R
+from ..writer import BackgroundWriter
+from .. import utils
+
+
+TEST_SETTINGS = {
+    "HOST": "localhost",
+    "PORT": 6379,
+    "DB": 0,
+    "PASSWORD": None,
+    "SOCKET_TIMEOUT": None,
+    "SOCKET_CONNECTION_POOL": None,
+    "MIN_GRANULARITY": "daily",
+    "MAX_GRANULARITY": "yearly",
+    "MONDAY_FIRST_DAY_OF_WEEK": False,
+    "USE_ISO_WEEK_NUMBER": False,
+    "WRITE_MODE": "background",
+    "WRITE_QUEUE_SIZE": 2,
+    "WRITE_QUEUE_POLICY": "drop-newest",
+    "WRITE_BATCH_SIZE": 100,
+}
+
+
+@override_settings(REDIS_METRICS=TEST_SETTINGS)
+class TestBackgroundWriter(TestCase):
+    """Tests for the ``BackgroundWriter`` class."""
+
+    def setUp(self):
+        self.redis_patcher = patch("redis_metrics.models.redis.StrictRedis")
+        mock_StrictRedis = self.redis_patcher.start()
+        self.redis = mock_StrictRedis.return_value
+        self.pipe = self.redis.pipeline.return_value
+        self.r = R()
+        self.date = datetime(2014, 7, 2, 12, 6, 34)
+
+    def tearDown(self):
+        self.redis_patcher.stop()
+        super(TestBackgroundWriter, self).tearDown()
+
+    def _stall(self, writer):
+        """Queue a metric, and hold the writer thread inside its pipeline
+        until the returned event is set."""
+        writing = threading.Event()
+        release = threading.Event()
+
+        def execute():
+            writing.set()
+            release.wait(5)
+        self.pipe.execute.side_effect = execute
+
+        writer.metric("first", date=self.date)
+        self.assertTrue(writing.wait(5))
+        return release
+
+    def test__init__with_default_settings(self):
+        writer = BackgroundWriter(self.r)
+        self.assertEqual(writer.max_size, 2)
+        self.assertEqual(writer.policy, "drop-newest")
+        self.assertEqual(writer.batch_size, 100)
+        self.assertIsNone(writer._thread)  # Started on first use
+
+    def test__init__with_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            BackgroundWriter(self.r, policy="drop-everything")
+
+    def test_metric_and_flush(self):
+        writer = BackgroundWriter(self.r, max_size=10)
+        writer.metric("foo", 2, category="Stuff", date=self.date)
+        self.assertTrue(writer.flush(timeout=5))
+
+        self.pipe.assert_has_calls([
+            call.sadd("metric-slugs", "foo"),
+            call.sadd("c:Stuff", "foo"),
+            call.sadd("categories", "Stuff"),
+            call.incr("m:foo:2014-07-02", 2),
+            call.incr("m:foo:w:2014-26", 2),
+            call.incr("m:foo:m:2014-07", 2),
+            call.incr("m:foo:y:2014", 2),
+            call.execute(),
+        ])
+        stats = writer.stats()
+        self.assertEqual(stats["depth"], 0)
+        self.assertEqual(stats["enqueued"], 1)
+        self.assertEqual(stats["written"], 1)
+        self.assertEqual(stats["batches"], 1)
+        self.assertEqual(stats["last_batch_size"], 1)
+        writer.stop()
+
+    @patch("redis_metrics.models.random.random")
+    def test_metric_sampled_out_is_not_queued(self, mock_random):
+        mock_random.return_value = 0.9
+        writer = BackgroundWriter(self.r, max_size=10)
+        writer.metric("foo", sample_rate=0.5, date=self.date)
+        self.assertEqual(writer.stats()["enqueued"], 0)
+        self.assertIsNone(writer._thread)
+
+    @patch("redis_metrics.models.random.random")
+    def test_metric_is_sampled_once(self, mock_random):
+        mock_random.return_value = 0.1
+        settings = dict(TEST_SETTINGS, SAMPLE_RATES={"foo": 0.5})
+        with override_settings(REDIS_METRICS=settings):
+            writer = BackgroundWriter(self.r, max_size=10)
+            writer.metric("foo", date=self.date)
+            self.assertTrue(writer.flush(timeout=5))
+            writer.stop()
+
+        # Sampled at 0.5, one event is counted as 2 (not scaled up twice).
+        self.pipe.incr.assert_any_call("m:foo:2014-07-02", 2)
+        self.assertNotIn(call("m:foo:2014-07-02", 4),
+                         self.pipe.incr.call_args_list)
+
+    def test_batches_coalesce_queued_metrics(self):
+        writer = BackgroundWriter(self.r, max_size=10)
+        release = self._stall(writer)
+        writer.metric("foo", date=self.date)
+        writer.metric("foo", 3, date=self.date)
+        self.assertEqual(writer.depth, 2)
+        release.set()
+        self.assertTrue(writer.flush(timeout=5))
+
+        self.pipe.incr.assert_any_call("m:foo:2014-07-02", 4)
+        stats = writer.stats()
+        self.assertEqual(stats["batches"], 2)
+        self.assertEqual(stats["max_batch_size"], 2)
+        self.assertEqual(stats["written"], 3)
+        self.assertGreater(stats["max_lag"], 0)
+        writer.stop()
+
+    def test_drop_newest(self):
+        writer = BackgroundWriter(self.r, policy="drop-newest")
+        release = self._stall(writer)
+        for slug in ["a", "b", "c"]:
+            writer.metric(slug, date=self.date)
+        self.assertEqual([r[1] for r in writer._queue], ["a", "b"])
+        self.assertEqual(writer.stats()["discarded"], 1)
+        release.set()
+        writer.stop()
+
+    def test_drop_oldest(self):
+        writer = BackgroundWriter(self.r, policy="drop-oldest")
+        release = self._stall(writer)
+        for slug in ["a", "b", "c"]:
+            writer.metric(slug, date=self.date)
+        self.assertEqual([r[1] for r in writer._queue], ["b", "c"])
+        self.assertEqual(writer.stats()["discarded"], 1)
+        release.set()
+        self.assertTrue(writer.flush(timeout=5))
+        writer.stop()
+
+    def test_block(self):
+        writer = BackgroundWriter(self.r, policy="block")
+        release = self._stall(writer)
+        writer.metric("a", date=self.date)
+        writer.metric("b", date=self.date)
+
+        blocked = threading.Thread(target=writer.metric, args=("c",))
+        blocked.start()
+        blocked.join(0.1)
+        self.assertTrue(blocked.is_alive())
+
+        release.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        self.assertTrue(writer.flush(timeout=5))
+        self.assertEqual(writer.stats()["discarded"], 0)
+        self.assertEqual(writer.stats()["written"], 4)
+        writer.stop()
+
+    def test_restarts_after_fork(self):
+        writer = BackgroundWriter(self.r, max_size=10)
+        release = self._stall(writer)
+        writer.metric("queued-in-parent", date=self.date)
+        parent_thread = writer._thread
+
+        with patch("redis_metrics.writer.os.getpid", return_value=-1):
+            self.pipe.execute.side_effect = None
+            writer.metric("foo", date=self.date)
+            self.assertIsNot(writer._thread, parent_thread)
+            self.assertTrue(writer.flush(timeout=5))
+            # The parent's queue isn't copied into the child.
+            self.assertEqual(writer.stats()["enqueued"], 1)
+            writer.stop()
+
+        release.set()
+        parent_thread.join(5)
+
+    def test_stop_writes_queued_metrics(self):
+        writer = BackgroundWriter(self.r, max_size=10)
+        release = self._stall(writer)
+        writer.metric("foo", date=self.date)
+        thread = writer._thread
+        release.set()
+        writer.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(writer.stats()["written"], 2)
+
+    def test_utils_metric_uses_writer(self):
+        utils._redis_model = None
+        utils._metric_writer = None
+        with patch("redis_metrics.utils._at_exit") as mock_at_exit:
+            utils.metric("foo", date=self.date)
+            writer = utils.get_writer()
+            mock_at_exit.assert_called_once_with(writer.stop)
+
+        utils.flush_metrics()
+        self.assertEqual(writer.stats()["written"], 1)
+        writer.stop()
+        utils._metric_writer = None
+        utils._redis_model = None
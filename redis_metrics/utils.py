@@ -1,18 +1,154 @@
 from __future__ import unicode_literals
+import atexit
+import functools
+import inspect
+import os
 import random
+import threading
+import time
 
+from contextvars import ContextVar
 from datetime import datetime, timedelta
-from .models import R
+from django.core.exceptions import ImproperlyConfigured
+from .aio import AsyncR
+from .buffer import MetricBuffer
+from .keys import get_schema
+from .models import R, dedupe
+from .recorder import CallRecorder
+from .settings import app_settings
+from .sharding import ShardedR
+from .writer import BackgroundWriter
 
 
+# The shared objects below belong to the process that created them: a
+# process forked from it (e.g. a gunicorn worker started with --preload)
+# creates its own, rather than sharing connections and threads.
 _redis_model = None
+_async_redis_model = None
+_metric_buffer = None
+_metric_writer = None
+_call_recorder = None
+_lock = threading.RLock()
+_pid = os.getpid()
+
+
+def _check_pid():
+    """Forgets the shared objects if this process was forked since they were
+    created. Call with ``_lock`` held."""
+    global _pid, _redis_model, _async_redis_model
+    global _metric_buffer, _metric_writer, _call_recorder
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _redis_model = None
+        _async_redis_model = None
+        _metric_buffer = None
+        _metric_writer = None
+        _call_recorder = None
+
+
+def _at_exit(func):
+    """Registers ``func`` to run when this process exits, but not when a
+    process forked from it does."""
+    pid = os.getpid()
+
+    def run():
+        if os.getpid() == pid:
+            func()
+    atexit.register(run)
 
 
 def get_r():
+    """Returns the process-wide ``R`` instance, or a ``ShardedR`` if the
+    SHARDS setting lists any Redis servers. It's safe to share between
+    threads, and is created again after a fork."""
     global _redis_model
-    if not _redis_model:
-        _redis_model = R()
-    return _redis_model
+    shared = _redis_model
+    if shared and _pid == os.getpid():
+        return shared
+    with _lock:
+        _check_pid()
+        if not _redis_model:
+            if app_settings.SHARDS:
+                _redis_model = ShardedR()
+            else:
+                _redis_model = R()
+        return _redis_model
+
+
+def get_async_r():
+    """Returns a shared ``AsyncR`` instance. Its connection pool belongs to
+    the event loop in which it's first used. Raises ImproperlyConfigured when
+    SHARDS is set, since ``AsyncR`` would only write to HOST."""
+    global _async_redis_model
+    if app_settings.SHARDS:
+        raise ImproperlyConfigured("AsyncR doesn't support SHARDS")
+    shared = _async_redis_model
+    if shared and _pid == os.getpid():
+        return shared
+    with _lock:
+        _check_pid()
+        if not _async_redis_model:
+            _async_redis_model = AsyncR()
+        return _async_redis_model
+
+
+def get_buffer():
+    """Returns the process-wide ``MetricBuffer`` used when
+    ``REDIS_METRICS['WRITE_MODE']`` is ``"buffered"``. Anything left in the
+    buffer is flushed when the process exits."""
+    global _metric_buffer
+    shared = _metric_buffer
+    if shared and _pid == os.getpid():
+        return shared
+    with _lock:
+        _check_pid()
+        if not _metric_buffer:
+            _metric_buffer = MetricBuffer(get_r())
+            _at_exit(_metric_buffer.flush)
+        return _metric_buffer
+
+
+def get_writer():
+    """Returns the process-wide ``BackgroundWriter`` used when
+    ``REDIS_METRICS['WRITE_MODE']`` is ``"background"``. The writer drains its
+    queue when the process exits."""
+    global _metric_writer
+    shared = _metric_writer
+    if shared and _pid == os.getpid():
+        return shared
+    with _lock:
+        _check_pid()
+        if not _metric_writer:
+            _metric_writer = BackgroundWriter(get_r())
+            _at_exit(_metric_writer.stop)
+        return _metric_writer
+
+
+def get_recorder():
+    """Returns the process-wide ``CallRecorder`` used by ``timed`` and
+    ``count_calls``. It writes anything left when the process exits."""
+    global _call_recorder
+    shared = _call_recorder
+    if shared and _pid == os.getpid():
+        return shared
+    with _lock:
+        _check_pid()
+        if not _call_recorder:
+            _call_recorder = CallRecorder(get_r())
+            _at_exit(_call_recorder.stop)
+        return _call_recorder
+
+
+def flush_metrics():
+    """Writes any buffered or queued metrics to Redis."""
+    with _lock:
+        _check_pid()
+    if _metric_buffer:
+        _metric_buffer.flush()
+    if _metric_writer:
+        _metric_writer.flush()
+    if _call_recorder:
+        _call_recorder.flush()
 
 
 def set_metric(slug, value, category=None, expire=None, date=None):
@@ -20,9 +156,23 @@ def set_metric(slug, value, category=None, expire=None, date=None):
     get_r().set_metric(slug, value, category=category, expire=expire, date=date)
 
 
-def metric(slug, num=1, category=None, expire=None, date=None):
+def metric(slug, num=1, category=None, expire=None, date=None, sample_rate=None):
     """Create/Increment a metric."""
-    get_r().metric(slug, num=num, category=category, expire=expire, date=date)
+    if app_settings.WRITE_MODE == "buffered":
+        r = get_buffer()
+    elif app_settings.WRITE_MODE == "background":
+        r = get_writer()
+    else:
+        r = get_r()
+    r.metric(
+        slug, num=num, category=category, expire=expire, date=date,
+        sample_rate=sample_rate
+    )
+
+
+def metrics_bulk(metrics, expire=None):
+    """Record many metrics at once; see ``R.metrics_bulk``."""
+    return get_r().metrics_bulk(metrics, expire=expire)
 
 
 def gauge(slug, current_value):
@@ -30,6 +180,133 @@ def gauge(slug, current_value):
     get_r().gauge(slug, current_value)
 
 
+def timing(slug, value, date=None):
+    """Record a timing (e.g. in milliseconds) for a timer"""
+    get_r().timing(slug, value, date=date)
+
+
+def unique(slug, member, date=None):
+    """Record a member (e.g. a user id) of a unique-count metric"""
+    get_r().unique(slug, member, date=date)
+
+
+async def aset_metric(slug, value, category=None, expire=None, date=None):
+    """Create/Increment a metric, from async code."""
+    await get_async_r().set_metric(
+        slug, value, category=category, expire=expire, date=date
+    )
+
+
+async def ametric(slug, num=1, category=None, expire=None, date=None,
+                  sample_rate=None):
+    """Create/Increment a metric, from async code."""
+    await get_async_r().metric(
+        slug, num=num, category=category, expire=expire, date=date,
+        sample_rate=sample_rate
+    )
+
+
+async def agauge(slug, current_value):
+    """Set a value for a Gauge, from async code."""
+    await get_async_r().gauge(slug, current_value)
+
+
+async def atiming(slug, value, date=None):
+    """Record a timing for a timer, from async code."""
+    await get_async_r().timing(slug, value, date=date)
+
+
+async def aunique(slug, member, date=None):
+    """Record a member of a unique-count metric, from async code."""
+    await get_async_r().unique(slug, member, date=date)
+
+
+# The start times of the ``with timed(...)`` blocks that haven't finished,
+# innermost last. Each thread and asyncio task has its own, so a shared
+# ``timed`` instance can time them all, even nested in itself.
+_timed_starts = ContextVar("redis_metrics_timed_starts", default=())
+
+
+class timed(object):
+    """Records how long something takes, in milliseconds, for the timer
+    ``slug`` (see ``R.timing``). Use it as a decorator, on a function or a
+    coroutine function::
+
+        @timed('search-view')
+        def search(request):
+            ...
+
+    or as a context manager::
+
+        with timed('thumbnail'):
+            make_thumbnail()
+
+    Timings are accumulated in memory by a ``CallRecorder`` and written to
+    Redis in batches, so the timed code never waits for Redis.
+
+    """
+
+    def __init__(self, slug):
+        self.slug = slug
+
+    def __enter__(self):
+        _timed_starts.set(_timed_starts.get() + (time.perf_counter(),))
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        starts = _timed_starts.get()
+        _timed_starts.set(starts[:-1])
+        get_recorder().timing(self.slug, (end - starts[-1]) * 1000)
+
+    def __call__(self, func):
+        slug = self.slug
+        perf_counter = time.perf_counter
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    get_recorder().timing(slug, (perf_counter() - start) * 1000)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    get_recorder().timing(slug, (perf_counter() - start) * 1000)
+        return wrapper
+
+
+def count_calls(slug):
+    """A decorator that increments the metric ``slug`` every time the
+    function (or coroutine function) is called. Like ``timed``, the counts
+    are written to Redis in batches::
+
+        @count_calls('search-requests')
+        def search(request):
+            ...
+
+    """
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                get_recorder().count(slug)
+                return await func(*args, **kwargs)
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                get_recorder().count(slug)
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def generate_test_metrics(slug='test-metric', num=100, randomize=False,
                           cap=None, increment_value=100):
     """Generate some dummy metrics for the given ``slug``.
@@ -43,9 +320,15 @@ def generate_test_metrics(slug='test-metric', num=100, randomize=False,
       generate a ceiling for random values.
 
     NOTE: This only generates metrics for daily and larger granularities.
+    Values are written in the configured STORAGE_LAYOUT, like ``R.metric``.
 
     """
     r = get_r()
+    schema = get_schema()
+    granularities = [
+        g for g in schema.granularities
+        if g in ('daily', 'weekly', 'monthly', 'yearly')
+    ]
     i = 0
     if randomize:
         random.seed()
@@ -53,24 +336,46 @@ def generate_test_metrics(slug='test-metric', num=100, randomize=False,
     r.r.sadd(r._metric_slugs_key, slug)  # Store the slug created.
     for date in r._date_range('daily', datetime.utcnow() - timedelta(days=num)):
         # Only keep the keys for daily and above granularities.
-        keys = r._build_keys(slug, date=date)
-        keys = [k for k in keys if k.split(":")[2] not in ['i', 's', 'h']]
-        for key in keys:
+        keys = [
+            key for granularity in granularities
+            for key in schema.build_keys(slug, date, granularity)
+        ]
+        current = r._mget(keys) if cap else [None] * len(keys)
+        pipe = r.r.pipeline(transaction=False)
+        for key, existing in zip(keys, current):
             # The following is normally done in r.metric, but we're adding
             # metrics for past days here, so this is duplicate code.
             value = i
             if randomize:
                 value = random.randint(0, i + increment_value)
-            if cap and r.r.get(key) >= cap:
+            if cap and int(existing or 0) >= cap:
                 value = 0  # Dont' increment this one any more.
-            r.r.incr(key, value)
+            r._incr(pipe, key, value)
+        pipe.execute()
         i += increment_value
 
 
 def delete_test_metrics(slug='test-metric', num=100):
-    """Deletes the metrics created by ``generate_test_metrics``."""
+    """Deletes the metrics created by ``generate_test_metrics``, in either
+    STORAGE_LAYOUT."""
     r = get_r()
+    schema = get_schema()
+    keys = []
     for date in r._date_range('daily', datetime.utcnow() - timedelta(days=num)):
-        keys = r._build_keys(slug, date=date)
-        r.r.srem(r._metric_slugs_key, slug)  # remove metric slugs
-        r.r.delete(*keys)  # delete the metrics
+        keys.extend(r._build_keys(slug, date=date))
+    keys = list(dedupe(keys))
+
+    pipe = r.r.pipeline(transaction=False)
+    if schema.hashed:
+        # Only delete the test metrics' fields from each hash.
+        fields = {}
+        for key in keys:
+            name, field = schema.hash_field(key)
+            fields.setdefault(name, []).append(field)
+        for name, names in fields.items():
+            pipe.hdel(name, *names)
+    else:
+        r._queue_delete(pipe, keys)  # delete the metrics
+    pipe.srem(r._metric_slugs_key, slug)  # remove metric slugs
+    pipe.execute()
+    r._known_slugs.discard(r._metric_slugs_key, slug)
@@ -0,0 +1,229 @@
+"""
+A background thread that writes metrics to Redis.
+
+When ``settings.REDIS_METRICS['WRITE_MODE']`` is set to ``"background"``, calls
+to ``redis_metrics.utils.metric`` only append a small record to an in-memory
+queue and return. A daemon thread drains the queue in batches of up to
+``WRITE_BATCH_SIZE`` records, sums the increments for each Redis key, and
+writes each batch using a single pipeline (see ``MetricBuffer``).
+
+The queue holds at most ``WRITE_QUEUE_SIZE`` records. When it's full, the
+``WRITE_QUEUE_POLICY`` setting decides what happens to a new record:
+
+* ``"block"`` -- the caller waits until the writer makes room.
+* ``"drop-oldest"`` -- the oldest queued record is discarded.
+* ``"drop-newest"`` -- the new record is discarded.
+
+The writer thread is started on first use and restarted in a forked child
+process (e.g. a gunicorn worker started with ``--preload``), which doesn't
+inherit the parent's threads. Records queued before the fork are left to the
+parent, so they're never written twice.
+
+"""
+from __future__ import unicode_literals
+from collections import deque
+from datetime import datetime
+import logging
+import os
+import threading
+import time
+
+from .buffer import MetricBuffer
+from .settings import app_settings
+
+logger = logging.getLogger(__name__)
+
+POLICIES = ("block", "drop-oldest", "drop-newest")
+
+
+class BackgroundWriter(object):
+
+    def __init__(self, r, max_size=None, policy=None, batch_size=None):
+        """Creates a writer that sends metrics using the given ``R`` instance.
+
+        * ``r`` -- an instance of ``redis_metrics.models.R``
+        * ``max_size`` -- The most records to hold in the queue (set in
+          settings.REDIS_METRICS['WRITE_QUEUE_SIZE'])
+        * ``policy`` -- What to do when the queue is full; one of "block",
+          "drop-oldest", or "drop-newest" (set in
+          settings.REDIS_METRICS['WRITE_QUEUE_POLICY'])
+        * ``batch_size`` -- The most records to write in one pipeline (set in
+          settings.REDIS_METRICS['WRITE_BATCH_SIZE'])
+
+        """
+        self.r = r
+        if max_size is None:
+            max_size = app_settings.WRITE_QUEUE_SIZE
+        if policy is None:
+            policy = app_settings.WRITE_QUEUE_POLICY
+        if batch_size is None:
+            batch_size = app_settings.WRITE_BATCH_SIZE
+        if policy not in POLICIES:
+            raise ValueError("Unknown WRITE_QUEUE_POLICY: {0}".format(policy))
+        self.max_size = max_size
+        self.policy = policy
+        self.batch_size = batch_size
+
+        self._pid = None  # The process in which the thread is running
+        self._start_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        """Set up an empty queue and new counters, without starting the
+        writer thread."""
+        self._queue = deque()  # [(enqueued at, slug, num, category, expire, date)]
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._all_written = threading.Condition(self._lock)
+        self._unfinished = 0  # Records queued or being written
+        self._stopping = False
+        self._thread = None
+
+        # Coalesces each batch into a single pipeline; it's only flushed
+        # explicitly, by the writer thread.
+        self._buffer = MetricBuffer(
+            self.r,
+            max_size=float("inf"),
+            flush_interval=float("inf")
+        )
+
+        self.enqueued = 0  # Number of records accepted into the queue
+        self.discarded = 0  # Number of records dropped because it was full
+        self.batches = 0  # Number of batches taken from the queue
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_lag = 0.0  # Seconds from enqueue to write, for the oldest
+        self.max_lag = 0.0  # record in a batch
+
+    def _ensure_started(self):
+        """Starts the writer thread if it isn't running in this process."""
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            pid = os.getpid()
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                # We're in a forked child: the thread, and possibly the held
+                # state of the parent's locks, didn't survive the fork.
+                self._start_lock = threading.Lock()
+                self._reset()
+            self._stopping = False
+            self._thread = threading.Thread(
+                target=self._run,
+                name="redis-metrics-writer"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = pid
+
+    def metric(self, slug, num=1, category=None, expire=None, date=None,
+               sample_rate=None):
+        """Queues a metric. This accepts the same arguments as ``R.metric``.
+        The current time is captured now, so the metric is counted in the
+        period in which it was recorded. Sampling happens here, so skipped
+        metrics never reach the queue."""
+        num = self.r._sample(slug, num, sample_rate)
+        if num is None:
+            return
+
+        self._ensure_started()
+        if date is None:
+            date = datetime.utcnow()
+        record = (time.monotonic(), slug, num, category, expire, date)
+
+        with self._lock:
+            if len(self._queue) >= self.max_size:
+                if self.policy == "drop-newest":
+                    self.discarded += 1
+                    return
+                elif self.policy == "drop-oldest":
+                    self._queue.popleft()
+                    self._unfinished -= 1
+                    self.discarded += 1
+                else:
+                    while len(self._queue) >= self.max_size and not self._stopping:
+                        self._not_full.wait()
+            self._queue.append(record)
+            self._unfinished += 1
+            self.enqueued += 1
+            self._not_empty.notify()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._queue and not self._stopping:
+                    self._not_empty.wait()
+                if not self._queue:
+                    return  # Stopped, and everything has been written.
+                size = min(self.batch_size, len(self._queue))
+                batch = [self._queue.popleft() for i in range(size)]
+                self._not_full.notify_all()
+
+            try:
+                self._write(batch)
+            except Exception:
+                # Keep the thread alive; the next batch may well succeed.
+                logger.exception("Failed to write %d metrics", len(batch))
+            finally:
+                with self._lock:
+                    self._unfinished -= len(batch)
+                    if self._unfinished <= 0:
+                        self._all_written.notify_all()
+
+    def _write(self, batch):
+        # Each record was already sampled (and scaled) by metric().
+        for enqueued_at, slug, num, category, expire, date in batch:
+            self._buffer.metric(slug, num, category=category, expire=expire,
+                                date=date, sample_rate=1)
+        self._buffer.flush()
+
+        self.batches += 1
+        self.last_batch_size = len(batch)
+        self.max_batch_size = max(self.max_batch_size, self.last_batch_size)
+        self.last_lag = time.monotonic() - batch[0][0]
+        self.max_lag = max(self.max_lag, self.last_lag)
+
+    def flush(self, timeout=None):
+        """Waits until every metric queued so far has been written. Returns
+        False if ``timeout`` seconds pass first."""
+        if self._pid != os.getpid():
+            return True  # Nothing has been queued in this process.
+        with self._lock:
+            return self._all_written.wait_for(
+                lambda: self._unfinished <= 0,
+                timeout=timeout
+            )
+
+    def stop(self, timeout=5):
+        """Writes whatever is left in the queue, then stops the writer thread.
+        Waits at most ``timeout`` seconds."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._stopping = True
+            self._not_empty.notify_all()
+            self._not_full.notify_all()
+        self._thread.join(timeout)
+        self._pid = None
+
+    @property
+    def depth(self):
+        """The number of records waiting in the queue."""
+        return len(self._queue)
+
+    def stats(self):
+        """Returns a dictionary of counters describing this writer."""
+        return {
+            'depth': self.depth,
+            'enqueued': self.enqueued,
+            'discarded': self.discarded,
+            'batches': self.batches,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'written': self._buffer.flushed,
+            'dropped': self._buffer.dropped,
+        }